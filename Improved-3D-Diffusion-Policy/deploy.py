@@ -18,26 +18,27 @@ os.environ['WANDB_SILENT'] = "True"
 OmegaConf.register_new_resolver("eval", eval, replace=True)
 
 
-from diffusion_policy_3d.common.multi_realsense import MultiRealSense
-
-zenoh_path="/home/gr1p24ap0049/projects/gr1-dex-real/teleop-zenoh"
-sys.path.append(zenoh_path)
-from communication import *
-from retarget import ArmRetarget
+from diffusion_policy_3d.common.async_executor import AsyncActionExecutor, TemporalEnsembler
+from diffusion_policy_3d.common.robot_backend import RobotBackend, make_backend
+from diffusion_policy_3d.common.episode_recorder import EpisodeRecorder
 
 
 import numpy as np
 import torch
+from collections import deque
 from termcolor import cprint
 
 class GR1DexEnvInference:
     """
-    The deployment is running on the local computer of the robot.
+    The deployment is running on the local computer of the robot,
+    or anywhere with the replay backend (see robot_backend.py).
     """
     def __init__(self, obs_horizon=2, action_horizon=8, device="gpu",
                 use_point_cloud=True, use_image=True, img_size=224,
                  num_points=4096,
-                 use_waist=False):
+                 use_waist=False,
+                 backend: RobotBackend=None,
+                 recorder: EpisodeRecorder=None):
         
         # obs/action
         self.use_point_cloud = use_point_cloud
@@ -45,10 +46,13 @@ class GR1DexEnvInference:
         
         self.use_waist = use_waist
         
-        # camera
-        self.camera = MultiRealSense(use_front_cam=True, # by default we use single cam. but we also support multi-cam
-                            front_num_points=num_points,
-                            img_size=img_size)
+        # robot comm and camera
+        if backend is None:
+            backend = make_backend("gr1", num_points=num_points, img_size=img_size)
+        self.backend = backend
+        self.camera = backend.camera
+        # streams (obs, action) steps to a replay buffer zarr, None to not record
+        self.recorder = recorder
 
         # horizon
         self.obs_horizon = obs_horizon
@@ -59,48 +63,53 @@ class GR1DexEnvInference:
             self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         else:
             self.device = torch.device("cpu")
-        
-        # robot comm
-        self.upbody_comm = UpperBodyCommunication()
-        self.hand_comm = HandCommunication()
-        self.arm_solver = ArmRetarget("AVP")
     
     
     def step(self, action_list):
         
         for action_id in range(self.action_horizon):
-            act = action_list[action_id]
-            self.action_array.append(act)
-            act = action_util.joint25_to_joint32(act)
-            
-            filtered_act = act.copy()
-            filtered_pos = filtered_act[:-12]
-            filtered_handpos = filtered_act[-12:]
-            if not self.use_waist:
-                filtered_pos[0:6] = 0.
-            
-            self.upbody_comm.set_pos(filtered_pos)
-            self.hand_comm.send_hand_cmd(filtered_handpos[6:], filtered_handpos[:6])
-            
-            
-            cam_dict = self.camera()
-            self.cloud_array.append(cam_dict['point_cloud'])
-            self.color_array.append(cam_dict['color'])
-            self.depth_array.append(cam_dict['depth'])
-            
-            try:
-                hand_qpos = self.hand_comm.get_qpos()
-            except:
-                cprint("fail to fetch hand qpos. use default.", "red")
-                hand_qpos = np.ones(12)
-            env_qpos = np.concatenate([self.upbody_comm.get_pos(), hand_qpos])
-            self.env_qpos_array.append(env_qpos)
-            
+            self.execute_action(action_list[action_id])
+        
+        return self.get_obs()
+
+    def execute_action(self, act):
+        """
+        Send a single action to the robot and record the resulting observation.
+        """
+        if self.recorder is not None:
+            # the action together with the observation it was taken at
+            self.recorder.add_step({
+                'state': self.env_qpos_array[-1],
+                'action': act,
+                'point_cloud': self.cloud_array[-1],
+                'image': self.color_array[-1],
+                'depth': self.depth_array[-1],
+            })
+        act = action_util.joint25_to_joint32(act)
+        
+        filtered_act = act.copy()
+        filtered_pos = filtered_act[:-12]
+        filtered_handpos = filtered_act[-12:]
+        if not self.use_waist:
+            filtered_pos[0:6] = 0.
+        
+        self.backend.set_upbody_pos(filtered_pos)
+        self.backend.send_hand_cmd(filtered_handpos[6:], filtered_handpos[:6])
+        
         
-        agent_pos = np.stack(self.env_qpos_array[-self.obs_horizon:], axis=0)
+        cam_dict = self.camera()
+        self.cloud_array.append(cam_dict['point_cloud'])
+        self.color_array.append(cam_dict['color'])
+        self.depth_array.append(cam_dict['depth'])
+        
+        env_qpos = self.backend.get_qpos()
+        self.env_qpos_array.append(env_qpos)
+
+    def get_obs(self):
+        agent_pos = np.stack(self.env_qpos_array, axis=0)
     
-        obs_cloud = np.stack(self.cloud_array[-self.obs_horizon:], axis=0)
-        obs_img = np.stack(self.color_array[-self.obs_horizon:], axis=0)
+        obs_cloud = np.stack(self.cloud_array, axis=0)
+        obs_img = np.stack(self.color_array, axis=0)
             
         obs_dict = {
             'agent_pos': torch.from_numpy(agent_pos).unsqueeze(0).to(self.device),
@@ -114,9 +123,13 @@ class GR1DexEnvInference:
     
     def reset(self, first_init=True):
         # init buffer
-        self.color_array, self.depth_array, self.cloud_array = [], [], []
-        self.env_qpos_array = []
-        self.action_array = []
+        # only the last obs_horizon observations are kept, the recorder keeps the rest
+        self.color_array = deque(maxlen=self.obs_horizon)
+        self.depth_array = deque(maxlen=self.obs_horizon)
+        self.cloud_array = deque(maxlen=self.obs_horizon)
+        self.env_qpos_array = deque(maxlen=self.obs_horizon)
+        if self.recorder is not None:
+            self.recorder.start_episode()
     
     
         # pos init
@@ -130,20 +143,20 @@ class GR1DexEnvInference:
         if first_init:
             # ======== INIT ==========
             upbody_initpos = np.concatenate([qpos_init2])
-            self.upbody_comm.init_set_pos(upbody_initpos)
-            self.hand_comm.send_hand_cmd(hand_init[6:], hand_init[:6])
+            self.backend.set_upbody_pos(upbody_initpos, init=True)
+            self.backend.send_hand_cmd(hand_init[6:], hand_init[:6])
 
         upbody_initpos = np.concatenate([qpos_init1])
-        self.upbody_comm.init_set_pos(upbody_initpos)
+        self.backend.set_upbody_pos(upbody_initpos, init=True)
         q_14d = upbody_initpos.copy()
             
         body_action = np.zeros(6)
         
         # this is a must for eef pos alignment
         arm_pos, arm_rot_quat = action_util.init_arm_pos, action_util.init_arm_quat
-        q_14d = self.arm_solver.ik(q_14d, arm_pos, arm_rot_quat)
-        self.upbody_comm.init_set_pos(q_14d)
-        time.sleep(2)
+        q_14d = self.backend.ik(q_14d, arm_pos, arm_rot_quat)
+        self.backend.set_upbody_pos(q_14d, init=True)
+        self.backend.wait(2)
         
         print("Robot ready!")
         
@@ -154,13 +167,7 @@ class GR1DexEnvInference:
         self.depth_array.append(cam_dict['depth'])
         self.cloud_array.append(cam_dict['point_cloud'])
 
-        try:
-            hand_qpos = self.hand_comm.get_qpos()
-        except:
-            cprint("fail to fetch hand qpos. use default.", "red")
-            hand_qpos = np.ones(12)
-
-        env_qpos = np.concatenate([self.upbody_comm.get_pos(), hand_qpos])
+        env_qpos = self.backend.get_qpos()
         self.env_qpos_array.append(env_qpos)
                         
         self.q_14d = q_14d
@@ -201,8 +208,16 @@ def main(cfg: OmegaConf):
         use_image = False
         use_point_cloud = True
         
+    # robot backend and policy device, see the deploy block of the config
+    deploy_cfg = cfg.get('deploy', None)
+    backend_name = "gr1" if deploy_cfg is None else deploy_cfg.backend
+    policy_device = "cuda" if deploy_cfg is None else deploy_cfg.device
+    backend_kwargs = dict()
+    if deploy_cfg is not None and deploy_cfg.get(backend_name, None) is not None:
+        backend_kwargs = OmegaConf.to_container(deploy_cfg[backend_name])
+
     # fetch policy model
-    policy = workspace.get_model()
+    policy = workspace.get_model(device=policy_device)
     action_horizon = policy.horizon - policy.n_obs_steps + 1
 
     # pour
@@ -220,54 +235,66 @@ def main(cfg: OmegaConf):
     num_points = 4096
     use_waist = True
     first_init = True
-    record_data = True
+    # only real rollouts are recorded
+    record_data = backend_name == "gr1"
+    # rollouts are appended as episodes, the zarr can be used as training data
+    record_path = "/home/gr1p24ap0049/projects/gr1-learning-real/deploy_dir/deploy.zarr"
+    # infer the next chunk in the background while the current one executes
+    async_execution = False
+    # 'ensemble' blends overlapping chunks, 'latest' switches to the newest chunk
+    ensemble_mode = "ensemble"
 
     env = GR1DexEnvInference(obs_horizon=2, action_horizon=action_horizon, device="cpu",
                              use_point_cloud=use_point_cloud,
                              use_image=use_image,
                              img_size=img_size,
                              num_points=num_points,
-                             use_waist=use_waist)
+                             use_waist=use_waist,
+                             backend=make_backend(backend_name, num_points=num_points, img_size=img_size,
+                                                  **backend_kwargs),
+                             recorder=EpisodeRecorder(record_path) if record_data else None)
 
     
     obs_dict = env.reset(first_init=first_init)
 
     step_count = 0
+    loop_start = time.time()
+    try:
+        if async_execution:
+            def infer_chunk(obs_dict):
+                # no_grad is thread local
+                with torch.no_grad():
+                    return policy(obs_dict)[0].cpu().numpy()
+            executor = AsyncActionExecutor(infer_chunk, ensembler=TemporalEnsembler(mode=ensemble_mode))
+            while step_count < roll_out_length:
+                executor.submit(obs_dict, step_count)
+                act = executor.next_action(step_count)
+                env.execute_action(act)
+                obs_dict = env.get_obs()
+                step_count += 1
+                if step_count % action_horizon == 0:
+                    print(f"step: {step_count} {executor.get_metrics()}")
+            executor.close()
     
-    while step_count < roll_out_length:
-        with torch.no_grad():
-            action = policy(obs_dict)[0]
-            action_list = [act.numpy() for act in action]
-        
-        obs_dict = env.step(action_list)
-        step_count += action_horizon
-        print(f"step: {step_count}")
-
-    if record_data:
-        import h5py
-        root_dir = "/home/gr1p24ap0049/projects/gr1-learning-real/"
-        save_dir = root_dir + "deploy_dir"
-        os.makedirs(save_dir, exist_ok=True)
-        
-        record_file_name = f"{save_dir}/demo.h5"
-        color_array = np.array(env.color_array)
-        depth_array = np.array(env.depth_array)
-        cloud_array = np.array(env.cloud_array)
-        qpos_array = np.array(env.qpos_array)
-        with h5py.File(record_file_name, "w") as f:
-            f.create_dataset("color", data=np.array(color_array))
-            f.create_dataset("depth", data=np.array(depth_array))
-            f.create_dataset("cloud", data=np.array(cloud_array))
-            f.create_dataset("qpos", data=np.array(qpos_array))
+        while step_count < roll_out_length:
+            with torch.no_grad():
+                action = policy(obs_dict)[0]
+                action_list = [act.cpu().numpy() for act in action]
         
-        choice = input("whether to rename: y/n")
-        if choice == "y":
-            renamed = input("file rename:")
-            os.rename(src=record_file_name, dst=record_file_name.replace("demo.h5", renamed+'.h5'))
-            new_name = record_file_name.replace("demo.h5", renamed+'.h5')
-            cprint(f"save data at step: {roll_out_length} in {new_name}", "yellow")
-        else:
-            cprint(f"save data at step: {roll_out_length} in {record_file_name}", "yellow")
+            obs_dict = env.step(action_list)
+            step_count += action_horizon
+            print(f"step: {step_count}")
+    finally:
+        # Ctrl-C or a crash still flushes the recorded part of the rollout
+        if env.recorder is not None:
+            env.recorder.end_episode()
+            env.recorder.close()
+            n_episodes = len(env.recorder.episode_ends)
+            cprint(f"save data at step: {step_count} as episode {n_episodes - 1} of {record_path}", "yellow")
+            cprint(f"recorder: {env.recorder.get_metrics()}", "yellow")
+    loop_time = time.time() - loop_start
+    cprint(f"deploy loop: {step_count} steps in {loop_time:.2f}s, {step_count / loop_time:.1f} steps/s", "green")
+    env.backend.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,185 @@
+"""
+Asynchronous action-chunk execution for deployment.
+
+The next action chunk is inferred in a background thread from the latest
+observation while the robot keeps executing the current chunk. Chunks are
+time-aligned by control step: a chunk inferred from the observation of step s
+holds the actions of steps s, s+1, ..., so actions of steps that already passed
+while the model was running are skipped, and the remaining ones are blended
+with the still pending actions of older chunks (temporal ensembling).
+"""
+from typing import Callable, Dict, Optional
+import threading
+import time
+from collections import deque
+import numpy as np
+
+
+class TemporalEnsembler:
+    """
+    Pending actions per control step, from every chunk that covers the step.
+
+    mode:
+        'ensemble': exponentially weighted average, w_i = exp(-exp_weight * i)
+            with i = 0 for the oldest chunk (exp_weight < 0 favours newer chunks)
+        'latest': the newest chunk replaces the remainder of older ones
+    """
+    def __init__(self, mode='ensemble', exp_weight=0.01):
+        assert mode in ('ensemble', 'latest'), mode
+        self.mode = mode
+        self.exp_weight = exp_weight
+        self.pending = dict()
+
+    def reset(self):
+        self.pending = dict()
+
+    def add_chunk(self, start_step: int, actions: np.ndarray, current_step: int=None):
+        """
+        actions: (T, Da), actions[i] is meant for control step start_step + i.
+        Actions of steps before current_step are outdated and dropped.
+        """
+        first = 0 if current_step is None else max(current_step - start_step, 0)
+        if self.mode == 'latest':
+            for step in [step for step in self.pending if step >= start_step + first]:
+                del self.pending[step]
+        for i in range(first, len(actions)):
+            self.pending.setdefault(start_step + i, list()).append(actions[i])
+
+    def has_action(self, step: int):
+        return step in self.pending
+
+    def horizon(self, step: int):
+        """Number of consecutive steps from `step` on that have an action."""
+        n = 0
+        while (step + n) in self.pending:
+            n += 1
+        return n
+
+    def pop(self, step: int) -> Optional[np.ndarray]:
+        # older steps can no longer be executed
+        for old in [s for s in self.pending if s < step]:
+            del self.pending[old]
+        preds = self.pending.pop(step, None)
+        if preds is None:
+            return None
+        if len(preds) == 1 or self.mode == 'latest':
+            return preds[-1]
+        weights = np.exp(-self.exp_weight * np.arange(len(preds)))
+        weights /= weights.sum()
+        return np.tensordot(weights, np.stack(preds, axis=0), axes=1)
+
+
+class AsyncActionExecutor:
+    """
+    Runs `infer_fn(obs_dict) -> (T, Da) np.ndarray` in a background thread.
+
+    submit() hands over the latest observation without blocking and is ignored
+    while the worker is busy, so every chunk is inferred from the freshest
+    observation. next_action() returns the blended action of a control step and
+    only blocks when no chunk covers that step yet, e.g. right after reset.
+    """
+    def __init__(self, infer_fn: Callable[[Dict], np.ndarray],
+            ensembler: Optional[TemporalEnsembler]=None,
+            overlap: Optional[int]=None):
+        """
+        overlap: start the next inference once at most this many actions are
+            pending, None infers continuously
+        """
+        self.infer_fn = infer_fn
+        self.ensembler = TemporalEnsembler() if ensembler is None else ensembler
+        self.overlap = overlap
+
+        self._cond = threading.Condition()
+        self._request = None
+        self._busy = False
+        self._step = 0
+        # bumped by reset(), chunks of inferences started before are dropped
+        self._generation = 0
+        self._busy_generation = 0
+        self._stop = False
+        self._error = None
+        self.latencies = deque(maxlen=100)
+        self.n_chunks = 0
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while self._request is None and not self._stop:
+                    self._cond.wait()
+                if self._stop:
+                    return
+                step, obs_dict = self._request
+                self._request = None
+                self._busy = True
+                generation = self._busy_generation = self._generation
+            try:
+                start = time.monotonic()
+                actions = np.asarray(self.infer_fn(obs_dict))
+                latency = time.monotonic() - start
+            except Exception as e:
+                with self._cond:
+                    self._error = e
+                    self._busy = False
+                    self._cond.notify_all()
+                return
+            with self._cond:
+                # an episode that was reset meanwhile has its own step indices
+                if generation == self._generation:
+                    self.ensembler.add_chunk(step, actions, current_step=self._step)
+                    self.n_chunks += 1
+                self.latencies.append(latency)
+                self._busy = False
+                self._cond.notify_all()
+
+    def _check_error(self):
+        if self._error is not None:
+            raise RuntimeError('AsyncActionExecutor: inference failed') from self._error
+
+    def submit(self, obs_dict: Dict, step: int):
+        """
+        Offer the observation of control `step`, returns whether an inference was started.
+        """
+        with self._cond:
+            self._check_error()
+            # an inference of the previous episode does not hold up the new one
+            if (self._busy and self._busy_generation == self._generation) \
+                    or self._request is not None:
+                return False
+            if self.overlap is not None and self.ensembler.horizon(step) > self.overlap:
+                return False
+            self._request = (step, obs_dict)
+            self._cond.notify_all()
+            return True
+
+    def next_action(self, step: int, timeout=None) -> np.ndarray:
+        with self._cond:
+            self._step = step
+            while not self.ensembler.has_action(step):
+                self._check_error()
+                if not self._cond.wait(timeout=timeout):
+                    raise TimeoutError(f'AsyncActionExecutor: no action for step {step}')
+            return self.ensembler.pop(step)
+
+    def reset(self):
+        """Start a new episode, a running inference is discarded when it finishes."""
+        with self._cond:
+            self._request = None
+            self._generation += 1
+            self._step = 0
+            self.ensembler.reset()
+
+    def get_metrics(self):
+        latencies = list(self.latencies)
+        return {
+            'n_chunks': self.n_chunks,
+            'latency_mean': float(np.mean(latencies)) if len(latencies) > 0 else 0.0,
+            'latency_max': float(np.max(latencies)) if len(latencies) > 0 else 0.0,
+        }
+
+    def close(self):
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+        self._thread.join()
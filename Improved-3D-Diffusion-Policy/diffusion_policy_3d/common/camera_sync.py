@@ -0,0 +1,180 @@
+"""
+Timestamp-based synchronization of several camera streams.
+
+Every camera is a frame source with the read side of SharedFrameRing:
+
+    source.read_history(newer_than) -> [(frame index, timestamp, data), ...] oldest first
+
+The synchronizer keeps a short history per camera and returns the newest tuple
+of frames (one per camera) whose timestamps lie within `tolerance` seconds of
+each other. Timestamps are taken from data[timestamp_key] when given (e.g. the
+device timestamp of a realsense frame), otherwise from the ring.
+"""
+from typing import Dict, Optional
+import time
+from collections import deque
+import numpy as np
+
+
+class CameraSynchronizer:
+    def __init__(self, sources: Dict[str, object],
+            tolerance=0.015,
+            history=8,
+            timestamp_key: Optional[str]='device_timestamp'):
+        assert len(sources) > 0
+        self.sources = dict(sources)
+        self.tolerance = tolerance
+        self.timestamp_key = timestamp_key
+        self.history = {name: deque(maxlen=history) for name in self.sources}
+        # newest frame index pulled / returned per camera
+        self.last_pulled = {name: -1 for name in self.sources}
+        self.last_returned = {name: -1 for name in self.sources}
+        self.reset_metrics()
+
+    def reset_metrics(self):
+        self.n_synced = 0
+        self.n_timeouts = 0
+        self.n_frames = {name: 0 for name in self.sources}
+        self.n_dropped = {name: 0 for name in self.sources}
+        self.skew_sum = 0.0
+        self.skew_max = 0.0
+
+    def _timestamp(self, stamp, data):
+        if self.timestamp_key is not None and self.timestamp_key in data:
+            return float(data[self.timestamp_key])
+        return stamp
+
+    def poll(self):
+        """
+        Pull new frames of every camera into its history.
+        """
+        for name, source in self.sources.items():
+            hist = self.history[name]
+            for frame, stamp, data in source.read_history(newer_than=self.last_pulled[name]):
+                if len(hist) == hist.maxlen and hist[0][0] > self.last_returned[name]:
+                    # pushed out of the history without ever being used
+                    self.n_dropped[name] += 1
+                # (frame index, sync timestamp, source timestamp, data)
+                hist.append((frame, self._timestamp(stamp, data), stamp, data))
+                self.last_pulled[name] = frame
+                self.n_frames[name] += 1
+
+    def _best_tuple(self):
+        """
+        Newest tuple within tolerance, anchored on the camera whose newest
+        frame is the oldest, or None.
+        """
+        names = list(self.sources.keys())
+        fresh = {name: [f for f in self.history[name] if f[0] > self.last_returned[name]]
+            for name in names}
+        if any(len(frames) == 0 for frames in fresh.values()):
+            return None
+        anchor = min(names, key=lambda name: fresh[name][-1][1])
+        for anchor_frame in reversed(fresh[anchor]):
+            t = anchor_frame[1]
+            chosen = {anchor: anchor_frame}
+            for name in names:
+                if name != anchor:
+                    chosen[name] = min(fresh[name], key=lambda f: abs(f[1] - t))
+            stamps = [f[1] for f in chosen.values()]
+            skew = max(stamps) - min(stamps)
+            if skew <= self.tolerance:
+                return chosen, skew
+        return None
+
+    def get(self, timeout=1.0, poll_interval=0.001):
+        """
+        Best-aligned tuple: {camera: (frame index, source timestamp, data)},
+        None if no tuple within tolerance shows up before the timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            self.poll()
+            result = self._best_tuple()
+            if result is not None:
+                chosen, skew = result
+                for name, (frame, _, _, _) in chosen.items():
+                    # unused fresh frames older than the chosen one are dropped
+                    self.n_dropped[name] += sum(1 for f in self.history[name]
+                        if self.last_returned[name] < f[0] < frame)
+                    self.last_returned[name] = frame
+                self.n_synced += 1
+                self.skew_sum += skew
+                self.skew_max = max(self.skew_max, skew)
+                return {name: (f[0], f[2], f[3]) for name, f in chosen.items()}
+            if deadline is not None and time.monotonic() > deadline:
+                self.n_timeouts += 1
+                return None
+            time.sleep(poll_interval)
+
+    def get_metrics(self):
+        metrics = {
+            'n_synced': self.n_synced,
+            'n_timeouts': self.n_timeouts,
+            'skew_mean': self.skew_sum / max(self.n_synced, 1),
+            'skew_max': self.skew_max,
+        }
+        for name in self.sources:
+            metrics[f'{name}_drop_rate'] = self.n_dropped[name] / max(self.n_frames[name], 1)
+        return metrics
+
+
+class SimulatedCameraSource:
+    """
+    Frame source for testing without cameras, same read side as SharedFrameRing.
+    Frames are generated lazily at `fps` from the wall clock, with a constant
+    clock offset, gaussian timestamp jitter and random frame drops.
+    """
+    def __init__(self, fps=30.0, offset=0.0, jitter=0.0, drop_prob=0.0,
+            n_slots=4, shape=(8, 8, 3), seed=0):
+        self.fps = fps
+        self.offset = offset
+        self.jitter = jitter
+        self.drop_prob = drop_prob
+        self.n_slots = n_slots
+        self.shape = tuple(shape)
+        self.rng = np.random.default_rng(seed=seed)
+        self.start = time.monotonic()
+        self.frames = deque(maxlen=n_slots)
+        self.n_generated = 0
+        self.count = 0
+
+    def _generate(self):
+        now = time.monotonic()
+        while self.start + self.n_generated / self.fps <= now:
+            k = self.n_generated
+            self.n_generated += 1
+            if self.rng.random() < self.drop_prob:
+                continue
+            stamp = self.start + k / self.fps + self.offset + self.rng.normal(0.0, self.jitter)
+            data = {
+                'color': np.full(self.shape, k % 256, dtype=np.uint8),
+                'device_timestamp': np.float64(stamp),
+            }
+            self.frames.append((self.count, stamp, data))
+            self.count += 1
+
+    def read_history(self, newer_than=-1):
+        self._generate()
+        return [f for f in self.frames if f[0] > newer_than]
+
+    def read_latest(self, newer_than=-1, timeout=None, poll_interval=0.0005):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            frames = self.read_history(newer_than)
+            if len(frames) > 0:
+                return frames[-1]
+            if deadline is not None and time.monotonic() > deadline:
+                return None
+            time.sleep(poll_interval)
+
+
+if __name__ == '__main__':
+    # two simulated cameras, the second one with a clock offset, jitter and drops
+    sync = CameraSynchronizer({
+        'front': SimulatedCameraSource(fps=30, seed=0),
+        'right': SimulatedCameraSource(fps=30, offset=0.004, jitter=0.003, drop_prob=0.1, seed=1),
+    }, tolerance=0.01)
+    for _ in range(60):
+        sync.get()
+    print(sync.get_metrics())
@@ -1,5 +1,6 @@
 from typing import Optional, Dict
 import os
+import shutil
 
 class TopKCheckpointManager:
     def __init__(self,
@@ -54,6 +55,9 @@ class TopKCheckpointManager:
             if not os.path.exists(self.save_dir):
                 os.mkdir(self.save_dir)
 
-            if os.path.exists(delete_path):
+            if os.path.isdir(delete_path):
+                # sharded checkpoint directory
+                shutil.rmtree(delete_path)
+            elif os.path.exists(delete_path):
                 os.remove(delete_path)
             return ckpt_path
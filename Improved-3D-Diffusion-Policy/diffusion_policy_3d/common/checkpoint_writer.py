@@ -0,0 +1,275 @@
+"""
+Sharded checkpoints, written by a background thread.
+
+A checkpoint is a directory:
+
+    latest.ckpt/
+        index.json                          committed last, by an atomic rename
+        meta-00003.pkl                      cfg and the pickled workspace attributes
+        model.obs_encoder.backbone-00001.pt one shard per submodule, shard_depth levels deep
+        optimizer-00003.pt                  other state dicts (optimizer, ...) are a single shard
+
+save() snapshots the state into pinned cpu buffers that are reused between
+saves and returns, the writer thread does the disk io. Shards whose tensors were
+not touched since the last save (same storage, same version counter), e.g. a
+frozen pretrained backbone, are neither copied nor rewritten. The index only
+references complete files, so a crash while writing leaves the previous
+checkpoint of the directory intact.
+"""
+from typing import Dict, Optional
+from collections import OrderedDict
+import atexit
+import copy
+import hashlib
+import json
+import os
+import pathlib
+import queue
+import threading
+import time
+import uuid
+import dill
+import torch
+from termcolor import cprint
+
+INDEX_FILE = 'index.json'
+
+
+def _is_flat_tensor_dict(state_dict):
+    return len(state_dict) > 0 and all(isinstance(v, torch.Tensor) for v in state_dict.values())
+
+
+def _collect_tensors(value, out):
+    if isinstance(value, torch.Tensor):
+        out.append(value)
+    elif isinstance(value, dict):
+        for v in value.values():
+            _collect_tensors(v, out)
+    elif isinstance(value, (list, tuple)):
+        for v in value:
+            _collect_tensors(v, out)
+    return out
+
+
+class CheckpointWriter:
+    def __init__(self, shard_depth=2, max_pending=1):
+        """
+        shard_depth: module state dicts are split by the first shard_depth
+            components of their keys, e.g. 2: model.obs_encoder.* -> model.obs_encoder
+        max_pending: checkpoints queued for writing before save() blocks
+        """
+        self.shard_depth = shard_depth
+        # fingerprints use storage pointers, they are only valid within this process
+        self._token = uuid.uuid4().hex
+        # shard name -> (fingerprint, pinned cpu copy)
+        self._buffers = dict()
+        self.queue = queue.Queue(maxsize=max_pending)
+        self._error = None
+        self.n_saves = 0
+        self.n_copied_shards = 0
+        self.n_reused_shards = 0
+        self.n_written_shards = 0
+        self.n_skipped_shards = 0
+        self.last_snapshot_time = 0.0
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+        # daemon threads are killed at exit, queued checkpoints are written first
+        atexit.register(self.close)
+
+    # ========= training loop side ============
+    def save(self, path, cfg, state_dicts: Dict[str, dict], pickles: Dict[str, bytes], block=False):
+        """
+        state_dicts: workspace attribute -> state dict
+        pickles: workspace attribute -> dill pickled value
+        block: wait until the checkpoint is on disk
+        """
+        self._check_error()
+        start = time.monotonic()
+        shards = OrderedDict()
+        waited = False
+        copies = list()
+        for owner, state_dict in state_dicts.items():
+            for name, part, split in self._split(owner, state_dict):
+                fingerprint = self._fingerprint(part)
+                buffered = self._buffers.get(name)
+                if fingerprint is None or buffered is None or buffered[0] != fingerprint:
+                    if not waited:
+                        # pending checkpoints may still be reading the buffers
+                        self.wait()
+                        waited = True
+                    old = None if buffered is None else buffered[1]
+                    buffered = (fingerprint, self._snapshot(part, old, copies))
+                    self._buffers[name] = buffered
+                    self.n_copied_shards += 1
+                else:
+                    self.n_reused_shards += 1
+                shards[name] = {'owner': owner, 'split': split,
+                    'fingerprint': fingerprint, 'state': buffered[1]}
+        if any(t.is_cuda for t in copies):
+            # device -> pinned host copies are asynchronous
+            torch.cuda.synchronize()
+        meta = dill.dumps({'cfg': cfg, 'pickles': pickles})
+        self.last_snapshot_time = time.monotonic() - start
+        self.n_saves += 1
+
+        self.queue.put((pathlib.Path(path), meta, shards))
+        if block:
+            self.wait()
+
+    def _split(self, owner, state_dict):
+        """(shard name, state dict part, split) of one workspace attribute."""
+        if not _is_flat_tensor_dict(state_dict):
+            return [(owner, state_dict, False)]
+        parts = OrderedDict()
+        for key, value in state_dict.items():
+            prefix = '.'.join(key.split('.')[:-1][:self.shard_depth])
+            name = owner if prefix == '' else f'{owner}.{prefix}'
+            parts.setdefault(name, OrderedDict())[key] = value
+        return [(name, part, True) for name, part in parts.items()]
+
+    def _fingerprint(self, part):
+        """Changes whenever a tensor of the shard is modified in place or replaced, None if unknown."""
+        if not _is_flat_tensor_dict(part):
+            return None
+        items = [self._token]
+        for key, t in part.items():
+            items.append((key, t.data_ptr(), t._version, tuple(t.shape), str(t.dtype), str(t.device)))
+        return hashlib.sha1(repr(items).encode()).hexdigest()
+
+    def _snapshot(self, value, old, copies):
+        if isinstance(value, torch.Tensor):
+            if not (isinstance(old, torch.Tensor) and old.shape == value.shape and old.dtype == value.dtype):
+                old = torch.empty(value.shape, dtype=value.dtype, device='cpu',
+                    pin_memory=value.is_cuda)
+            old.copy_(value.detach(), non_blocking=True)
+            copies.append(value)
+            return old
+        if isinstance(value, dict):
+            old = old if isinstance(old, dict) else dict()
+            result = type(value)() if isinstance(value, OrderedDict) else dict()
+            for key, v in value.items():
+                result[key] = self._snapshot(v, old.get(key), copies)
+            return result
+        if isinstance(value, (list, tuple)) and len(_collect_tensors(value, list())) > 0:
+            old = old if isinstance(old, (list, tuple)) and len(old) == len(value) else [None] * len(value)
+            return type(value)(self._snapshot(v, o, copies) for v, o in zip(value, old))
+        return copy.deepcopy(value)
+
+    def wait(self):
+        """Block until every queued checkpoint is on disk."""
+        self.queue.join()
+        self._check_error()
+
+    def close(self):
+        if self._thread.is_alive():
+            self.queue.put(None)
+            self._thread.join()
+        self._check_error()
+
+    def _check_error(self):
+        if self._error is not None:
+            raise RuntimeError('CheckpointWriter: writing failed') from self._error
+
+    def get_metrics(self):
+        return {
+            'n_saves': self.n_saves,
+            'n_copied_shards': self.n_copied_shards,
+            'n_reused_shards': self.n_reused_shards,
+            'n_written_shards': self.n_written_shards,
+            'n_skipped_shards': self.n_skipped_shards,
+            'last_snapshot_time': self.last_snapshot_time,
+            'queue_depth': self.queue.qsize(),
+        }
+
+    # ========= writer thread ============
+    def _worker(self):
+        while True:
+            job = self.queue.get()
+            try:
+                if job is None:
+                    return
+                if self._error is None:
+                    self._write(*job)
+            except Exception as e:
+                self._error = e
+                cprint(f"[CheckpointWriter] failed to write {job[0]}: {e}", "red")
+            finally:
+                self.queue.task_done()
+
+    def _write(self, path: pathlib.Path, meta: bytes, shards):
+        if path.is_file():
+            # single-file checkpoint of an older version
+            path.unlink()
+        path.mkdir(parents=True, exist_ok=True)
+        old_index = read_index(path)
+        serial = 0 if old_index is None else old_index['serial'] + 1
+        old_shards = dict() if old_index is None else old_index['shards']
+
+        index = {
+            'serial': serial,
+            'meta': f'meta-{serial:05d}.pkl',
+            'shards': OrderedDict(),
+        }
+        path.joinpath(index['meta']).write_bytes(meta)
+        for name, shard in shards.items():
+            old = old_shards.get(name)
+            if shard['fingerprint'] is not None and old is not None \
+                    and old['fingerprint'] == shard['fingerprint'] \
+                    and path.joinpath(old['file']).exists():
+                file = old['file']
+                self.n_skipped_shards += 1
+            else:
+                file = f'{name}-{serial:05d}.pt'
+                with path.joinpath(file).open('wb') as f:
+                    torch.save(shard['state'], f)
+                self.n_written_shards += 1
+            index['shards'][name] = {'owner': shard['owner'], 'split': shard['split'],
+                'fingerprint': shard['fingerprint'], 'file': file}
+
+        # commit, the new files are only visible once the index points at them
+        tmp_path = path.joinpath(INDEX_FILE + '.tmp')
+        with tmp_path.open('w') as f:
+            json.dump(index, f, indent=1)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path.joinpath(INDEX_FILE))
+
+        referenced = {INDEX_FILE, index['meta']} | {entry['file'] for entry in index['shards'].values()}
+        for file in path.iterdir():
+            if file.name not in referenced:
+                file.unlink()
+
+
+def read_index(path) -> Optional[dict]:
+    index_path = pathlib.Path(path).joinpath(INDEX_FILE)
+    if not index_path.is_file():
+        return None
+    with index_path.open('r') as f:
+        return json.load(f)
+
+
+def load_payload(path, map_location='cpu'):
+    """
+    {'cfg', 'state_dicts', 'pickles'} of a sharded checkpoint directory,
+    or of a single-file checkpoint of an older version.
+    """
+    path = pathlib.Path(path)
+    if path.is_file():
+        return torch.load(path.open('rb'), pickle_module=dill, map_location=map_location)
+    index = read_index(path)
+    if index is None:
+        raise FileNotFoundError(f"{path} is not a checkpoint, {INDEX_FILE} is missing")
+    meta = dill.loads(path.joinpath(index['meta']).read_bytes())
+    state_dicts = OrderedDict()
+    for name, entry in index['shards'].items():
+        with path.joinpath(entry['file']).open('rb') as f:
+            state = torch.load(f, map_location=map_location)
+        if entry['split']:
+            state_dicts.setdefault(entry['owner'], OrderedDict()).update(state)
+        else:
+            state_dicts[entry['owner']] = state
+    return {
+        'cfg': meta['cfg'],
+        'state_dicts': state_dicts,
+        'pickles': meta['pickles'],
+    }
@@ -0,0 +1,69 @@
+"""
+torch.compile helpers for the policies.
+
+Compiled modules are kept out of the module tree (no duplicated `_orig_mod`
+entries in state dicts, nothing extra to deep-copy for the EMA model) and are
+compiled with static shapes: every input shape is compiled once, the first time
+it is seen, instead of recompiling with dynamic shapes in the middle of a run.
+"""
+import os
+import time
+import torch
+import torch.nn as nn
+from termcolor import cprint
+
+
+def enable_compile_cache(cache_dir=None):
+    """
+    Keep inductor's compiled fx graphs on disk, later runs with the same model
+    and shapes skip most of the compilation.
+    cache_dir: None uses inductor's default (TORCHINDUCTOR_CACHE_DIR or /tmp/torchinductor_<user>)
+    """
+    if cache_dir is not None:
+        os.environ['TORCHINDUCTOR_CACHE_DIR'] = os.path.expanduser(str(cache_dir))
+    import torch._inductor.config as inductor_config
+    if hasattr(inductor_config, 'fx_graph_cache'):
+        inductor_config.fx_graph_cache = True
+
+
+def _signature(value):
+    if isinstance(value, torch.Tensor):
+        return (tuple(value.shape), value.dtype, value.device)
+    if isinstance(value, dict):
+        return tuple((key, _signature(v)) for key, v in sorted(value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_signature(v) for v in value)
+    return value
+
+
+class CompiledModule:
+    """
+    Calls torch.compile(module). The first call of every input signature
+    (shapes, dtypes, devices, grad and train mode) includes the compilation,
+    its wall time is reported and kept in `compile_times`.
+    """
+    def __init__(self, module: nn.Module, name=None, mode='default', dynamic=False):
+        self.module = module
+        self.name = type(module).__name__ if name is None else name
+        self.compiled = torch.compile(module, mode=mode, dynamic=dynamic)
+        self.compile_times = dict()
+
+    def __call__(self, *args, **kwargs):
+        key = (_signature(args), _signature(kwargs),
+            torch.is_grad_enabled(), self.module.training)
+        if key in self.compile_times:
+            return self.compiled(*args, **kwargs)
+
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        result = self.compiled(*args, **kwargs)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        self.compile_times[key] = time.perf_counter() - start
+        cprint(f"[torch.compile] {self.name}: first call took {self.compile_times[key]:.1f}s "
+            f"(compile #{len(self.compile_times)})", "yellow")
+        return result
+
+    def total_compile_time(self):
+        return sum(self.compile_times.values())
@@ -0,0 +1,110 @@
+from typing import Optional, Tuple
+import numpy as np
+
+try:
+    import torch
+except ImportError:
+    torch = None
+
+
+class DepthBackProjector:
+    """
+    Back-projects depth images into (colored) point clouds.
+
+    The normalized pixel rays ((u - cx) / fx, (v - cy) / fy) are computed once
+    per image size and ROI and reused for every frame, so a frame only costs
+    one mask and a few multiplies in float32. ROI cropping and near/far
+    clipping are done in the same pass.
+
+    camera_info: anything with fx, fy, cx, cy and scale (depth divisor),
+        e.g. multi_realsense.CameraInfo
+    roi: optional pixel box (u_min, v_min, u_max, v_max), max exclusive
+    use_torch: run on `device` with torch, inputs may be numpy or tensors
+    """
+    def __init__(self, camera_info,
+            near=0.1, far=1.0,
+            roi: Optional[Tuple[int, int, int, int]]=None,
+            use_torch=False, device='cpu'):
+        if use_torch and torch is None:
+            raise ImportError('DepthBackProjector(use_torch=True) requires torch')
+        self.camera_info = camera_info
+        self.near = near
+        self.far = far
+        self.roi = roi
+        self.use_torch = use_torch
+        self.device = device
+        self._rays = dict()
+
+    def _roi_slices(self, height, width):
+        if self.roi is None:
+            return slice(0, height), slice(0, width)
+        u_min, v_min, u_max, v_max = self.roi
+        return slice(max(v_min, 0), min(v_max, height)), slice(max(u_min, 0), min(u_max, width))
+
+    def get_rays(self, height, width):
+        """
+        Flattened ray x/y factors of the ROI, (2, H_roi * W_roi) float32.
+        """
+        key = (height, width)
+        rays = self._rays.get(key)
+        if rays is None:
+            info = self.camera_info
+            rows, cols = self._roi_slices(height, width)
+            u = (np.arange(cols.start, cols.stop, dtype=np.float32) - info.cx) / info.fx
+            v = (np.arange(rows.start, rows.stop, dtype=np.float32) - info.cy) / info.fy
+            rays = np.stack([
+                np.broadcast_to(u[None, :], (len(v), len(u))).reshape(-1),
+                np.broadcast_to(v[:, None], (len(v), len(u))).reshape(-1)
+            ], axis=0).astype(np.float32)
+            if self.use_torch:
+                rays = torch.from_numpy(rays).to(self.device)
+            self._rays[key] = rays
+        return rays
+
+    def __call__(self, depth, color=None, near=None, far=None):
+        """
+        depth: (H, W) depth image, divided by camera_info.scale
+        color: optional (H, W, 3), appended as float32 channels
+        returns: (M, 3) or (M, 6) float32 points of the ROI with near < z < far
+        """
+        near = self.near if near is None else near
+        far = self.far if far is None else far
+        height, width = depth.shape[:2]
+        rays = self.get_rays(height, width)
+        rows, cols = self._roi_slices(height, width)
+        if self.use_torch:
+            return self._project_torch(depth, color, rays, rows, cols, near, far)
+
+        z = depth[rows, cols].reshape(-1).astype(np.float32)
+        scale = getattr(self.camera_info, 'scale', 1)
+        if scale != 1:
+            z /= scale
+        idx = np.flatnonzero((z > near) & (z < far))
+        n_channels = 3 if color is None else 6
+        cloud = np.empty((len(idx), n_channels), dtype=np.float32)
+        z = z[idx]
+        np.multiply(rays[0, idx], z, out=cloud[:, 0])
+        np.multiply(rays[1, idx], z, out=cloud[:, 1])
+        cloud[:, 2] = z
+        if color is not None:
+            cloud[:, 3:] = color[rows, cols].reshape(-1, 3)[idx]
+        return cloud
+
+    def _project_torch(self, depth, color, rays, rows, cols, near, far):
+        if isinstance(depth, np.ndarray):
+            # torch has no uint16, realsense depth is converted on the host
+            depth = torch.from_numpy(np.ascontiguousarray(depth[rows, cols], dtype=np.float32))
+        else:
+            depth = depth[rows, cols]
+        z = depth.to(self.device).reshape(-1).float()
+        scale = getattr(self.camera_info, 'scale', 1)
+        if scale != 1:
+            z = z / scale
+        mask = (z > near) & (z < far)
+        z = z[mask]
+        xyz = [rays[0][mask] * z, rays[1][mask] * z, z]
+        if color is not None:
+            color = torch.as_tensor(color, device=self.device)
+            xyz = torch.stack(xyz, dim=-1)
+            return torch.cat([xyz, color[rows, cols].reshape(-1, 3)[mask].float()], dim=-1)
+        return torch.stack(xyz, dim=-1)
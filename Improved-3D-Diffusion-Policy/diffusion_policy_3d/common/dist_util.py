@@ -0,0 +1,170 @@
+"""
+Helpers for multi-process data-parallel training launched with torchrun:
+
+    torchrun --nproc_per_node=4 train.py --config-name=idp3 ...
+
+Without torchrun (WORLD_SIZE unset or 1) everything degrades to the
+single-process behaviour, rank 0 of a world of size 1.
+"""
+import os
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def get_local_rank():
+    return int(os.environ.get('LOCAL_RANK', 0))
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def init_distributed(device='cuda:0', backend=None):
+    """
+    Join the process group set up by torchrun, if any.
+    Returns the device of this rank: cuda:<local_rank> for cuda training devices.
+    backend: None picks nccl for cuda and gloo for cpu
+    """
+    device = torch.device(device)
+    if int(os.environ.get('WORLD_SIZE', 1)) <= 1:
+        return device
+    if device.type == 'cuda':
+        device = torch.device('cuda', get_local_rank())
+        torch.cuda.set_device(device)
+    if backend is None:
+        backend = 'nccl' if device.type == 'cuda' else 'gloo'
+    if not is_distributed():
+        dist.init_process_group(backend=backend)
+    return device
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def broadcast_object(obj, src=0):
+    """Picklable object of rank `src` on every rank."""
+    if not is_distributed():
+        return obj
+    objs = [obj]
+    dist.broadcast_object_list(objs, src=src)
+    return objs[0]
+
+
+@torch.no_grad()
+def broadcast_module(module: nn.Module, src=0):
+    """Copy parameters and buffers of rank `src` into `module` on every rank."""
+    if not is_distributed():
+        return module
+    for tensor in list(module.parameters()) + list(module.buffers()):
+        dist.broadcast(tensor.data, src=src)
+    return module
+
+
+def all_reduce_mean(value, device=None):
+    """Mean of a float or tensor over all ranks."""
+    if not is_distributed():
+        return value
+    is_tensor = isinstance(value, torch.Tensor)
+    tensor = value.detach().clone() if is_tensor else torch.tensor(float(value), device=device)
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    tensor /= get_world_size()
+    return tensor if is_tensor else tensor.item()
+
+
+class LossWrapper(nn.Module):
+    """
+    DistributedDataParallel only synchronizes gradients of computations run
+    through its forward, so compute_loss is exposed as forward.
+    """
+    def __init__(self, policy: nn.Module):
+        super().__init__()
+        self.policy = policy
+
+    def forward(self, batch):
+        return self.policy.compute_loss(batch)
+
+
+def wrap_ddp(policy: nn.Module, device, find_unused_parameters=False) -> nn.Module:
+    """
+    Module whose forward(batch) computes the loss, wrapped in DDP when distributed.
+    """
+    wrapper = LossWrapper(policy)
+    if not is_distributed():
+        return wrapper
+    device_ids = [device.index] if device.type == 'cuda' else None
+    return nn.parallel.DistributedDataParallel(wrapper,
+        device_ids=device_ids,
+        find_unused_parameters=find_unused_parameters)
+
+
+class _ToyPolicy(nn.Module):
+    def __init__(self):
+        super().__init__()
+        self.net = nn.Linear(4, 2)
+
+    def compute_loss(self, batch):
+        return nn.functional.mse_loss(self.net(batch['obs']), batch['action'])
+
+
+def _self_check_worker(rank, world_size, port):
+    os.environ.update({'RANK': str(rank), 'LOCAL_RANK': str(rank),
+        'WORLD_SIZE': str(world_size), 'MASTER_ADDR': '127.0.0.1', 'MASTER_PORT': str(port)})
+    device = init_distributed('cpu')
+    assert is_distributed() and get_world_size() == world_size and get_rank() == rank
+
+    assert broadcast_object(f'rank{rank}') == 'rank0'
+    assert abs(all_reduce_mean(float(rank)) - (world_size - 1) / 2) < 1e-6
+
+    torch.manual_seed(rank)
+    policy = _ToyPolicy()
+    broadcast_module(policy)
+    reference = _ToyPolicy()
+    reference.load_state_dict(policy.state_dict())
+
+    # every rank gets its own half of the same full batch
+    generator = torch.Generator().manual_seed(0)
+    full = {'obs': torch.randn(8, 4, generator=generator),
+        'action': torch.randn(8, 2, generator=generator)}
+    shard = {key: value[rank::world_size] for key, value in full.items()}
+    model = wrap_ddp(policy, device)
+    model(shard).backward()
+    # DDP averages the gradients, equal to the gradient of the mean loss over the full batch
+    loss = torch.stack([reference.compute_loss({key: value[r::world_size] for key, value in full.items()})
+        for r in range(world_size)]).mean()
+    loss.backward()
+    for param, ref_param in zip(policy.parameters(), reference.parameters()):
+        assert torch.allclose(param.grad, ref_param.grad, atol=1e-6)
+    del model
+    cleanup()
+
+
+if __name__ == '__main__':
+    # DDP path on cpu with gloo, 2 processes:
+    #   python -m diffusion_policy_3d.common.dist_util
+    import socket
+    import torch.multiprocessing as mp
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+    mp.spawn(_self_check_worker, args=(2, port), nprocs=2, join=True)
+    print('dist_util: gloo self check passed')
@@ -0,0 +1,186 @@
+"""
+Streaming episode recorder, appends rollouts to a replay buffer zarr
+(data/<key>, meta/episode_ends, same layout as ReplayBuffer.add_episode)
+while they are running.
+
+Steps are handed to a background thread through a bounded queue and written
+every `flush_every` steps. Each flush also moves the end of the current episode,
+so the zarr on disk is a valid replay buffer at all times and a crash loses at
+most the steps that were not flushed yet.
+"""
+from typing import Dict
+import os
+import queue
+import threading
+import time
+import numpy as np
+import zarr
+from termcolor import cprint
+from diffusion_policy_3d.common.replay_buffer import ReplayBuffer
+
+
+class EpisodeRecorder:
+    def __init__(self, zarr_path,
+            max_queue_size=64,
+            flush_every=16,
+            compressor='default',
+            block=True):
+        """
+        max_queue_size: steps buffered between the control loop and the writer
+        block: add_step waits while the queue is full, otherwise the step is dropped
+        """
+        self.zarr_path = os.path.expanduser(zarr_path)
+        self.flush_every = flush_every
+        self.compressor = ReplayBuffer.resolve_compressor(compressor)
+        self.block = block
+
+        self.root = zarr.open(self.zarr_path, 'a')
+        if 'data' not in self.root:
+            ReplayBuffer.create_empty_zarr(root=self.root)
+        self._truncate_to_episode_ends()
+        self.data = self.root['data']
+        self.episode_ends = self.root['meta']['episode_ends']
+
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        self.n_steps = 0
+        self.n_dropped = 0
+        self.n_blocked = 0
+        self.blocked_time = 0.0
+        self.max_queue_depth = 0
+        self.n_written = 0
+        self._error = None
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def _truncate_to_episode_ends(self):
+        # a crash during a flush can leave some arrays longer than the last episode end
+        meta = self.root['meta']
+        n_steps = int(meta['episode_ends'][-1]) if len(meta['episode_ends']) > 0 else 0
+        for key, arr in self.root['data'].arrays():
+            if arr.shape[0] != n_steps:
+                cprint(f"[EpisodeRecorder] truncating {key} from {arr.shape[0]} to {n_steps} steps", "yellow")
+                arr.resize((n_steps,) + arr.shape[1:])
+
+    # ========= control loop side ============
+    def start_episode(self):
+        self._put(('start', None))
+
+    def add_step(self, step: Dict[str, np.ndarray]):
+        """
+        step: key -> single-step array, e.g. state, action, point_cloud, image.
+        None values are skipped, keys must stay the same within a zarr.
+        """
+        self._check_error()
+        self.n_steps += 1
+        step = {key: np.asarray(value) for key, value in step.items() if value is not None}
+        if not self.block:
+            try:
+                self.queue.put_nowait(('step', step))
+            except queue.Full:
+                self.n_dropped += 1
+                return
+        else:
+            self._put(('step', step))
+        self.max_queue_depth = max(self.max_queue_depth, self.queue.qsize())
+
+    def end_episode(self):
+        self._put(('end', None))
+
+    def _put(self, item, poll_interval=0.1):
+        # a writer that died would never drain the full queue, its error is raised instead
+        self._check_error()
+        blocked = self.queue.full()
+        start = time.monotonic()
+        while True:
+            try:
+                self.queue.put(item, timeout=poll_interval)
+                break
+            except queue.Full:
+                self._check_error()
+        if blocked:
+            self.n_blocked += 1
+            self.blocked_time += time.monotonic() - start
+
+    def _check_error(self):
+        if self._error is not None:
+            raise RuntimeError('EpisodeRecorder: writing failed') from self._error
+        if not self._thread.is_alive():
+            raise RuntimeError('EpisodeRecorder: the writer thread is not running')
+
+    def get_metrics(self):
+        return {
+            'n_steps': self.n_steps,
+            'n_written': self.n_written,
+            'n_dropped': self.n_dropped,
+            'n_blocked': self.n_blocked,
+            'blocked_time': self.blocked_time,
+            'queue_depth': self.queue.qsize(),
+            'max_queue_depth': self.max_queue_depth,
+        }
+
+    def close(self):
+        """
+        Flush everything that is queued and stop the writer.
+        """
+        if self._thread.is_alive():
+            try:
+                self._put(('close', None))
+            except RuntimeError:
+                # the writer died meanwhile, its error is raised below
+                pass
+            self._thread.join()
+        if self._error is not None:
+            raise RuntimeError('EpisodeRecorder: writing failed') from self._error
+
+    # ========= writer thread ============
+    def _worker(self):
+        pending = list()
+        new_episode = False
+        try:
+            while True:
+                kind, item = self.queue.get()
+                if kind == 'step':
+                    pending.append(item)
+                    if len(pending) >= self.flush_every:
+                        self._flush(pending, new_episode)
+                        new_episode = False
+                        pending = list()
+                elif kind == 'start':
+                    new_episode = True
+                else:
+                    # end and close
+                    if len(pending) > 0:
+                        self._flush(pending, new_episode)
+                        new_episode = False
+                        pending = list()
+                    if kind == 'close':
+                        return
+        except Exception as e:
+            self._error = e
+
+    def _flush(self, steps, new_episode):
+        curr_len = int(self.episode_ends[-1]) if len(self.episode_ends) > 0 else 0
+        if not new_episode and len(self.episode_ends) == 0:
+            new_episode = True
+        new_len = curr_len + len(steps)
+        if curr_len > 0:
+            assert set(steps[0].keys()) == set(self.data.array_keys()), \
+                f'recorded keys {sorted(steps[0].keys())} differ from {sorted(self.data.array_keys())}'
+        for key in steps[0].keys():
+            value = np.stack([step[key] for step in steps], axis=0)
+            if key not in self.data:
+                # chunked along time, one flush per chunk
+                self.data.zeros(name=key,
+                    shape=(new_len,) + value.shape[1:],
+                    chunks=(self.flush_every,) + value.shape[1:],
+                    dtype=value.dtype,
+                    compressor=self.compressor)
+                assert curr_len == 0, f'{key} is missing from the earlier episodes'
+            arr = self.data[key]
+            arr.resize((new_len,) + arr.shape[1:])
+            arr[curr_len:] = value
+        # the episode end is moved last, data beyond it is truncated on the next open
+        if new_episode:
+            self.episode_ends.resize(self.episode_ends.shape[0] + 1)
+        self.episode_ends[-1] = new_len
+        self.n_written += len(steps)
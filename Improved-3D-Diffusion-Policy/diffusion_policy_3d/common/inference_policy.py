@@ -0,0 +1,63 @@
+"""
+Inference-only policy artifacts.
+
+A training checkpoint holds the optimizer, both the model and its EMA copy and
+the pickled workspace, and loading it means building the whole training
+workspace. The exported artifact is a single torch file with what serving needs:
+
+    policy_cfg:  the resolved policy config (shape_meta, noise scheduler, network sizes)
+    state_dict:  weights of the served policy (the EMA copy if used), incl. normalizer params
+    precision:   precision the policy was trained in
+
+load_inference_policy() builds only the policy from it, on any device.
+"""
+import pathlib
+import hydra
+import torch
+from omegaconf import OmegaConf
+from termcolor import cprint
+
+ARTIFACT_VERSION = 1
+
+
+def save_inference_policy(policy: torch.nn.Module, policy_cfg, path, precision=None):
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if OmegaConf.is_config(policy_cfg):
+        policy_cfg = OmegaConf.to_container(policy_cfg, resolve=True)
+    state_dict = {key: value.detach().to('cpu') for key, value in policy.state_dict().items()}
+    artifact = {
+        'version': ARTIFACT_VERSION,
+        'policy_cfg': policy_cfg,
+        'state_dict': state_dict,
+        'precision': precision,
+    }
+    # written next to the target and renamed, a crash never leaves half an artifact
+    tmp_path = path.with_name(path.name + '.tmp')
+    with tmp_path.open('wb') as f:
+        torch.save(artifact, f)
+    tmp_path.replace(path)
+    cprint(f"Exported inference policy to {path}", "green")
+    return str(path.absolute())
+
+
+def load_inference_policy(path, device='cuda', mmap=False):
+    """
+    mmap: map the weights from the file instead of reading it up front
+    """
+    path = pathlib.Path(path)
+    load_kwargs = dict(map_location='cpu')
+    if mmap:
+        load_kwargs['mmap'] = True
+    artifact = torch.load(str(path), **load_kwargs)
+    assert artifact.get('version') == ARTIFACT_VERSION, f"{path} is not an inference policy artifact"
+
+    policy_cfg = OmegaConf.create(artifact['policy_cfg'])
+    if artifact['precision'] is not None and 'precision' in policy_cfg:
+        policy_cfg.precision = artifact['precision']
+    policy = hydra.utils.instantiate(policy_cfg)
+    policy.load_state_dict(artifact['state_dict'])
+    policy.to(torch.device(device))
+    policy.eval()
+    cprint(f"Loaded inference policy from {path} on {device}", "magenta")
+    return policy
@@ -0,0 +1,122 @@
+"""
+Training metrics without a host sync and a logging call per step.
+
+Per-step metrics are summed on the device. Every `flush_every` steps or
+`flush_interval` seconds the window averages are copied to the host in one
+transfer and handed to a background thread that writes them to wandb and the
+JsonLogger.
+"""
+from typing import Dict, Optional
+import queue
+import threading
+import time
+import numbers
+import torch
+
+# keys that are reported as their last value in the window instead of the mean
+LAST_VALUE_KEYS = ('global_step', 'epoch', 'lr')
+
+
+def to_float_dict(data: Dict) -> Dict:
+    """Tensors of `data` as python floats, copied to the host in one transfer."""
+    keys = [key for key, value in data.items() if isinstance(value, torch.Tensor)]
+    result = dict(data)
+    if len(keys) > 0:
+        values = torch.stack([data[key].detach().float().reshape(()) for key in keys]).cpu().tolist()
+        result.update(zip(keys, values))
+    return result
+
+
+class MetricsAggregator:
+    def __init__(self, wandb_run=None, json_logger=None,
+            flush_every=50, flush_interval=10.0, enabled=True):
+        """
+        wandb_run, json_logger: sinks, None to skip one (e.g. offline runs have no wandb_run)
+        enabled: False drops everything, e.g. on non-main ranks
+        """
+        self.wandb_run = wandb_run
+        self.json_logger = json_logger
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.enabled = enabled
+
+        self._sums = dict()
+        self._last = dict()
+        self._count = 0
+        self._step = None
+        self._last_flush = time.monotonic()
+        self.n_flushes = 0
+
+        self.queue = queue.Queue()
+        self._error = None
+        self._thread = threading.Thread(target=self._worker, daemon=True)
+        self._thread.start()
+
+    def add(self, metrics: Dict, step: int):
+        """
+        metrics: key -> tensor (device scalar) or number of one training step
+        """
+        if not self.enabled:
+            return
+        self._check_error()
+        for key, value in metrics.items():
+            if key in LAST_VALUE_KEYS:
+                self._last[key] = value
+            elif isinstance(value, torch.Tensor):
+                value = value.detach().float()
+                self._sums[key] = value if key not in self._sums else self._sums[key] + value
+            elif isinstance(value, numbers.Number):
+                self._sums[key] = self._sums.get(key, 0.0) + value
+        self._count += 1
+        self._step = step
+        if self._count >= self.flush_every \
+                or time.monotonic() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Hand the averages of the current window to the writer."""
+        self._last_flush = time.monotonic()
+        if self._count == 0:
+            return
+        record = {key: value / self._count for key, value in self._sums.items()}
+        record.update(self._last)
+        record = to_float_dict(record)
+        self.queue.put((record, self._step))
+        self._sums = dict()
+        self._last = dict()
+        self._count = 0
+        self.n_flushes += 1
+
+    def log(self, metrics: Dict, step: int):
+        """Write one record as is, after the pending window (e.g. the end-of-epoch log)."""
+        if not self.enabled:
+            return
+        self._check_error()
+        self.flush()
+        self.queue.put((to_float_dict(metrics), step))
+
+    def close(self):
+        if self.enabled:
+            self.flush()
+        if self._thread.is_alive():
+            self.queue.put(None)
+            self._thread.join()
+        self._check_error()
+
+    def _check_error(self):
+        if self._error is not None:
+            raise RuntimeError('MetricsAggregator: writing failed') from self._error
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            record, step = item
+            try:
+                if self.wandb_run is not None:
+                    self.wandb_run.log(record, step=step)
+                if self.json_logger is not None:
+                    self.json_logger.log(record)
+            except Exception as e:
+                self._error = e
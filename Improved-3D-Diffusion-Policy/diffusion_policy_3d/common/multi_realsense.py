@@ -7,6 +7,10 @@ import pyrealsense2 as rs
 from multiprocessing import Process, Pipe, Queue, Event
 import time
 import multiprocessing
+from diffusion_policy_3d.model.vision_3d.point_process import VoxelGrid, voxel_downsample_numpy
+from diffusion_policy_3d.common.depth_projection import DepthBackProjector
+from diffusion_policy_3d.common.shared_frame_ring import SharedFrameRing
+from diffusion_policy_3d.common.camera_sync import CameraSynchronizer
 multiprocessing.set_start_method('fork')
 
 np.printoptions(3, suppress=True)
@@ -87,18 +91,8 @@ def grid_sample_pcd(point_cloud, grid_size=0.005):
     Returns:
     - A NumPy array of sampled points with the same shape as the input but with fewer rows.
     """
-    coords = point_cloud[:, :3]  # Extract coordinates
-    scaled_coords = coords / grid_size
-    grid_coords = np.floor(scaled_coords).astype(int)
-    
-    # Create unique grid keys
-    keys = grid_coords[:, 0] + grid_coords[:, 1] * 10000 + grid_coords[:, 2] * 100000000
-    
-    # Select unique points based on grid keys
-    _, indices = np.unique(keys, return_index=True)
-    
-    # Return sampled points
-    return point_cloud[indices]
+    # collision-free voxel keys, see point_process.VoxelGrid
+    return voxel_downsample_numpy(point_cloud, grid_size)
 
 
 class CameraInfo():
@@ -113,7 +107,7 @@ class CameraInfo():
         self.scale = scale
         
 class SingleVisionProcess(Process):
-    def __init__(self, device, queue,
+    def __init__(self, device, ring: SharedFrameRing,
                 enable_rgb=True,
                 enable_depth=False,
                 enable_pointcloud=False,
@@ -122,9 +116,11 @@ class SingleVisionProcess(Process):
                 z_far=1.0,
                 z_near=0.1,
                 use_grid_sampling=True,
-                img_size=224) -> None:
+                img_size=224,
+                roi=None) -> None:
         super(SingleVisionProcess, self).__init__()
-        self.queue = queue
+        # latest frames are published to shared memory, see SharedFrameRing
+        self.ring = ring
         self.device = device
 
         self.enable_rgb = enable_rgb
@@ -133,6 +129,11 @@ class SingleVisionProcess(Process):
         self.sync_mode = sync_mode
             
         self.use_grid_sampling = use_grid_sampling
+        # keeps its voxel table between frames
+        self.voxel_grid = VoxelGrid(voxel_size=0.005)
+        # (u_min, v_min, u_max, v_max) pixel box of the aligned depth image, None for all
+        self.roi = roi
+        self.projector = None
 
   
         self.resize = True
@@ -146,6 +147,9 @@ class SingleVisionProcess(Process):
    
     def get_vision(self):
         frame = self.pipeline.wait_for_frames()
+        self.frame_timestamp = time.time()
+        # device clock in seconds, used to align cameras, see CameraSynchronizer
+        self.device_timestamp = frame.get_timestamp() / 1000.
 
         if self.enable_depth:
             aligned_frames = self.align.process(frame)
@@ -192,11 +196,14 @@ class SingleVisionProcess(Process):
                     enable_point_cloud=self.enable_pointcloud,
                     sync_mode=self.sync_mode)
 
+        # the block belongs to the parent process
+        self.ring.owner = False
         debug = False
         while True:
             color_frame, depth_frame, point_cloud_frame = self.get_vision()
-            self.queue.put([color_frame, depth_frame, point_cloud_frame])
-            time.sleep(0.05)
+            self.ring.write({'color': color_frame, 'depth': depth_frame, 'point_cloud': point_cloud_frame,
+                             'device_timestamp': self.device_timestamp},
+                            timestamp=self.frame_timestamp)
 
     def terminate(self) -> None:
         # self.pipeline.stop()
@@ -205,41 +212,23 @@ class SingleVisionProcess(Process):
    
     def create_colored_point_cloud(self, color, depth, far=1.0, near=0.1, num_points=10000):
         assert(depth.shape[0] == color.shape[0] and depth.shape[1] == color.shape[1])
-    
-        # Create meshgrid for pixel coordinates
-        xmap = np.arange(color.shape[1])
-        ymap = np.arange(color.shape[0])
-        xmap, ymap = np.meshgrid(xmap, ymap)
-
-        # Calculate 3D coordinates
-        points_z = depth / self.camera_info.scale
-        points_x = (xmap - self.camera_info.cx) * points_z / self.camera_info.fx
-        points_y = (ymap - self.camera_info.cy) * points_z / self.camera_info.fy
-        cloud = np.stack([points_x, points_y, points_z], axis=-1)
-        cloud = cloud.reshape([-1, 3])
-        
-        # Clip points based on depth
-        mask = (cloud[:, 2] < far) & (cloud[:, 2] > near)
-        cloud = cloud[mask]
-        color = color.reshape([-1, 3])
-        color = color[mask]
-
 
-        colored_cloud = np.hstack([cloud, color.astype(np.float32)])
+        # pixel rays are cached by the projector, see DepthBackProjector
+        if self.projector is None:
+            self.projector = DepthBackProjector(self.camera_info, near=near, far=far, roi=self.roi)
+        colored_cloud = self.projector(depth, color, near=near, far=far)
         if self.use_grid_sampling:
-            colored_cloud = grid_sample_pcd(colored_cloud, grid_size=0.005)
-        
-        if num_points > colored_cloud.shape[0]:
-            num_pad = num_points - colored_cloud.shape[0]
-            pad_points = np.zeros((num_pad, 6))
-            colored_cloud = np.concatenate([colored_cloud, pad_points], axis=0)
-        else: 
-            # Randomly sample points
-            selected_idx = np.random.choice(colored_cloud.shape[0], num_points, replace=True)
-            colored_cloud = colored_cloud[selected_idx]
-        
-        # shuffle
-        np.random.shuffle(colored_cloud)
+            colored_cloud = self.voxel_grid(colored_cloud)
+
+        n = colored_cloud.shape[0]
+        if num_points > n:
+            # zero padding, shuffled
+            padded = np.zeros((num_points, colored_cloud.shape[1]), dtype=np.float32)
+            padded[np.random.permutation(num_points)[:n]] = colored_cloud
+            colored_cloud = padded
+        else:
+            # random sampling with replacement, already in random order
+            colored_cloud = colored_cloud[np.random.randint(0, n, size=num_points)]
         return colored_cloud
 
 
@@ -251,12 +240,16 @@ class MultiRealSense(object):
                  front_z_far=1.0, front_z_near=0.1,
                  right_z_far=0.5, right_z_near=0.01,
                  use_grid_sampling=True,
-                 img_size=384):
+                 img_size=384,
+                 sync_tolerance=0.015):
 
         self.devices = get_realsense_id()
     
-        self.front_queue = Queue(maxsize=3)
-        self.right_queue = Queue(maxsize=3)
+        self.front_ring = SharedFrameRing(self._frame_spec(img_size, front_num_points)) if use_front_cam else None
+        self.right_ring = SharedFrameRing(self._frame_spec(img_size, right_num_points)) if use_right_cam else None
+        # index of the last frame handed out per camera, every call returns a new frame
+        self.front_frame = -1
+        self.right_frame = -1
 
       
         # 0: f1380328, 1: f1422212
@@ -264,12 +257,12 @@ class MultiRealSense(object):
         # sync_mode: Use 1 for master, 2 for slave, 0 for default (no sync)
 
         if use_front_cam:
-            self.front_process = SingleVisionProcess(self.devices[front_cam_idx], self.front_queue,
+            self.front_process = SingleVisionProcess(self.devices[front_cam_idx], self.front_ring,
                             enable_rgb=True, enable_depth=True, enable_pointcloud=True, sync_mode=1,
                             num_points=front_num_points, z_far=front_z_far, z_near=front_z_near, 
                             use_grid_sampling=use_grid_sampling, img_size=img_size)
         if use_right_cam:
-            self.right_process = SingleVisionProcess(self.devices[right_cam_idx], self.right_queue,
+            self.right_process = SingleVisionProcess(self.devices[right_cam_idx], self.right_ring,
                     enable_rgb=True, enable_depth=True, enable_pointcloud=True, sync_mode=1,
                         num_points=right_num_points, z_far=right_z_far, z_near=right_z_near, 
                         use_grid_sampling=use_grid_sampling,  img_size=img_size)
@@ -285,24 +278,58 @@ class MultiRealSense(object):
 
         self.use_front_cam = use_front_cam
         self.use_right_cam = use_right_cam
+
+        # with both cameras, frames are paired by device timestamp
+        self.synchronizer = None
+        if use_front_cam and use_right_cam and sync_tolerance is not None:
+            self.synchronizer = CameraSynchronizer({'front': self.front_ring, 'right': self.right_ring},
+                                                   tolerance=sync_tolerance)
         
+    @staticmethod
+    def _frame_spec(img_size, num_points):
+        # frames are resized to img_size, see SingleVisionProcess.get_vision
+        return {
+            'color': ((img_size, img_size, 3), np.uint8),
+            'depth': ((img_size, img_size), np.float32),
+            'point_cloud': ((num_points, 6), np.float32),
+            'device_timestamp': ((), np.float64),
+        }
         
     def __call__(self):  
+        if self.synchronizer is not None:
+            return self._synced_call()
+        # freshest frame of each camera, waits only if it was already returned
         cam_dict = {}
         if self.use_front_cam:  
-            front_color, front_depth, front_point_cloud = self.front_queue.get()
-            cam_dict.update({'color': front_color, 'depth': front_depth, 'point_cloud':front_point_cloud})
+            self.front_frame, front_timestamp, front = self.front_ring.read_latest(newer_than=self.front_frame)
+            cam_dict.update({'color': front['color'], 'depth': front['depth'], 'point_cloud': front['point_cloud'],
+                             'timestamp': front_timestamp})
       
         if self.use_right_cam: 
-            right_color, right_depth, right_point_cloud = self.right_queue.get()
-            cam_dict.update({'right_color': right_color, 'right_depth': right_depth, 'right_point_cloud':right_point_cloud})
+            self.right_frame, right_timestamp, right = self.right_ring.read_latest(newer_than=self.right_frame)
+            cam_dict.update({'right_color': right['color'], 'right_depth': right['depth'], 'right_point_cloud': right['point_cloud'],
+                             'right_timestamp': right_timestamp})
         return cam_dict
 
+    def _synced_call(self):
+        frames = None
+        while frames is None:
+            frames = self.synchronizer.get(timeout=1.0)
+            if frames is None:
+                print("camera sync timeout: {}".format(self.synchronizer.get_metrics()))
+        (_, front_timestamp, front), (_, right_timestamp, right) = frames['front'], frames['right']
+        return {'color': front['color'], 'depth': front['depth'], 'point_cloud': front['point_cloud'],
+                'timestamp': front_timestamp,
+                'right_color': right['color'], 'right_depth': right['depth'], 'right_point_cloud': right['point_cloud'],
+                'right_timestamp': right_timestamp}
+
     def finalize(self):
         if self.use_front_cam:
             self.front_process.terminate()
+            self.front_ring.close()
         if self.use_right_cam:
             self.right_process.terminate()
+            self.right_ring.close()
 
 
     def __del__(self):
@@ -0,0 +1,151 @@
+"""
+Action prediction error of a policy on a fixed evaluation subset.
+
+The subset is drawn once (seeded) from the validation split, or from the
+training split when there is no validation split (val_ratio: 0), collated and
+kept on the device, so every evaluation sees the same samples without going
+through a dataloader. The point cloud preprocessing is applied once when
+caching, and the sampling noise comes from a generator seeded on every
+evaluation, so differences between evaluations come from the weights only.
+"""
+from typing import Dict, Optional
+import copy
+import threading
+import time
+import numpy as np
+import torch
+from termcolor import cprint
+from diffusion_policy_3d.common.pytorch_util import dict_apply
+import diffusion_policy_3d.common.dist_util as dist_util
+
+
+class PolicyEvaluator:
+    def __init__(self, dataset, fallback_dataset=None,
+            n_samples=256,
+            batch_size=256,
+            max_steps=None,
+            seed=42,
+            device='cuda',
+            point_preprocessor=None,
+            background=False):
+        """
+        dataset: validation split, fallback_dataset is used when it is empty
+        n_samples: size of the evaluation subset, None for the whole split
+        max_steps: at most this many batches (training.max_val_steps)
+        background: evaluate a copy of the policy in a thread while training continues,
+            single process only: the reduction over ranks is a collective that would run
+            concurrently with the DDP gradient all-reduce, so it is ignored under torchrun
+        """
+        self.split = 'val'
+        if len(dataset) == 0 and fallback_dataset is not None:
+            dataset = fallback_dataset
+            self.split = 'train'
+        n_total = len(dataset)
+        if n_samples is None:
+            n_samples = n_total
+        if max_steps is not None:
+            n_samples = min(n_samples, max_steps * batch_size)
+        n_samples = min(n_samples, n_total)
+
+        self.batch_size = batch_size
+        self.seed = seed
+        self.device = torch.device(device)
+        self.background = background
+        if background and dist_util.is_distributed():
+            cprint("[PolicyEvaluator] background evaluation is single process only, "
+                "evaluating in the training loop", "yellow")
+            self.background = False
+
+        # the same samples every time, split across ranks
+        indices = np.sort(np.random.RandomState(seed).choice(n_total, n_samples, replace=False))
+        indices = indices[dist_util.get_rank()::dist_util.get_world_size()]
+        self.n_samples = len(indices)
+        start = time.monotonic()
+        self.batches = list()
+        devices = [self.device] if self.device.type == 'cuda' else []
+        with torch.random.fork_rng(devices=devices):
+            torch.manual_seed(seed)
+            for i in range(0, len(indices), batch_size):
+                samples = [dataset[int(idx)] for idx in indices[i:i + batch_size]]
+                batch = torch.utils.data.default_collate(samples)
+                batch = dict_apply(batch, lambda x: x.to(self.device))
+                if point_preprocessor is not None:
+                    batch['obs'] = point_preprocessor(batch['obs'], train=False)
+                self.batches.append(batch)
+        cprint(f"[PolicyEvaluator] {self.n_samples} {self.split} samples in {len(self.batches)} batches, "
+            f"cached in {time.monotonic() - start:.1f}s", "yellow")
+
+        self._eval_policy = None
+        self._thread = None
+        self._result = None
+        self._error = None
+
+    @torch.no_grad()
+    def evaluate(self, policy, reduce=True) -> Dict[str, float]:
+        """
+        Mean squared error of the predicted action sequences, averaged over samples.
+        reduce: average over ranks, every rank has to call evaluate from its main thread
+        """
+        start = time.monotonic()
+        # seeded noise from its own generator, the global random state of
+        # training is not touched (evaluate may run in a background thread)
+        generator = torch.Generator(device=self.device)
+        generator.manual_seed(self.seed)
+        sq_error = torch.zeros((), device=self.device)
+        for batch in self.batches:
+            pred_action = policy.predict_action(batch['obs'], generator=generator)['action_pred']
+            mse = torch.nn.functional.mse_loss(pred_action, batch['action'], reduction='none')
+            sq_error += mse.reshape(mse.shape[0], -1).mean(dim=1).sum()
+        stats = torch.stack([sq_error, torch.tensor(float(self.n_samples), device=self.device)])
+        if reduce:
+            # summed over ranks, one sync for the whole evaluation
+            stats = dist_util.all_reduce_mean(stats)
+        mse = (stats[0] / stats[1].clamp(min=1)).item()
+        return {
+            f'{self.split}_action_mse_error': mse,
+            'test_mean_score': -mse,
+            'eval_time': time.monotonic() - start,
+        }
+
+    # ========= background evaluation ============
+    def submit(self, policy, epoch=None):
+        """
+        Evaluate a snapshot of `policy` in the background, returns False while
+        the previous evaluation is still running or its result was not polled yet,
+        so a result always belongs to the last accepted submit.
+        """
+        # ranks would decide on their own whether to start, see __init__
+        assert not dist_util.is_distributed(), "background evaluation is single process only"
+        if self._thread is not None and self._thread.is_alive():
+            return False
+        if self._result is not None:
+            return False
+        if self._eval_policy is None:
+            self._eval_policy = copy.deepcopy(policy)
+        else:
+            self._eval_policy.load_state_dict(policy.state_dict())
+        self._eval_policy.eval()
+
+        def run():
+            try:
+                # no collectives from this thread
+                result = self.evaluate(self._eval_policy, reduce=False)
+                result['eval_epoch'] = epoch
+                self._result = result
+            except Exception as e:
+                self._error = e
+        self._thread = threading.Thread(target=run, daemon=True)
+        self._thread.start()
+        return True
+
+    def poll(self) -> Optional[Dict[str, float]]:
+        """Result of the last finished background evaluation, once."""
+        if self._error is not None:
+            raise RuntimeError('PolicyEvaluator: evaluation failed') from self._error
+        result, self._result = self._result, None
+        return result
+
+    def wait(self) -> Optional[Dict[str, float]]:
+        if self._thread is not None:
+            self._thread.join()
+        return self.poll()
@@ -1,5 +1,6 @@
 from typing import Dict, Callable, List
 import collections
+import numpy as np
 import torch
 import torch.nn as nn
 
@@ -80,3 +81,51 @@ def optimizer_to(optimizer, device):
             if isinstance(v, torch.Tensor):
                 state[k] = v.to(device=device)
     return optimizer
+
+
+class PinnedBufferPool:
+    """
+    Reusable page-locked host tensors keyed by name, used to stage numpy
+    arrays (e.g. read-only buffers received over zmq) for asynchronous
+    host-to-device copies without allocating on every request.
+    The staged copy of a key must have completed before the same key is
+    staged again, which holds for request/response loops that read results back.
+    """
+    def __init__(self, device):
+        self.device = torch.device(device)
+        self.pin_memory = (self.device.type == 'cuda')
+        self._buffers = dict()
+
+    def to_device(self, key, array: np.ndarray) -> torch.Tensor:
+        buf = self._buffers.get(key)
+        dtype = torch.from_numpy(np.empty((0,), dtype=array.dtype)).dtype
+        if buf is None or tuple(buf.shape) != array.shape or buf.dtype != dtype:
+            buf = torch.empty(array.shape, dtype=dtype, pin_memory=self.pin_memory)
+            self._buffers[key] = buf
+        np.copyto(buf.numpy(), array, casting='no')
+        return buf.to(self.device, non_blocking=self.pin_memory)
+
+
+def create_dataloader(dataset, batch_sampling=False, sampler=None, **kwargs):
+    """
+    DataLoader from a `dataloader` config block. With batch_sampling the dataset
+    receives a whole list of indices per call (dataset[list] -> batch) instead of
+    one index per sample followed by collate.
+    sampler: e.g. a DistributedSampler, replaces `shuffle`
+    """
+    kwargs = dict(kwargs)
+    if sampler is not None:
+        kwargs.pop('shuffle', None)
+    if not batch_sampling:
+        return torch.utils.data.DataLoader(dataset, sampler=sampler, **kwargs)
+    batch_size = kwargs.pop('batch_size', 1)
+    shuffle = kwargs.pop('shuffle', False)
+    drop_last = kwargs.pop('drop_last', False)
+    if sampler is None:
+        if shuffle:
+            sampler = torch.utils.data.RandomSampler(dataset)
+        else:
+            sampler = torch.utils.data.SequentialSampler(dataset)
+    batch_sampler = torch.utils.data.BatchSampler(sampler, batch_size, drop_last)
+    # batch_size=None disables auto collation, each "sample" is a full batch
+    return torch.utils.data.DataLoader(dataset, batch_size=None, sampler=batch_sampler, **kwargs)
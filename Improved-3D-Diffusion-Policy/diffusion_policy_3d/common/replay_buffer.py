@@ -8,6 +8,19 @@ import numpy as np
 from functools import cached_property
 from termcolor import cprint
 
+def get_newest_mtime(path):
+    """
+    Latest modification time of a file or of any file below a directory.
+    Rewriting zarr chunks in place does not touch the mtime of the array directory.
+    """
+    if not os.path.isdir(path):
+        return os.path.getmtime(path)
+    newest = os.path.getmtime(path)
+    for dirpath, _, filenames in os.walk(path):
+        for filename in filenames:
+            newest = max(newest, os.path.getmtime(os.path.join(dirpath, filename)))
+    return newest
+
 def check_chunks_compatible(chunks: tuple, shape: tuple):
     assert len(shape) == len(chunks)
     for c in chunks:
@@ -221,7 +234,10 @@ class ReplayBuffer:
         """
         Copy a on-disk zarr to in-memory compressed.
         Recommended
+        backend='memmap' maps the data from disk instead, see copy_from_path_memmap.
         """
+        if backend == 'memmap':
+            return cls.copy_from_path_memmap(zarr_path, keys=keys, **kwargs)
         if backend == 'numpy':
             print('backend argument is deprecated!')
             store = None
@@ -230,6 +246,69 @@ class ReplayBuffer:
             keys=keys, chunks=chunks, compressors=compressors, 
             if_exists=if_exists, **kwargs)
 
+    @classmethod
+    def copy_from_path_memmap(cls, zarr_path, memmap_dir=None, keys=None,
+            chunk_length=1024, **kwargs):
+        """
+        Expose a on-disk zarr as read-only np.memmap arrays (numpy backend).
+        Each key is converted once to an uncompressed .npy file in memmap_dir
+        (default: <zarr_path>.memmap). Dataloader workers and concurrent jobs
+        then share the data through the page cache instead of each holding a copy.
+        """
+        zarr_path = os.path.expanduser(zarr_path)
+        if memmap_dir is None:
+            memmap_dir = zarr_path.rstrip('/') + '.memmap'
+        memmap_dir = os.path.expanduser(memmap_dir)
+        group = zarr.open(zarr_path, 'r')
+
+        meta = dict()
+        for key, value in group['meta'].items():
+            if len(value.shape) == 0:
+                meta[key] = np.array(value)
+            else:
+                meta[key] = value[:]
+        if keys is None:
+            keys = group['data'].keys()
+        data = dict()
+        for key in keys:
+            data[key] = cls._load_memmap(
+                array=group['data'][key],
+                path=os.path.join(memmap_dir, key + '.npy'),
+                src_path=os.path.join(zarr_path, 'data', key),
+                chunk_length=chunk_length)
+
+        buffer = cls(root={'meta': meta, 'data': data})
+        for key, value in buffer.items():
+            cprint(f'Replay Buffer (memmap): {key}, shape {value.shape}, dtype {value.dtype}', 'green')
+        cprint("--------------------------", 'green')
+        return buffer
+
+    @staticmethod
+    def _load_memmap(array: zarr.Array, path, src_path=None, chunk_length=1024):
+        if os.path.exists(path):
+            arr = np.load(path, mmap_mode='r')
+            up_to_date = (src_path is None) or (not os.path.exists(src_path)) \
+                or (os.path.getmtime(path) >= get_newest_mtime(src_path))
+            if up_to_date and (arr.shape == array.shape) and (arr.dtype == array.dtype):
+                return arr
+            del arr
+
+        cprint(f'Converting {src_path} to memmap {path}', 'yellow')
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a private file and rename, concurrent jobs never see a partial file
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        out = np.lib.format.open_memmap(tmp_path, mode='w+',
+            dtype=array.dtype, shape=array.shape)
+        # read whole zarr chunks at a time
+        src_chunk = array.chunks[0] if len(array.chunks) > 0 else 1
+        step = src_chunk * max(1, chunk_length // src_chunk)
+        for start in range(0, array.shape[0], step):
+            out[start:start+step] = array[start:start+step]
+        out.flush()
+        del out
+        os.replace(tmp_path, path)
+        return np.load(path, mmap_mode='r')
+
     # ============= save methods ===============
     def save_to_store(self, store, 
             chunks: Optional[Dict[str,tuple]]=dict(),
@@ -0,0 +1,165 @@
+"""
+Robot and camera backends for deploy.py.
+
+GR1DexEnvInference talks to the robot only through this interface, so the
+deploy loop can also run without hardware:
+
+    gr1:    the real robot, zenoh communication, arm retargeting and realsense cameras
+    replay: observations of a recorded zarr episode, actions are swallowed
+"""
+from typing import Dict, Optional
+import sys
+import time
+import numpy as np
+from termcolor import cprint
+from diffusion_policy_3d.common.replay_buffer import ReplayBuffer
+import diffusion_policy_3d.model.vision_3d.point_process as point_process
+
+
+class RobotBackend:
+    def camera(self) -> Dict[str, np.ndarray]:
+        """Next camera frame, same keys as MultiRealSense: color, depth, point_cloud."""
+        raise NotImplementedError()
+
+    def get_qpos(self) -> np.ndarray:
+        """Current joint positions: upper body followed by the 12 hand joints."""
+        raise NotImplementedError()
+
+    def set_upbody_pos(self, pos: np.ndarray, init=False):
+        raise NotImplementedError()
+
+    def send_hand_cmd(self, right_pos: np.ndarray, left_pos: np.ndarray):
+        raise NotImplementedError()
+
+    def ik(self, q_14d, arm_pos, arm_rot_quat):
+        raise NotImplementedError()
+
+    def wait(self, seconds):
+        time.sleep(seconds)
+
+    def close(self):
+        pass
+
+
+class GR1Backend(RobotBackend):
+    """
+    The real robot. The zenoh teleop modules only exist on the robot PC and are
+    imported on construction.
+    """
+    def __init__(self, num_points=4096, img_size=224,
+            zenoh_path="/home/gr1p24ap0049/projects/gr1-dex-real/teleop-zenoh"):
+        if zenoh_path not in sys.path:
+            sys.path.append(zenoh_path)
+        from communication import UpperBodyCommunication, HandCommunication
+        from retarget import ArmRetarget
+        from diffusion_policy_3d.common.multi_realsense import MultiRealSense
+
+        self.cam = MultiRealSense(use_front_cam=True, # by default we use single cam. but we also support multi-cam
+                            front_num_points=num_points,
+                            img_size=img_size)
+        self.upbody_comm = UpperBodyCommunication()
+        self.hand_comm = HandCommunication()
+        self.arm_solver = ArmRetarget("AVP")
+
+    def camera(self):
+        return self.cam()
+
+    def get_qpos(self):
+        try:
+            hand_qpos = self.hand_comm.get_qpos()
+        except:
+            cprint("fail to fetch hand qpos. use default.", "red")
+            hand_qpos = np.ones(12)
+        return np.concatenate([self.upbody_comm.get_pos(), hand_qpos])
+
+    def set_upbody_pos(self, pos, init=False):
+        if init:
+            self.upbody_comm.init_set_pos(pos)
+        else:
+            self.upbody_comm.set_pos(pos)
+
+    def send_hand_cmd(self, right_pos, left_pos):
+        self.hand_comm.send_hand_cmd(right_pos, left_pos)
+
+    def ik(self, q_14d, arm_pos, arm_rot_quat):
+        return self.arm_solver.ik(q_14d, arm_pos, arm_rot_quat)
+
+    def close(self):
+        self.cam.finalize()
+
+
+class ReplayBackend(RobotBackend):
+    """
+    Serves the frames of one episode of a replay buffer zarr, one per camera()
+    call, and holds the last frame once the episode is over. Commands are
+    recorded in `self.commands` but go nowhere.
+
+    fps: pace camera() like a real camera, None serves frames as fast as possible
+    """
+    def __init__(self, zarr_path, episode=0, num_points=4096, img_size=224, fps=None):
+        keys = ['state', 'action', 'point_cloud', 'image', 'depth']
+        # only the replayed episode is read from disk
+        replay_buffer = ReplayBuffer.create_from_path(zarr_path, mode='r')
+        episode_slice = replay_buffer.get_episode_slice(episode)
+        self.data = {key: replay_buffer[key][episode_slice] for key in keys if key in replay_buffer}
+        assert 'state' in self.data, f'{zarr_path} has no state array'
+        self.n_frames = len(self.data['state'])
+        self.num_points = num_points
+        self.img_size = img_size
+        self.period = None if fps is None else 1.0 / fps
+        self.index = -1
+        self.last_frame_time = None
+        self.commands = list()
+        cprint(f"Replaying episode {episode} of {zarr_path} ({self.n_frames} frames)", "yellow")
+
+    @property
+    def done(self):
+        return self.index >= self.n_frames - 1
+
+    def camera(self):
+        if self.period is not None and self.last_frame_time is not None:
+            delay = self.last_frame_time + self.period - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        self.last_frame_time = time.monotonic()
+        self.index = min(self.index + 1, self.n_frames - 1)
+
+        cam_dict = dict()
+        if 'point_cloud' in self.data:
+            cam_dict['point_cloud'] = point_process.uniform_sampling_numpy(
+                self.data['point_cloud'][self.index][None].astype(np.float32), self.num_points)[0]
+        else:
+            cam_dict['point_cloud'] = np.zeros((self.num_points, 6), dtype=np.float32)
+        if 'image' in self.data:
+            cam_dict['color'] = self.data['image'][self.index]
+        else:
+            cam_dict['color'] = np.zeros((self.img_size, self.img_size, 3), dtype=np.uint8)
+        if 'depth' in self.data:
+            cam_dict['depth'] = self.data['depth'][self.index]
+        else:
+            cam_dict['depth'] = np.zeros((self.img_size, self.img_size), dtype=np.float32)
+        cam_dict['timestamp'] = time.time()
+        return cam_dict
+
+    def get_qpos(self):
+        return self.data['state'][max(self.index, 0)].astype(np.float64)
+
+    def set_upbody_pos(self, pos, init=False):
+        self.commands.append(('upbody', np.array(pos)))
+
+    def send_hand_cmd(self, right_pos, left_pos):
+        self.commands.append(('hand', np.concatenate([left_pos, right_pos])))
+
+    def ik(self, q_14d, arm_pos, arm_rot_quat):
+        return q_14d
+
+    def wait(self, seconds):
+        pass
+
+
+def make_backend(name, num_points=4096, img_size=224, **kwargs) -> RobotBackend:
+    if name == 'gr1':
+        return GR1Backend(num_points=num_points, img_size=img_size, **kwargs)
+    if name == 'replay':
+        return ReplayBackend(num_points=num_points, img_size=img_size, **kwargs)
+    raise ValueError(f"Unknown robot backend {name}")
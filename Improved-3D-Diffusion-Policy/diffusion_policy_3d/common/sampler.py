@@ -74,6 +74,14 @@ def downsample_mask(mask, max_n, seed=0):
         assert np.sum(train_mask) == n_train
     return train_mask
 
+def _gather_frames(input_arr, frame_idxs):
+    if isinstance(input_arr, np.ndarray):
+        return np.take(input_arr, frame_idxs, axis=0)
+    # zarr: read each needed chunk once, then expand duplicates
+    unique_idxs, inverse = np.unique(frame_idxs, return_inverse=True)
+    return input_arr.get_orthogonal_selection(
+        (unique_idxs,) + (slice(None),) * (input_arr.ndim - 1))[inverse]
+
 class SequenceSampler:
     def __init__(self, 
         replay_buffer: ReplayBuffer, 
@@ -117,6 +125,42 @@ class SequenceSampler:
     
     def __len__(self):
         return len(self.indices)
+
+    def sequence_frame_indices(self, idx):
+        """
+        Buffer frame index for every step of sequence idx (or a batch of sequences),
+        padded by repeating the first/last frame the same way sample_sequence does.
+        Also used to read per-frame data that lives outside the replay buffer.
+        """
+        indices = self.indices[idx]
+        buffer_start_idx, buffer_end_idx, sample_start_idx = \
+            indices[...,0,None], indices[...,1,None], indices[...,2,None]
+        frame_idxs = np.arange(self.sequence_length) - sample_start_idx + buffer_start_idx
+        return np.clip(frame_idxs, buffer_start_idx, buffer_end_idx - 1)
+
+    def sample_batch(self, idxs):
+        """
+        Vectorized sample_sequence for a batch of sequence indices,
+        every key is gathered with a single fancy index. Returns key: (B, T, ...)
+        """
+        idxs = np.asarray(idxs, dtype=np.int64)
+        # (B, T) clamp indices implement pad_before/pad_after
+        frame_idxs = self.sequence_frame_indices(idxs)
+        flat_idxs = frame_idxs.reshape(-1)
+        result = dict()
+        for key in self.keys:
+            input_arr = self.replay_buffer[key]
+            out_shape = frame_idxs.shape + input_arr.shape[1:]
+            if key not in self.key_first_k:
+                data = _gather_frames(input_arr, flat_idxs).reshape(out_shape)
+            else:
+                # only load the first k frames of each buffer range, rest stays Nan
+                buffer_start_idx = self.indices[idxs,0]
+                loaded = (frame_idxs - buffer_start_idx[:,None]) < self.key_first_k[key]
+                data = np.full(out_shape, fill_value=np.nan, dtype=input_arr.dtype)
+                data[loaded] = _gather_frames(input_arr, frame_idxs[loaded])
+            result[key] = data
+        return result
         
     def sample_sequence(self, idx):
         buffer_start_idx, buffer_end_idx, sample_start_idx, sample_end_idx \
@@ -0,0 +1,178 @@
+"""
+Latest-frame ring buffer in shared memory, one writer process and any number
+of readers.
+
+Every slot holds one frame (a fixed dict of arrays) plus its capture timestamp
+and is guarded by a seqlock counter: the writer makes the counter odd, writes
+the slot, then makes it even again. A reader copies the slot and retries if the
+counter was odd or changed meanwhile, so neither side ever blocks the other and
+nothing is pickled.
+
+Layout of the shared block:
+    header  int64[2]               frame count (total frames written), n_slots
+    seq     int64[n_slots]         seqlock counter of each slot
+    frame   int64[n_slots]         frame index stored in each slot
+    stamp   float64[n_slots]       capture timestamp of each slot
+    <key>   dtype[n_slots, *shape] one array per field
+"""
+from typing import Dict, Optional, Tuple
+import time
+import numpy as np
+from multiprocessing import shared_memory
+
+
+def _aligned(offset, alignment=64):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+class SharedFrameRing:
+    def __init__(self,
+            spec: Dict[str, Tuple[tuple, np.dtype]],
+            n_slots=4,
+            name: Optional[str]=None,
+            create=True):
+        """
+        spec: field name -> (shape, dtype) of a single frame
+        create: allocate a new block, otherwise attach to the block `name`
+        """
+        assert n_slots >= 2
+        self.spec = {key: (tuple(shape), np.dtype(dtype)) for key, (shape, dtype) in spec.items()}
+        self.n_slots = n_slots
+
+        offsets = dict()
+        offset = 0
+        for key, nbytes in [('header', 2 * 8), ('seq', n_slots * 8),
+                ('frame', n_slots * 8), ('stamp', n_slots * 8)] \
+                + [(key, n_slots * int(np.prod(shape)) * dtype.itemsize)
+                    for key, (shape, dtype) in self.spec.items()]:
+            offsets[key] = offset
+            offset = _aligned(offset + nbytes)
+        size = max(offset, 1)
+
+        if create:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.owner = create
+        buf = self.shm.buf
+        self.header = np.ndarray((2,), dtype=np.int64, buffer=buf, offset=offsets['header'])
+        self.seq = np.ndarray((n_slots,), dtype=np.int64, buffer=buf, offset=offsets['seq'])
+        self.frame = np.ndarray((n_slots,), dtype=np.int64, buffer=buf, offset=offsets['frame'])
+        self.stamp = np.ndarray((n_slots,), dtype=np.float64, buffer=buf, offset=offsets['stamp'])
+        self.arrays = {
+            key: np.ndarray((n_slots,) + shape, dtype=dtype, buffer=buf, offset=offsets[key])
+            for key, (shape, dtype) in self.spec.items()}
+        if create:
+            self.header[:] = (0, n_slots)
+            self.seq[:] = 0
+            self.frame[:] = -1
+            self.stamp[:] = np.nan
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def count(self):
+        """Total number of frames written so far."""
+        return int(self.header[0])
+
+    # ========= writer ============
+    def write(self, data: Dict[str, np.ndarray], timestamp=None):
+        """
+        Copy one frame into the next slot. Missing fields are left untouched.
+        """
+        if timestamp is None:
+            timestamp = time.time()
+        count = int(self.header[0])
+        slot = count % self.n_slots
+        self.seq[slot] += 1 # odd: slot is being written
+        for key, value in data.items():
+            if value is not None and key in self.arrays:
+                self.arrays[key][slot] = value
+        self.frame[slot] = count
+        self.stamp[slot] = timestamp
+        self.seq[slot] += 1 # even: slot is consistent
+        self.header[0] = count + 1
+        return count
+
+    # ========= reader ============
+    def read_slot(self, slot, frame=None, max_retries=20, backoff=0.0001):
+        """
+        Consistent copy of a slot: (frame index, timestamp, data),
+        frame index is -1 for a slot that was never written.
+        frame: expected frame index, None once the slot holds another frame
+        Returns None if the slot is still being written after max_retries
+        (sleeping between retries, starting at backoff seconds and doubling).
+        """
+        for i in range(max_retries):
+            seq = int(self.seq[slot])
+            if not seq & 1:
+                slot_frame = int(self.frame[slot])
+                if frame is not None and slot_frame != frame:
+                    # overwritten by a newer frame
+                    return None
+                stamp = float(self.stamp[slot])
+                data = {key: arr[slot].copy() for key, arr in self.arrays.items()}
+                if int(self.seq[slot]) == seq:
+                    return slot_frame, stamp, data
+            # a frame write takes far longer than a spin, back off
+            time.sleep(min(backoff * 2 ** i, 0.002))
+        return None
+
+    def read_latest(self, newer_than=-1, timeout=None, poll_interval=0.0005):
+        """
+        Freshest frame: (frame index, timestamp, data).
+        Waits until a frame with index > newer_than exists, returns None on timeout.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            count = int(self.header[0])
+            if count - 1 > newer_than:
+                result = self.read_slot((count - 1) % self.n_slots)
+                # the slot may have been overwritten by a newer frame meanwhile, that's fine
+                if result is not None and result[0] > newer_than:
+                    return result
+            if deadline is not None and time.monotonic() > deadline:
+                return None
+            time.sleep(poll_interval)
+
+    def read_history(self, newer_than=-1):
+        """
+        All frames still in the ring with index > newer_than, oldest first.
+        """
+        count = int(self.header[0])
+        # slot (count - n_slots) % n_slots is the one the writer fills next
+        first = max(newer_than + 1, count - self.n_slots + 1)
+        frames = list()
+        for i in range(first, count):
+            result = self.read_slot(i % self.n_slots, frame=i)
+            # skip slots overwritten (or being overwritten) by the writer meanwhile
+            if result is not None:
+                frames.append(result)
+        return frames
+
+    # ========= lifecycle ============
+    def __getstate__(self):
+        # attach by name when sent to a spawned process
+        return {'spec': self.spec, 'n_slots': self.n_slots, 'name': self.name}
+
+    def __setstate__(self, state):
+        self.__init__(state['spec'], n_slots=state['n_slots'], name=state['name'], create=False)
+
+    def close(self):
+        if self.shm is None:
+            return
+        # numpy views must be released before the mapping can be closed
+        self.header = self.seq = self.frame = self.stamp = None
+        self.arrays = dict()
+        try:
+            self.shm.close()
+            if self.owner:
+                self.shm.unlink()
+        except (FileNotFoundError, BufferError):
+            pass
+        self.shm = None
+
+    def __del__(self):
+        self.close()
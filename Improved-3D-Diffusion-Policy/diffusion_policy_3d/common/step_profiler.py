@@ -0,0 +1,206 @@
+"""
+Per-phase timing of the training step.
+
+Host timestamps (time.time()) around asynchronous cuda work measure kernel
+launches, not the work itself, and miss the time spent waiting for the
+dataloader. StepProfiler instead records a cuda event at the end of every phase
+of a step and reads them back in one synchronization per report window:
+
+    data_wait   host time blocked on the dataloader for the next batch
+    gpu_idle    gpu time with nothing queued between the end of the previous
+                step and the start of this one (the gpu side of data_wait)
+    h2d, forward, backward, optimizer, ema, logging, ...
+                gpu time between consecutive mark() calls
+
+plus samples/sec of this process and the fraction of the window the gpu was
+idle. On cpu the phases fall back to host timestamps.
+
+Optionally a torch.profiler trace of a few steps is written for tensorboard
+(trace_steps > 0).
+"""
+from typing import Dict, Optional
+import os
+import time
+import torch
+from termcolor import cprint
+
+
+class StepProfiler:
+    def __init__(self, device='cuda',
+            enabled=True,
+            report_every=100,
+            trace_steps=0,
+            trace_skip_steps=10,
+            trace_warmup_steps=2,
+            trace_dir=None,
+            rank=0):
+        """
+        report_every: steps per report window, each report synchronizes once
+        trace_steps: steps recorded with torch.profiler, 0 disables tracing
+        trace_skip_steps: steps run before the trace window (compilation, cudnn autotuning)
+        trace_dir: tensorboard trace output, one file per rank
+        """
+        self.device = torch.device(device)
+        self.enabled = enabled
+        self.report_every = report_every
+        self.use_events = self.device.type == 'cuda'
+
+        self._steps = list()
+        self._current = None
+        self._prev_end = None
+        self._last_end_time = None
+        self._window_start = None
+        self._excluded = 0.0
+        self.n_steps = 0
+
+        self.trace = None
+        if enabled and trace_steps > 0:
+            assert trace_dir is not None, "trace_dir is required for tracing"
+            os.makedirs(trace_dir, exist_ok=True)
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.use_events:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.trace = torch.profiler.profile(
+                activities=activities,
+                schedule=torch.profiler.schedule(skip_first=trace_skip_steps,
+                    wait=0, warmup=trace_warmup_steps, active=trace_steps, repeat=1),
+                on_trace_ready=torch.profiler.tensorboard_trace_handler(
+                    str(trace_dir), worker_name=f'rank{rank}'),
+                record_shapes=True,
+                with_stack=False)
+            self.trace.start()
+            self._trace_end = trace_skip_steps + trace_warmup_steps + trace_steps
+            cprint(f"[StepProfiler] tracing steps {trace_skip_steps + trace_warmup_steps}"
+                f"-{self._trace_end - 1} to {trace_dir}", "yellow")
+
+    def _timestamp(self):
+        if self.use_events:
+            event = torch.cuda.Event(enable_timing=True)
+            event.record()
+            return event
+        return time.perf_counter()
+
+    @staticmethod
+    def _elapsed(start, end):
+        """Seconds between two timestamps of _timestamp()."""
+        if isinstance(start, float):
+            return end - start
+        return start.elapsed_time(end) / 1000.0
+
+    def epoch_begin(self):
+        """
+        Time spent outside the training loop (evaluation, checkpointing) is
+        neither data wait nor gpu idle time of the next step.
+        """
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if len(self._steps) > 0:
+            self._excluded += now - self._last_end_time
+        else:
+            self._window_start = now
+        self._prev_end = None
+        self._last_end_time = now
+
+    def step_begin(self, batch_size: int):
+        """Called as soon as the batch is returned by the dataloader."""
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if self._last_end_time is None:
+            self._last_end_time = now
+        if self._window_start is None:
+            self._window_start = now
+        self._current = {
+            'batch_size': batch_size,
+            'data_wait': now - self._last_end_time,
+            'prev_end': self._prev_end,
+            'marks': [('start', self._timestamp())],
+        }
+
+    def mark(self, phase: str):
+        """End of `phase`, it started at the previous mark (or step_begin)."""
+        if self._current is None:
+            return
+        self._current['marks'].append((phase, self._timestamp()))
+
+    def step_end(self) -> Optional[Dict[str, float]]:
+        """
+        Last call of a step. Returns the report of the window every report_every
+        steps, None otherwise.
+        """
+        if self._current is None:
+            return None
+        self._steps.append(self._current)
+        self._prev_end = self._current['marks'][-1][1]
+        self._current = None
+        self.n_steps += 1
+        if self.trace is not None:
+            self.trace.step()
+            if self.n_steps >= self._trace_end:
+                self.trace.stop()
+                self.trace = None
+        result = None
+        if len(self._steps) >= self.report_every:
+            result = self.report()
+        # taken after the report, its synchronization is not data wait of the next step
+        self._last_end_time = time.perf_counter()
+        return result
+
+    def report(self) -> Optional[Dict[str, float]]:
+        """
+        Mean times of the steps since the last report, synchronizes once.
+        Called outside step_end (e.g. at the end of an epoch) it has to follow
+        the last step directly, the wall time of the window ends here.
+        """
+        if len(self._steps) == 0:
+            return None
+        if self.use_events:
+            self._steps[-1]['marks'][-1][1].synchronize()
+        wall = time.perf_counter() - self._window_start - self._excluded
+
+        n = len(self._steps)
+        totals = dict()
+        data_wait = 0.0
+        gpu_idle = 0.0
+        gpu_busy = 0.0
+        n_samples = 0
+        for step in self._steps:
+            marks = step['marks']
+            for (_, start), (phase, end) in zip(marks[:-1], marks[1:]):
+                totals[phase] = totals.get(phase, 0.0) + self._elapsed(start, end)
+            gpu_busy += self._elapsed(marks[0][1], marks[-1][1])
+            if step['prev_end'] is not None:
+                gpu_idle += self._elapsed(step['prev_end'], marks[0][1])
+            data_wait += step['data_wait']
+            n_samples += step['batch_size']
+
+        result = {f'profile/{phase}_time': total / n for phase, total in totals.items()}
+        result['profile/data_wait_time'] = data_wait / n
+        result['profile/step_time'] = wall / n
+        result['profile/samples_per_sec'] = n_samples / max(wall, 1e-9)
+        if self.use_events:
+            result['profile/gpu_idle_frac'] = gpu_idle / max(gpu_idle + gpu_busy, 1e-9)
+
+        self._steps = list()
+        self._window_start = time.perf_counter()
+        self._excluded = 0.0
+        return result
+
+    def close(self):
+        if self.trace is not None:
+            self.trace.stop()
+            self.trace = None
+
+    @staticmethod
+    def format(report: Dict[str, float]) -> str:
+        items = list()
+        for key, value in report.items():
+            name = key.split('/')[-1]
+            if name.endswith('_time'):
+                items.append(f"{name[:-len('_time')]} {value * 1000:.1f}ms")
+            elif name == 'gpu_idle_frac':
+                items.append(f"gpu idle {value * 100:.1f}%")
+            else:
+                items.append(f"{name} {value:.1f}")
+        return ', '.join(items)
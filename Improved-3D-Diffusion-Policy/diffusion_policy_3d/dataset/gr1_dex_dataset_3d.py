@@ -7,6 +7,7 @@ from diffusion_policy_3d.common.replay_buffer import ReplayBuffer
 from diffusion_policy_3d.common.sampler import (SequenceSampler, get_val_mask, downsample_mask)
 from diffusion_policy_3d.model.common.normalizer import LinearNormalizer, SingleFieldLinearNormalizer, StringNormalizer
 from diffusion_policy_3d.dataset.base_dataset import BaseDataset
+from diffusion_policy_3d.dataset.point_cloud_cache import open_point_cloud_cache
 import diffusion_policy_3d.model.vision_3d.point_process as point_process
 from termcolor import cprint
 
@@ -22,12 +23,20 @@ class GR1DexDataset3D(BaseDataset):
             task_name=None,
             num_points=4096,
             use_wrist=False,
+            point_cloud_cache_path=None,
+            num_point_variants=4,
+            point_cloud_cache_dtype='float32',
+            point_cloud_cache_voxel_size=None,
+            replay_buffer_backend=None,
+            subsample_points=True,
             ):
         super().__init__()
         cprint(f'Loading GR1DexDataset from {zarr_path}', 'green')
         self.task_name = task_name
 
         self.num_points = num_points
+        # False ships full clouds, subsampling then happens on the gpu (see PointCloudPreprocessor)
+        self.subsample_points = subsample_points
 
         print(f"use wrist {use_wrist}")
 
@@ -41,9 +50,26 @@ class GR1DexDataset3D(BaseDataset):
         if use_wrist:
             buffer_keys.append('wrist_point_cloud')
 
-            
+
+        # pre-subsampled point clouds are read memory-mapped from a sidecar cache
+        # instead of being loaded at full resolution into the replay buffer
+        self.point_cloud_cache = None
+        if point_cloud_cache_path is not None:
+            cloud_keys = [key for key in buffer_keys if key.endswith('point_cloud')]
+            self.point_cloud_cache = open_point_cloud_cache(
+                zarr_path, point_cloud_cache_path, num_points,
+                keys=cloud_keys, num_variants=num_point_variants,
+                dtype=point_cloud_cache_dtype, seed=seed,
+                voxel_size=point_cloud_cache_voxel_size)
+            buffer_keys = [key for key in buffer_keys if key not in cloud_keys]
+            cprint(f'Using point cloud cache {point_cloud_cache_path} '
+                f'with {self.point_cloud_cache.num_variants} variants', 'green')
+
         self.replay_buffer = ReplayBuffer.copy_from_path(
-            zarr_path, keys=buffer_keys)
+            zarr_path, keys=buffer_keys, backend=replay_buffer_backend)
+        if self.point_cloud_cache is not None:
+            assert self.point_cloud_cache.n_frames == self.replay_buffer.n_steps, \
+                'point cloud cache is out of date with the replay buffer, delete it to rebuild'
         
         val_mask = get_val_mask(
             n_episodes=self.replay_buffer.n_episodes, 
@@ -92,6 +118,21 @@ class GR1DexDataset3D(BaseDataset):
     def __len__(self) -> int:
         return len(self.sampler)
 
+    def _sample_cached_point_clouds(self, idx, sample):
+        # one random subsampling variant per sample, shared by all its frames
+        frame_idxs = self.sampler.sequence_frame_indices(idx)
+        variant = np.random.randint(self.point_cloud_cache.num_variants,
+            size=frame_idxs.shape[:-1] + (1,))
+        for key in self.point_cloud_cache.arrays.keys():
+            sample[key] = self.point_cloud_cache[key][frame_idxs, variant]
+        return sample
+
+    def _uniform_sampling(self, point_cloud):
+        if point_cloud.ndim == 4:
+            # batched (B, T, N, C)
+            return point_process.uniform_sampling_numpy_batch(point_cloud, self.num_points)
+        return point_process.uniform_sampling_numpy(point_cloud, self.num_points)
+
     def _sample_to_data(self, sample):
         agent_pos = sample['state'][:,].astype(np.float32)
         point_cloud = sample['point_cloud'][:,].astype(np.float32)
@@ -99,9 +140,11 @@ class GR1DexDataset3D(BaseDataset):
         wrist_point_cloud = None
         if self.use_wrist:
             wrist_point_cloud = sample['wrist_point_cloud'][:,].astype(np.float32)
-            wrist_point_cloud = point_process.uniform_sampling_numpy(wrist_point_cloud, self.num_points)
+            if self.point_cloud_cache is None and self.subsample_points:
+                wrist_point_cloud = self._uniform_sampling(wrist_point_cloud)
         
-        point_cloud = point_process.uniform_sampling_numpy(point_cloud, self.num_points)
+        if self.point_cloud_cache is None and self.subsample_points:
+            point_cloud = self._uniform_sampling(point_cloud)
         
         data = {
             'obs': {
@@ -116,9 +159,19 @@ class GR1DexDataset3D(BaseDataset):
         return data
     
     def __getitem__(self, idx: int) -> Dict[str, torch.Tensor]:
-        sample = self.sampler.sample_sequence(idx)
+        """
+        idx can also be a list of indices (from a BatchSampler),
+        a whole batch is then gathered at once, see SequenceSampler.sample_batch.
+        """
+        if np.ndim(idx) > 0:
+            sample = self.sampler.sample_batch(idx)
+        else:
+            sample = self.sampler.sample_sequence(idx)
+        if self.point_cloud_cache is not None:
+            sample = self._sample_cached_point_clouds(idx, sample)
         data = self._sample_to_data(sample)
-        to_torch_function = lambda x: torch.from_numpy(x) if x.__class__.__name__ == 'ndarray' else x
+        # isinstance also catches np.memmap results of the memmap backend
+        to_torch_function = lambda x: torch.from_numpy(np.asarray(x)) if isinstance(x, np.ndarray) else x
         torch_data = dict_apply(data, to_torch_function)
         return torch_data
 
@@ -24,6 +24,7 @@ class GR1DexDatasetImage(BaseDataset):
             use_img=True,
             use_wrist=False,
             use_depth=False,
+            replay_buffer_backend=None,
             ):
         super().__init__()
         cprint(f'Loading GR1DexDataset from {zarr_path}', 'green')
@@ -47,7 +48,7 @@ class GR1DexDatasetImage(BaseDataset):
 
         print(f"buffer keys {buffer_keys}")
         self.replay_buffer = ReplayBuffer.copy_from_path(
-            zarr_path, keys=buffer_keys)
+            zarr_path, keys=buffer_keys, backend=replay_buffer_backend)
         
         val_mask = get_val_mask(
             n_episodes=self.replay_buffer.n_episodes, 
@@ -125,9 +126,17 @@ class GR1DexDatasetImage(BaseDataset):
         return data
     
     def __getitem__(self, idx: int) -> Dict[str, torch.Tensor]:
-        sample = self.sampler.sample_sequence(idx)
+        """
+        idx can also be a list of indices (from a BatchSampler),
+        a whole batch is then gathered at once, see SequenceSampler.sample_batch.
+        """
+        if np.ndim(idx) > 0:
+            sample = self.sampler.sample_batch(idx)
+        else:
+            sample = self.sampler.sample_sequence(idx)
         data = self._sample_to_data(sample)
-        to_torch_function = lambda x: torch.from_numpy(x) if x.__class__.__name__ == 'ndarray' else x
+        # isinstance also catches np.memmap results of the memmap backend
+        to_torch_function = lambda x: torch.from_numpy(np.asarray(x)) if isinstance(x, np.ndarray) else x
         torch_data = dict_apply(data, to_torch_function)
         return torch_data
 
@@ -0,0 +1,219 @@
+"""
+Sidecar cache of pre-subsampled point clouds.
+
+For every frame of a replay buffer zarr the cache stores K random subsamples
+at `num_points` (optionally of the voxel-downsampled frame), as an uncompressed
+zarr group:
+
+    <cache_path>/<key>   (T, K, num_points, C) float32/float16
+
+Each array is a single uncompressed chunk, so the chunk file is the raw C-order
+array and can be memory-mapped directly instead of being loaded into RAM.
+
+The build parameters and a fingerprint of the source arrays (shape, dtype and
+newest file mtime) are kept in the group attrs, open_point_cloud_cache rebuilds
+the cache when any of them changed.
+"""
+import os
+import shutil
+import numpy as np
+import zarr
+from termcolor import cprint
+import diffusion_policy_3d.model.vision_3d.point_process as point_process
+from diffusion_policy_3d.common.replay_buffer import get_newest_mtime
+
+
+CACHE_VERSION = 1
+
+
+def _chunk_file(cache_path, key, ndim):
+    # zarr v2 key of the one and only chunk of an array
+    return os.path.join(cache_path, key, '.'.join(['0'] * ndim))
+
+
+def _source_fingerprint(zarr_path, keys):
+    """Shape, dtype and newest file mtime of every source array, json serializable."""
+    zarr_path = os.path.expanduser(zarr_path)
+    src = zarr.open(zarr_path, 'r')
+    fingerprint = dict()
+    for name in ['meta/episode_ends'] + [f'data/{key}' for key in keys]:
+        arr = src[name]
+        path = os.path.join(zarr_path, name)
+        fingerprint[name] = {
+            'shape': list(arr.shape),
+            'dtype': str(arr.dtype),
+            # None for stores that are not a directory (e.g. zip)
+            'mtime': get_newest_mtime(path) if os.path.exists(path) else None,
+        }
+    return fingerprint
+
+
+def _build_params(num_points, keys, num_variants, dtype, seed, voxel_size):
+    return {
+        'num_points': int(num_points),
+        'num_variants': int(num_variants),
+        'dtype': str(np.dtype(dtype)),
+        'seed': int(seed),
+        'voxel_size': voxel_size,
+        'keys': list(keys),
+    }
+
+
+def _subsample_variants(points, num_points, num_variants, rng):
+    """
+    points: (F, N, C) -> (F, K, num_points, C), every frame and variant
+    gets its own random subset.
+    """
+    F, N, C = points.shape
+    if N <= num_points:
+        # pad with zeros and shuffle, like uniform_sampling_numpy but with the seeded rng
+        padded = np.zeros((F, 1, num_points, C), dtype=points.dtype)
+        padded[:, 0, :N] = points
+        idx = np.argsort(rng.random((F, num_variants, num_points)), axis=-1)
+        return np.take_along_axis(padded, idx[..., None], axis=2)
+    # argpartition of uniform noise gives a random subset per (frame, variant)
+    idx = np.argpartition(rng.random((F, num_variants, N)), num_points - 1, axis=-1)[..., :num_points]
+    return np.take_along_axis(points[:, None], idx[..., None], axis=2)
+
+
+def build_point_cloud_cache(zarr_path, cache_path, num_points,
+        keys=('point_cloud',), num_variants=4, dtype='float32',
+        seed=0, chunk_frames=256, voxel_size=None):
+    """
+    Write the sidecar cache for `keys` of the replay buffer at `zarr_path`.
+    With voxel_size, every frame is voxel-downsampled before subsampling.
+    The source is read chunk by chunk, the cache is written to a temporary
+    directory and renamed into place once complete.
+    """
+    dtype = np.dtype(dtype)
+    assert dtype in (np.dtype(np.float32), np.dtype(np.float16))
+    src = zarr.open(os.path.expanduser(zarr_path), 'r')
+    n_frames = int(src['meta']['episode_ends'][-1]) if len(src['meta']['episode_ends']) > 0 else 0
+    if n_frames == 0:
+        raise ValueError(f'{zarr_path} has no episodes, there is nothing to cache')
+    cache_path = os.path.expanduser(cache_path)
+    tmp_path = cache_path + '.tmp'
+    if os.path.exists(tmp_path):
+        shutil.rmtree(tmp_path)
+
+    # taken before reading, a source modified while building makes the cache stale
+    fingerprint = _source_fingerprint(zarr_path, keys)
+    rng = np.random.default_rng(seed=seed)
+    voxel_grid = None if voxel_size is None else point_process.VoxelGrid(voxel_size)
+    root = zarr.open_group(tmp_path, mode='w')
+    for key in keys:
+        src_arr = src['data'][key]
+        n_channels = src_arr.shape[-1]
+        shape = (n_frames, num_variants, num_points, n_channels)
+        # one uncompressed chunk: the chunk file is a plain memmap-able array
+        root.create_dataset(key, shape=shape, chunks=shape, dtype=dtype,
+            compressor=None, fill_value=None)
+        out = np.memmap(_chunk_file(tmp_path, key, len(shape)),
+            dtype=dtype, mode='w+', shape=shape)
+        for start in range(0, n_frames, chunk_frames):
+            end = min(start + chunk_frames, n_frames)
+            points = src_arr[start:end].astype(np.float32)
+            if voxel_grid is None:
+                out[start:end] = _subsample_variants(points, num_points, num_variants, rng)
+            else:
+                # voxelized frames differ in size, subsample them one by one
+                for i, frame in enumerate(points):
+                    out[start + i] = _subsample_variants(
+                        voxel_grid(frame)[None], num_points, num_variants, rng)[0]
+        out.flush()
+        del out
+        cprint(f'[PointCloudCache] {key}: {shape} {dtype}', 'green')
+
+    root.attrs.update({
+        'version': CACHE_VERSION,
+        'source': os.path.abspath(os.path.expanduser(zarr_path)),
+        'source_fingerprint': fingerprint,
+        'n_frames': n_frames,
+        **_build_params(num_points, keys, num_variants, dtype, seed, voxel_size),
+    })
+    if os.path.exists(cache_path):
+        shutil.rmtree(cache_path)
+    os.rename(tmp_path, cache_path)
+    return cache_path
+
+
+class PointCloudCache:
+    """
+    Read side of the sidecar, arrays are memory-mapped read-only.
+    """
+    def __init__(self, cache_path):
+        cache_path = os.path.expanduser(cache_path)
+        root = zarr.open_group(cache_path, mode='r')
+        self.attrs = dict(root.attrs)
+        self.arrays = dict()
+        for key in self.attrs['keys']:
+            arr = root[key]
+            assert arr.compressor is None and arr.chunks == arr.shape
+            self.arrays[key] = np.memmap(_chunk_file(cache_path, key, arr.ndim),
+                dtype=arr.dtype, mode='r', shape=arr.shape)
+
+    @property
+    def num_points(self):
+        return self.attrs['num_points']
+
+    @property
+    def num_variants(self):
+        return self.attrs['num_variants']
+
+    @property
+    def voxel_size(self):
+        return self.attrs.get('voxel_size', None)
+
+    @property
+    def n_frames(self):
+        return self.attrs['n_frames']
+
+    def __contains__(self, key):
+        return key in self.arrays
+
+    def __getitem__(self, key):
+        return self.arrays[key]
+
+
+def open_point_cloud_cache(zarr_path, cache_path, num_points,
+        keys=('point_cloud',), num_variants=4, dtype='float32', seed=0, voxel_size=None):
+    """
+    Open the cache, building it first if it does not exist yet, or if it was
+    built with other parameters or from a source that changed since.
+    """
+    reason = None
+    if not os.path.exists(os.path.join(os.path.expanduser(cache_path), '.zgroup')):
+        reason = 'it does not exist'
+    else:
+        attrs = PointCloudCache(cache_path).attrs
+        params = _build_params(num_points, keys, num_variants, dtype, seed, voxel_size)
+        changed = [key for key, value in params.items() if attrs.get(key) != value]
+        if attrs.get('version') != CACHE_VERSION:
+            reason = f"cache version {attrs.get('version')} != {CACHE_VERSION}"
+        elif len(changed) > 0:
+            reason = ', '.join(f'{key} changed ({attrs.get(key)} -> {params[key]})' for key in changed)
+        elif attrs.get('source_fingerprint') != _source_fingerprint(zarr_path, keys):
+            reason = f'{zarr_path} changed since it was built'
+    if reason is not None:
+        cprint(f'Building point cloud cache {cache_path} from {zarr_path}, {reason}', 'yellow')
+        build_point_cloud_cache(zarr_path, cache_path, num_points,
+            keys=keys, num_variants=num_variants, dtype=dtype, seed=seed,
+            voxel_size=voxel_size)
+    return PointCloudCache(cache_path)
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Build a pre-subsampled point cloud cache for a replay buffer zarr.')
+    parser.add_argument('zarr_path')
+    parser.add_argument('cache_path')
+    parser.add_argument('--num_points', type=int, default=4096)
+    parser.add_argument('--num_variants', type=int, default=4)
+    parser.add_argument('--keys', nargs='+', default=['point_cloud'])
+    parser.add_argument('--dtype', default='float32', choices=['float32', 'float16'])
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--voxel_size', type=float, default=None)
+    args = parser.parse_args()
+    build_point_cloud_cache(args.zarr_path, args.cache_path, args.num_points,
+        keys=args.keys, num_variants=args.num_variants, dtype=args.dtype, seed=args.seed,
+        voxel_size=args.voxel_size)
@@ -1,4 +1,5 @@
 import copy
+import itertools
 import torch
 from torch.nn.modules.batchnorm import _BatchNorm
 
@@ -14,7 +15,9 @@ class EMAModel:
         inv_gamma=1.0,
         power=2 / 3,
         min_value=0.0,
-        max_value=0.9999
+        max_value=0.9999,
+        update_every=1,
+        offload=None
     ):
         """
         @crowsonkb's notes on EMA Warmup:
@@ -26,6 +29,10 @@ class EMAModel:
             inv_gamma (float): Inverse multiplicative factor of EMA warmup. Default: 1.
             power (float): Exponential factor of EMA warmup. Default: 2/3.
             min_value (float): The minimum EMA decay rate. Default: 0.
+            update_every (int): Average every N calls to step. The decay is raised to the N-th
+                power so the averaging horizon stays the same in optimizer steps. Default: 1.
+            offload (str): None keeps the EMA weights next to the model, 'cpu' or 'pinned'
+                (page-locked cpu memory) keeps them off the GPU. Default: None.
         """
 
         self.averaged_model = model
@@ -38,9 +45,33 @@ class EMAModel:
         self.min_value = min_value
         self.max_value = max_value
 
+        self.update_every = update_every
+        assert offload in (None, 'cpu', 'pinned'), f"Unsupported offload {offload}"
+        self.offload = offload
+
         self.decay = 0.0
         self.optimization_step = 0
 
+        # parameter lists of the last stepped model, see _get_groups
+        self._groups = None
+        self._groups_key = None
+        self._copy_versions = None
+        self._staging = None
+        self.offload_()
+
+    def offload_(self):
+        """
+        Move the averaged model back to cpu / pinned memory, e.g. after it was moved
+        to the GPU for evaluation. No-op without offload.
+        """
+        if self.offload is None:
+            return
+        self.averaged_model.to('cpu')
+        if self.offload == 'pinned' and torch.cuda.is_available():
+            for tensor in itertools.chain(self.averaged_model.parameters(), self.averaged_model.buffers()):
+                if not tensor.is_pinned():
+                    tensor.data = tensor.data.pin_memory()
+
     def get_decay(self, optimization_step):
         """
         Compute the decay factor for the exponential moving average.
@@ -53,36 +84,73 @@ class EMAModel:
 
         return max(self.min_value, min(value, self.max_value))
 
-    @torch.no_grad()
-    def step(self, new_model):
-        self.decay = self.get_decay(self.optimization_step)
-
-        # old_all_dataptrs = set()
-        # for param in new_model.parameters():
-        #     data_ptr = param.data_ptr()
-        #     if data_ptr != 0:
-        #         old_all_dataptrs.add(data_ptr)
+    def _get_groups(self, new_model):
+        """
+        (ema, model) parameter lists, averaged and copied ones, built once per model
+        and placement instead of walking the module tree on every step.
+        """
+        ema_first = next(self.averaged_model.parameters())
+        model_first = next(new_model.parameters())
+        key = (id(new_model), ema_first.device, ema_first.dtype, model_first.device, model_first.dtype)
+        if self._groups_key == key:
+            return self._groups
 
-        all_dataptrs = set()
+        ema_params, model_params = list(), list()
+        ema_copies, model_copies = list(), list()
         for module, ema_module in zip(new_model.modules(), self.averaged_model.modules()):            
             for param, ema_param in zip(module.parameters(recurse=False), ema_module.parameters(recurse=False)):
                 # iterative over immediate parameters only.
                 if isinstance(param, dict):
                     raise RuntimeError('Dict parameter not supported')
-                
-                # data_ptr = param.data_ptr()
-                # if data_ptr != 0:
-                #     all_dataptrs.add(data_ptr)
-
-                if isinstance(module, _BatchNorm):
+                if isinstance(module, _BatchNorm) or not param.requires_grad:
                     # skip batchnorms
-                    ema_param.copy_(param.to(dtype=ema_param.dtype).data)
-                elif not param.requires_grad:
-                    ema_param.copy_(param.to(dtype=ema_param.dtype).data)
+                    ema_copies.append(ema_param)
+                    model_copies.append(param)
                 else:
-                    ema_param.mul_(self.decay)
-                    ema_param.add_(param.data.to(dtype=ema_param.dtype), alpha=1 - self.decay)
+                    ema_params.append(ema_param)
+                    model_params.append(param)
+
+        # model weights on another device or in another dtype go through
+        # staging buffers laid out like the ema weights
+        self._staging = None
+        if any(p.device != e.device or p.dtype != e.dtype for p, e in zip(model_params, ema_params)):
+            pin = self.offload == 'pinned' and torch.cuda.is_available()
+            self._staging = [torch.empty(e.shape, dtype=e.dtype, device=e.device, pin_memory=pin)
+                for e in ema_params]
+        self._groups = (ema_params, model_params, ema_copies, model_copies)
+        self._groups_key = key
+        # version counters of the copied model parameters at their last copy
+        self._copy_versions = [-1] * len(model_copies)
+        return self._groups
 
-        # verify that iterating over module and then parameters is identical to parameters recursively.
-        # assert old_all_dataptrs == all_dataptrs
+    @torch.no_grad()
+    def step(self, new_model):
+        self.decay = self.get_decay(self.optimization_step)
         self.optimization_step += 1
+        if self.optimization_step % self.update_every != 0:
+            return
+        decay = self.decay ** self.update_every
+
+        ema_params, model_params, ema_copies, model_copies = self._get_groups(new_model)
+        for i, (ema_param, param) in enumerate(zip(ema_copies, model_copies)):
+            # frozen parameters (e.g. a pretrained backbone) are only copied when they
+            # changed, the ema copy then keeps its version and is not re-checkpointed
+            if param._version != self._copy_versions[i]:
+                ema_param.copy_(param.data)
+                self._copy_versions[i] = param._version
+        if len(ema_params) == 0:
+            return
+
+        sources = [param.data for param in model_params]
+        if self._staging is not None:
+            for staging, source in zip(self._staging, sources):
+                staging.copy_(source, non_blocking=True)
+            if sources[0].is_cuda and not self._staging[0].is_cuda:
+                # device -> pinned host copies are asynchronous
+                torch.cuda.current_stream(sources[0].device).synchronize()
+            sources = self._staging
+
+        # one fused kernel launch per op for all parameters, in place on the
+        # parameters (not .data) so their version counters track the updates
+        torch._foreach_mul_(ema_params, decay)
+        torch._foreach_add_(ema_params, sources, alpha=1 - decay)
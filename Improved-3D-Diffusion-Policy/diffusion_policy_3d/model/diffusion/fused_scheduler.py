@@ -0,0 +1,164 @@
+"""
+Drop-in replacements for the diffusers DDIM/DDPM schedulers whose step() is a
+single tensor expression over per-timestep coefficient tables kept on the
+sample's device. Config, add_noise() and set_timesteps() are inherited, so
+they can be swapped in through the noise_scheduler `_target_` and are
+checkpoint compatible with the diffusers classes.
+
+Combinations the fused path does not cover (eta > 0, v_prediction, learned
+variances, ...) fall back to the stock diffusers step.
+"""
+from typing import Dict, Tuple, Union
+import torch
+from diffusers.schedulers.scheduling_ddim import DDIMScheduler, DDIMSchedulerOutput
+from diffusers.schedulers.scheduling_ddpm import DDPMScheduler, DDPMSchedulerOutput
+
+
+def _is_device_tensor(x):
+    return isinstance(x, torch.Tensor) and x.device.type != 'cpu'
+
+
+class _CoefficientTableMixin:
+    """
+    Caches one (num_train_timesteps, n_coef) table per (device, dtype, key),
+    so step() only gathers a row instead of indexing alphas_cumprod on the host.
+    """
+    def _build_table(self) -> torch.Tensor:
+        raise NotImplementedError()
+
+    def _table_key(self):
+        return None
+
+    def _coefficients(self, timestep, device, dtype) -> Tuple[torch.Tensor, ...]:
+        tables: Dict = self.__dict__.setdefault('_fused_tables', dict())
+        key = (device, dtype, self._table_key())
+        table = tables.get(key)
+        if table is None:
+            # computed in float64 on the host, cast once
+            table = self._build_table().to(device=device, dtype=dtype)
+            tables[key] = table
+        if _is_device_tensor(timestep):
+            # device timestep: gather on device, no host sync
+            row = table.index_select(0, timestep.reshape(1).long())[0]
+        else:
+            row = table[int(timestep)]
+        return row.unbind(0)
+
+
+class FusedDDIMScheduler(_CoefficientTableMixin, DDIMScheduler):
+    """
+    Table columns: 1/sqrt(a_t), sqrt(1-a_t), sqrt(a_prev), sqrt(1-a_prev)
+    where a_prev is the cumulative alpha of the previous inference timestep.
+    """
+    def _table_key(self):
+        return self.num_inference_steps
+
+    def _build_table(self):
+        n = self.config.num_train_timesteps
+        step_ratio = n // self.num_inference_steps
+        alphas_cumprod = self.alphas_cumprod.double()
+        t = torch.arange(n)
+        prev_t = t - step_ratio
+        alpha_prod_t_prev = torch.where(prev_t >= 0,
+            alphas_cumprod[prev_t.clamp(min=0)],
+            self.final_alpha_cumprod.double())
+        return torch.stack([
+            alphas_cumprod.rsqrt(),
+            (1 - alphas_cumprod).sqrt(),
+            alpha_prod_t_prev.sqrt(),
+            (1 - alpha_prod_t_prev).sqrt()
+        ], dim=-1)
+
+    def step(self, model_output, timestep, sample,
+            eta: float = 0.0, use_clipped_model_output: bool = False,
+            generator=None, variance_noise=None, return_dict: bool = True
+            ) -> Union[DDIMSchedulerOutput, Tuple]:
+        prediction_type = self.config.prediction_type
+        if eta > 0 or use_clipped_model_output \
+            or prediction_type not in ('epsilon', 'sample'):
+            return super().step(model_output, timestep, sample,
+                eta=eta, use_clipped_model_output=use_clipped_model_output,
+                generator=generator, variance_noise=variance_noise,
+                return_dict=return_dict)
+        if self.num_inference_steps is None:
+            raise ValueError(
+                "Number of inference steps is 'None', you need to run 'set_timesteps' after creating the scheduler")
+
+        inv_sqrt_a, sqrt_one_minus_a, sqrt_a_prev, sqrt_one_minus_a_prev = \
+            self._coefficients(timestep, sample.device, sample.dtype)
+
+        if prediction_type == 'epsilon':
+            pred_original_sample = (sample - sqrt_one_minus_a * model_output) * inv_sqrt_a
+        else:
+            pred_original_sample = model_output
+        if self.config.clip_sample:
+            pred_original_sample = pred_original_sample.clamp(-1, 1)
+        # same as diffusers 0.11: the direction term uses the raw model output
+        # (the noise for epsilon, the unclipped x0 for sample prediction)
+        prev_sample = torch.addcmul(
+            sqrt_one_minus_a_prev * model_output, pred_original_sample, sqrt_a_prev)
+
+        if not return_dict:
+            return (prev_sample,)
+        return DDIMSchedulerOutput(prev_sample=prev_sample, pred_original_sample=pred_original_sample)
+
+
+class FusedDDPMScheduler(_CoefficientTableMixin, DDPMScheduler):
+    """
+    Table columns: 1/sqrt(a_t), sqrt(1-a_t), x0 coefficient, x_t coefficient
+    and the posterior std (0 at t=0).
+    """
+    def _build_table(self):
+        alphas_cumprod = self.alphas_cumprod.double()
+        alphas = self.alphas.double()
+        betas = self.betas.double()
+        alpha_prod_t_prev = torch.cat([alphas_cumprod.new_ones(1), alphas_cumprod[:-1]])
+        beta_prod_t = 1 - alphas_cumprod
+        beta_prod_t_prev = 1 - alpha_prod_t_prev
+
+        if self.config.variance_type == 'fixed_large':
+            std = betas.sqrt()
+        else:
+            # fixed_small and fixed_small_log give the same std
+            std = (beta_prod_t_prev / beta_prod_t * betas).clamp(min=1e-20).sqrt()
+        std[0] = 0
+        return torch.stack([
+            alphas_cumprod.rsqrt(),
+            beta_prod_t.sqrt(),
+            alpha_prod_t_prev.sqrt() * betas / beta_prod_t,
+            alphas.sqrt() * beta_prod_t_prev / beta_prod_t,
+            std
+        ], dim=-1)
+
+    def step(self, model_output, timestep, sample,
+            generator=None, return_dict: bool = True, **kwargs
+            ) -> Union[DDPMSchedulerOutput, Tuple]:
+        prediction_type = self.config.prediction_type
+        if len(kwargs) > 0 \
+            or prediction_type not in ('epsilon', 'sample') \
+            or self.config.variance_type not in ('fixed_small', 'fixed_small_log', 'fixed_large'):
+            return super().step(model_output, timestep, sample,
+                generator=generator, return_dict=return_dict, **kwargs)
+
+        inv_sqrt_a, sqrt_one_minus_a, x0_coeff, sample_coeff, std = \
+            self._coefficients(timestep, sample.device, sample.dtype)
+
+        if prediction_type == 'epsilon':
+            pred_original_sample = (sample - sqrt_one_minus_a * model_output) * inv_sqrt_a
+        else:
+            pred_original_sample = model_output
+        if self.config.clip_sample:
+            pred_original_sample = pred_original_sample.clamp(-1, 1)
+        prev_sample = torch.addcmul(
+            sample_coeff * sample, pred_original_sample, x0_coeff)
+
+        # a host timestep lets us skip drawing noise at t=0 like diffusers does,
+        # a device timestep always draws (std is 0 there) to stay sync free
+        if _is_device_tensor(timestep) or int(timestep) > 0:
+            noise = torch.randn(model_output.shape, generator=generator,
+                device=model_output.device, dtype=model_output.dtype)
+            prev_sample = torch.addcmul(prev_sample, noise, std)
+
+        if not return_dict:
+            return (prev_sample,)
+        return DDPMSchedulerOutput(prev_sample=prev_sample, pred_original_sample=pred_original_sample)
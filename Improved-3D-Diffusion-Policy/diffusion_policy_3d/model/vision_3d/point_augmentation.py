@@ -0,0 +1,91 @@
+from typing import Dict, Optional, Sequence
+import torch
+import diffusion_policy_3d.model.vision_3d.point_process as point_process
+
+
+class PointCloudPreprocessor:
+    """
+    Batched on-device point cloud preprocessing for training, applied to the
+    obs dict right after device transfer so dataloader workers can ship raw clouds.
+
+    For every frame of every sample independently:
+        crop -> subsample to num_points (uniform / fps / voxel) -> jitter (train only)
+
+    Points outside the crop, and duplicate points of a voxel, are only used to
+    fill up clouds that have fewer than num_points valid points; such fill-up
+    points are zeroed, same as the zero padding of uniform_sampling_numpy.
+    """
+    def __init__(self,
+            num_points=4096,
+            sampling='uniform',
+            voxel_size=0.005,
+            crop: Optional[Sequence[Sequence[float]]]=None,
+            jitter_std=0.0,
+            jitter_clip=0.02,
+            keys=('point_cloud', 'wrist_point_cloud'),
+            ):
+        assert sampling in ('uniform', 'fps', 'voxel'), sampling
+        self.num_points = num_points
+        self.sampling = sampling
+        self.voxel_size = voxel_size
+        # [[xmin, ymin, zmin], [xmax, ymax, zmax]]
+        self.crop = None if crop is None else torch.tensor(crop, dtype=torch.float32)
+        self.jitter_std = jitter_std
+        self.jitter_clip = jitter_clip
+        self.keys = list(keys)
+
+    def __call__(self, obs: Dict[str, torch.Tensor], train=True) -> Dict[str, torch.Tensor]:
+        obs = dict(obs)
+        for key in self.keys:
+            if key in obs:
+                obs[key] = self.process(obs[key], train=train)
+        return obs
+
+    def process(self, points: torch.Tensor, train=True) -> torch.Tensor:
+        """
+        points: (..., N, C) with xyz in the first 3 channels -> (..., num_points, C)
+        """
+        lead_shape = points.shape[:-2]
+        N, C = points.shape[-2:]
+        points = points.reshape(-1, N, C)
+        M = points.shape[0]
+
+        valid = None
+        if self.crop is not None:
+            crop = self.crop.to(points.device)
+            valid = ((points[..., :3] >= crop[0]) & (points[..., :3] <= crop[1])).all(dim=-1)
+        if self.sampling == 'voxel':
+            voxel_mask = point_process.voxel_first_point_mask_torch(points[..., :3], self.voxel_size)
+            valid = voxel_mask if valid is None else (valid & voxel_mask)
+        if self.num_points > N:
+            # zero padding, like pad_point_numpy
+            num_pad = self.num_points - N
+            points = torch.cat([points, points.new_zeros(M, num_pad, C)], dim=1)
+            if valid is None:
+                valid = torch.ones(M, N, dtype=torch.bool, device=points.device)
+            valid = torch.cat([valid, valid.new_zeros(M, num_pad)], dim=1)
+
+        if self.sampling == 'fps':
+            indices = point_process.farthest_point_sampling_torch(
+                points[..., :3], self.num_points, valid=valid)
+        else:
+            # random subset per cloud, valid points ranked first
+            score = torch.rand(points.shape[:2], device=points.device)
+            if valid is not None:
+                score = score + valid
+            indices = score.topk(self.num_points, dim=1).indices
+        points = torch.gather(points, 1, indices[..., None].expand(-1, -1, C))
+        picked_valid = None
+        if valid is not None:
+            picked_valid = torch.gather(valid, 1, indices)[..., None]
+            points = points * picked_valid
+
+        if train and self.jitter_std > 0:
+            noise = (torch.randn_like(points[..., :3]) * self.jitter_std).clamp(
+                -self.jitter_clip, self.jitter_clip)
+            if picked_valid is not None:
+                # keep zero padding at zero
+                noise = noise * picked_valid
+            points = torch.cat([points[..., :3] + noise, points[..., 3:]], dim=-1)
+
+        return points.reshape(*lead_shape, self.num_points, C)
@@ -4,7 +4,9 @@
 import torch
 import numpy as np
 
-__all__ = ["shuffle_point_torch", "pad_point_torch", "uniform_sampling_torch"]
+__all__ = ["shuffle_point_torch", "pad_point_torch", "uniform_sampling_torch",
+    "farthest_point_sampling_torch", "voxel_first_point_mask_torch",
+    "voxel_downsample_numpy", "voxel_downsample_torch", "VoxelGrid"]
 
 def shuffle_point_numpy(point_cloud):
     B, N, C = point_cloud.shape
@@ -31,9 +33,21 @@ def uniform_sampling_numpy(point_cloud, num_points):
     sampled_points = point_cloud[:, indices]
     return sampled_points
 
+def uniform_sampling_numpy_batch(point_cloud, num_points):
+    """
+    point_cloud: (B, T, N, C), every sample gets its own random subset,
+    shared by its T frames (same as uniform_sampling_numpy per sample).
+    """
+    B, T, N, C = point_cloud.shape
+    if num_points > N:
+        return np.stack([pad_point_numpy(x, num_points) for x in point_cloud], axis=0)
+    # argpartition of uniform noise gives an independent random subset per sample
+    indices = np.argpartition(np.random.random((B, N)), num_points - 1, axis=-1)[:, :num_points]
+    return np.take_along_axis(point_cloud, indices[:, None, :, None], axis=2)
+
 def shuffle_point_torch(point_cloud):
     B, N, C = point_cloud.shape
-    indices = torch.randperm(N)
+    indices = torch.randperm(N, device=point_cloud.device)
     return point_cloud[:, indices]
 
 def pad_point_torch(point_cloud, num_points):
@@ -55,8 +69,209 @@ def uniform_sampling_torch(point_cloud, num_points):
     if num_points > N:
         return pad_point_torch(point_cloud, num_points)
     
-    # random sampling
-    indices = torch.randperm(N)[:num_points]
+    # random sampling, permutation created on the cloud's device
+    indices = torch.randperm(N, device=device)[:num_points]
     sampled_points = point_cloud[:, indices]
     return sampled_points
 
+
+def farthest_point_sampling_torch(xyz, num_points, valid=None):
+    """
+    Batched farthest point sampling, xyz: (M, N, 3), valid: optional (M, N) bool.
+    Returns (M, num_points) indices, starting from a random valid point.
+    Invalid points are never picked unless a cloud has no valid point left.
+    """
+    M, N, _ = xyz.shape
+    device = xyz.device
+    dist = torch.full((M, N), float('inf'), device=device, dtype=xyz.dtype)
+    start_score = torch.rand(M, N, device=device)
+    if valid is not None:
+        dist = dist.masked_fill(~valid, -1)
+        start_score = start_score * valid
+    farthest = start_score.argmax(dim=1)
+    batch_idx = torch.arange(M, device=device)
+    indices = torch.empty(M, num_points, dtype=torch.long, device=device)
+    for i in range(num_points):
+        indices[:, i] = farthest
+        centroid = xyz[batch_idx, farthest]
+        d = (xyz - centroid[:, None]).square().sum(dim=-1)
+        # invalid points stay at -1
+        dist = torch.minimum(dist, d)
+        farthest = dist.argmax(dim=1)
+    return indices
+
+
+# ============= voxel downsampling =============
+# Voxel coordinates are offset by their per-cloud minimum and packed into a
+# mixed-radix int64 key: key = (x * dim_y + y) * dim_z + z. Unlike fixed
+# multipliers this can not collide for negative or large coordinates.
+
+def voxel_keys_numpy(xyz, voxel_size):
+    """
+    xyz: (N, 3) -> (keys (N,) int64, number of cells)
+    """
+    # (3, N) layout keeps the per-axis min/max reductions contiguous
+    coords = np.floor(np.ascontiguousarray(xyz.T) / voxel_size).astype(np.int64)
+    coords -= coords.min(axis=1, keepdims=True)
+    dims = coords.max(axis=1) + 1
+    keys = (coords[0] * dims[1] + coords[1]) * dims[2] + coords[2]
+    return keys, int(np.prod(dims))
+
+
+class VoxelGrid:
+    """
+    Sort-free numpy voxel downsampling for point clouds (N, C), xyz first.
+    mode='first' keeps one input point per voxel, mode='centroid' averages
+    all channels of the points in a voxel.
+    A dense voxel -> point table (int32, at most max_cells entries, 16 MB by
+    default) is kept between calls and only the touched cells are reset, so a
+    frame costs O(N). Grids with more than max_cells cells fall back to np.unique.
+    """
+    def __init__(self, voxel_size=0.005, mode='first', max_cells=1 << 22):
+        assert mode in ('first', 'centroid'), mode
+        self.voxel_size = voxel_size
+        self.mode = mode
+        self.max_cells = max_cells
+        self._table = np.empty(0, dtype=np.int32)
+
+    def _voxel_index(self, keys, n_cells):
+        """
+        Returns (index of the voxel of every point (N,), representative point of every voxel).
+        """
+        N = len(keys)
+        need_inverse = (self.mode == 'centroid')
+        empty = np.iinfo(np.int32).max
+        if n_cells > self.max_cells or N >= empty:
+            _, first, inverse = np.unique(keys, return_index=True, return_inverse=True)
+            # renumber voxels from key order to first-point order
+            order = np.argsort(first)
+            rank = np.empty_like(order)
+            rank[order] = np.arange(len(order))
+            return rank[inverse.reshape(-1)], first[order]
+        if len(self._table) < n_cells:
+            self._table = np.full(n_cells, empty, dtype=np.int32)
+        table = self._table
+        point_index = np.arange(N, dtype=np.int32)
+        # smallest point index per voxel, fancy assignment does not define
+        # which of several duplicate indices wins
+        np.minimum.at(table, keys, point_index)
+        first = np.flatnonzero(table[keys] == point_index)
+        inverse = None
+        if need_inverse:
+            # number the occupied voxels 0..V-1 in first-point order
+            table[keys[first]] = np.arange(len(first), dtype=np.int32)
+            inverse = table[keys].astype(np.int64)
+        table[keys] = empty
+        return inverse, first
+
+    def __call__(self, point_cloud):
+        if len(point_cloud) == 0:
+            return point_cloud
+        keys, n_cells = voxel_keys_numpy(point_cloud[:, :3], self.voxel_size)
+        inverse, first = self._voxel_index(keys, n_cells)
+        if self.mode == 'first':
+            return point_cloud[first]
+        counts = np.bincount(inverse, minlength=len(first)).astype(np.float64)
+        out = np.empty((len(first), point_cloud.shape[1]), dtype=point_cloud.dtype)
+        for c in range(point_cloud.shape[1]):
+            out[:, c] = np.bincount(inverse, weights=point_cloud[:, c], minlength=len(first)) / counts
+        return out
+
+
+def voxel_downsample_numpy(point_cloud, voxel_size, mode='first'):
+    """
+    point_cloud: (N, C) numpy, xyz in the first 3 channels.
+    """
+    return VoxelGrid(voxel_size, mode=mode)(point_cloud)
+
+
+def _voxel_keys_torch(xyz, voxel_size):
+    """
+    xyz: (M, N, 3) -> (M, N) int64 keys, cloud index as the most significant digit.
+    """
+    M = xyz.shape[0]
+    coords = torch.floor(xyz / voxel_size).long()
+    coords = coords - coords.amin(dim=1, keepdim=True)
+    dims = coords.reshape(-1, 3).amax(dim=0) + 1
+    key = torch.arange(M, device=xyz.device)[:, None]
+    for axis in range(3):
+        key = key * dims[axis] + coords[..., axis]
+    return key
+
+
+def _first_index_torch(inverse, n_voxels):
+    flat_idx = torch.arange(len(inverse), device=inverse.device)
+    first = torch.full((n_voxels,), len(inverse), dtype=torch.long, device=inverse.device)
+    return first.scatter_reduce(0, inverse, flat_idx, reduce='amin')
+
+
+def voxel_first_point_mask_torch(xyz, voxel_size):
+    """
+    xyz: (M, N, 3). Marks the first point of every occupied voxel of every cloud.
+    """
+    M, N, _ = xyz.shape
+    key = _voxel_keys_torch(xyz, voxel_size)
+    unique_keys, inverse = torch.unique(key.reshape(-1), return_inverse=True)
+    first = _first_index_torch(inverse, len(unique_keys))
+    mask = torch.zeros(M * N, dtype=torch.bool, device=xyz.device)
+    mask[first] = True
+    return mask.reshape(M, N)
+
+
+def voxel_downsample_torch(point_cloud, voxel_size, mode='first'):
+    """
+    point_cloud: (N, C) tensor, xyz in the first 3 channels.
+    """
+    assert mode in ('first', 'centroid'), mode
+    if len(point_cloud) == 0:
+        return point_cloud
+    key = _voxel_keys_torch(point_cloud[None, :, :3], voxel_size)[0]
+    unique_keys, inverse = torch.unique(key, return_inverse=True)
+    if mode == 'first':
+        first = _first_index_torch(inverse, len(unique_keys))
+        # keep input order
+        return point_cloud[first.sort().values]
+    sums = torch.zeros((len(unique_keys), point_cloud.shape[1]),
+        dtype=point_cloud.dtype, device=point_cloud.device).index_add_(0, inverse, point_cloud)
+    counts = torch.bincount(inverse, minlength=len(unique_keys))
+    return sums / counts[:, None].to(sums.dtype)
+
+
+if __name__ == '__main__':
+    # benchmark: python -m diffusion_policy_3d.model.vision_3d.point_process
+    import time
+
+    def grid_sample_packed(point_cloud, grid_size=0.005):
+        # previous multi_realsense.grid_sample_pcd, for reference
+        grid_coords = np.floor(point_cloud[:, :3] / grid_size).astype(int)
+        keys = grid_coords[:, 0] + grid_coords[:, 1] * 10000 + grid_coords[:, 2] * 100000000
+        _, indices = np.unique(keys, return_index=True)
+        return point_cloud[indices]
+
+    def bench(name, fn, n_iter=20):
+        fn()
+        t = time.perf_counter()
+        for _ in range(n_iter):
+            out = fn()
+        if isinstance(out, torch.Tensor) and out.is_cuda:
+            torch.cuda.synchronize()
+        dt = (time.perf_counter() - t) / n_iter
+        print(f"{name:<32} {dt * 1000:8.2f} ms  {1 / dt:8.1f} fps  -> {len(out)} points")
+
+    # one 640x480 depth frame: a wavy surface ~0.6m away, xyz + rgb
+    rng = np.random.default_rng(0)
+    xs, ys = np.meshgrid(np.linspace(-0.4, 0.4, 640), np.linspace(-0.3, 0.3, 480))
+    zs = 0.6 + 0.05 * np.sin(xs * 20) * np.cos(ys * 20) + rng.normal(0, 0.002, xs.shape)
+    cloud = np.concatenate([np.stack([xs, ys, zs], axis=-1).reshape(-1, 3),
+        rng.uniform(0, 255, (xs.size, 3))], axis=1).astype(np.float32)
+    cloud = cloud[rng.permutation(len(cloud))]
+    voxel_grid = VoxelGrid(0.005)
+    centroid_grid = VoxelGrid(0.005, mode='centroid')
+    bench('np.unique packed keys (old)', lambda: grid_sample_packed(cloud))
+    bench('VoxelGrid first', lambda: voxel_grid(cloud))
+    bench('VoxelGrid centroid', lambda: centroid_grid(cloud))
+    assert len(voxel_grid(cloud)) == len(np.unique(voxel_keys_numpy(cloud[:, :3], 0.005)[0]))
+    devices = ['cpu'] + (['cuda'] if torch.cuda.is_available() else [])
+    for device in devices:
+        cloud_torch = torch.from_numpy(cloud).to(device)
+        bench(f'voxel_downsample_torch {device}', lambda: voxel_downsample_torch(cloud_torch, 0.005))
@@ -1,4 +1,6 @@
 from typing import Dict
+from collections import OrderedDict
+import contextlib
 import math
 import torch
 import torch.nn as nn
@@ -8,14 +10,22 @@ from diffusers.schedulers.scheduling_ddpm import DDPMScheduler
 from termcolor import cprint
 import copy
 import time
+import numpy as np
 from diffusion_policy_3d.model.common.normalizer import LinearNormalizer
 from diffusion_policy_3d.policy.base_policy import BasePolicy
 from diffusion_policy_3d.model.diffusion.conditional_unet1d import ConditionalUnet1D
 from diffusion_policy_3d.model.diffusion.mask_generator import LowdimMaskGenerator
 from diffusion_policy_3d.common.pytorch_util import dict_apply
 from diffusion_policy_3d.common.model_util import print_params
+from diffusion_policy_3d.common.compile_util import CompiledModule, enable_compile_cache
 from diffusion_policy_3d.model.vision_3d.pointnet_extractor import iDP3Encoder
 
+PRECISION_DTYPES = {
+    'fp32': torch.float32,
+    'bf16': torch.bfloat16,
+    'fp16': torch.float16,
+}
+
 class DiffusionPointcloudPolicy(BasePolicy):
     def __init__(self, 
             shape_meta: dict,
@@ -38,12 +48,31 @@ class DiffusionPointcloudPolicy(BasePolicy):
             pointcloud_encoder_cfg=None,
             point_downsample=False,
             use_wrist=False,
+            use_cuda_graph=False,
+            obs_feature_cache_size=64,
+            precision='fp32',
+            use_compile=False,
+            compile_mode='default',
             # parameters passed to step
             **kwargs):
         super().__init__()
 
         self.condition_type = condition_type
         self.use_wrist=use_wrist
+        # replay the whole denoising loop as one captured cuda graph at inference
+        self.use_cuda_graph = use_cuda_graph
+        self._cuda_graphs = dict()
+        # per-frame encoder features keyed by frame id, see predict_action(frame_ids=...)
+        self.obs_feature_cache_size = obs_feature_cache_size
+        self._obs_feature_cache = OrderedDict()
+        # torch.compile the obs encoder and the UNet, see _get_module
+        self.use_compile = use_compile
+        self.compile_mode = compile_mode
+        self._compiled = dict()
+        if use_compile:
+            enable_compile_cache()
+        # fp32 / bf16 / fp16, obs encoder and UNet run under autocast, weights stay fp32
+        self.set_precision(precision)
 
 
         # parse shape_meta
@@ -129,6 +158,36 @@ class DiffusionPointcloudPolicy(BasePolicy):
 
         print_params(self)
 
+    def set_precision(self, precision):
+        assert precision in PRECISION_DTYPES, f"Unsupported precision {precision}"
+        self.precision = precision
+        self._cuda_graphs = dict()
+        self._compiled = dict()
+        self._obs_feature_cache = OrderedDict()
+
+    def _get_module(self, name):
+        """
+        The submodule `name`, or its compiled version with use_compile.
+        Compiled wrappers are created on first use and are not registered as submodules.
+        """
+        module = getattr(self, name)
+        if not self.use_compile:
+            return module
+        if name not in self._compiled:
+            self._compiled[name] = CompiledModule(module,
+                name=f"{type(self).__name__}.{name}", mode=self.compile_mode)
+        return self._compiled[name]
+
+    def get_compile_times(self):
+        return {name: compiled.total_compile_time() for name, compiled in self._compiled.items()}
+
+    def _autocast(self, cache_enabled=True):
+        # only the obs encoder and the UNet, normalizer, loss and scheduler steps stay in fp32
+        if self.precision == 'fp32':
+            return contextlib.nullcontext()
+        return torch.autocast(device_type=self.device.type, dtype=PRECISION_DTYPES[self.precision],
+            cache_enabled=cache_enabled)
+
     def forward(self, obs_dict: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
         obs_dict = obs_dict.copy()
        
@@ -163,7 +222,7 @@ class DiffusionPointcloudPolicy(BasePolicy):
             
         # condition through global feature
         this_nobs = dict_apply(nobs, lambda x: x[:,:To,...].reshape(-1,*x.shape[2:]))
-        nobs_features = self.obs_encoder(this_nobs)
+        nobs_features = self._run_obs_encoder(this_nobs)
         # reshape back to B, Do
         global_cond = nobs_features.reshape(B, -1)
      
@@ -204,42 +263,192 @@ class DiffusionPointcloudPolicy(BasePolicy):
             # keyword arguments to scheduler.step
             **kwargs
             ):
-        model = self.model
+        model = self._get_module('model')
         scheduler = self.noise_scheduler
 
+        if self.use_cuda_graph and condition_data.is_cuda and generator is None \
+            and local_cond is None and not torch.is_grad_enabled():
+            return self._graph_conditional_sample(
+                condition_data, condition_mask, global_cond=global_cond)
 
         trajectory = torch.randn(
             size=condition_data.shape, 
             dtype=condition_data.dtype,
-            device=condition_data.device)
+            device=condition_data.device,
+            generator=generator)
 
-        # set step values
-        scheduler.set_timesteps(self.num_inference_steps)
+        # set step values, the timesteps only depend on the step count
+        if scheduler.num_inference_steps != self.num_inference_steps:
+            scheduler.set_timesteps(self.num_inference_steps)
+        # one host->device copy per call instead of one per step inside the UNet,
+        # the scheduler keeps indexing its tables with the host timestep
+        timesteps_device = scheduler.timesteps.to(condition_data.device)
 
 
-        for t in scheduler.timesteps:
-            # 1. apply conditioning
-            trajectory[condition_mask] = condition_data[condition_mask]
+        for t, t_device in zip(scheduler.timesteps, timesteps_device):
+            # 1. apply conditioning, mask-free so the compiled UNet sees no graph break
+            trajectory = torch.where(condition_mask, condition_data, trajectory)
 
 
-            model_output = model(sample=trajectory,
-                                timestep=t, 
-                                local_cond=local_cond, global_cond=global_cond)
+            with self._autocast():
+                model_output = model(sample=trajectory,
+                                    timestep=t_device, 
+                                    local_cond=local_cond, global_cond=global_cond)
+            model_output = model_output.float()
             
             # 3. compute previous image: x_t -> x_t-1
             trajectory = scheduler.step(
-                model_output, t, trajectory, ).prev_sample
+                model_output, t, trajectory, generator=generator).prev_sample
             
                 
         # finally make sure conditioning is enforced
-        trajectory[condition_mask] = condition_data[condition_mask]   
+        trajectory = torch.where(condition_mask, condition_data, trajectory)
 
 
         return trajectory
 
-    def predict_action(self, obs_dict: Dict[str, torch.Tensor]) -> Dict[str, torch.Tensor]:
+    # ========= cuda graph inference ============
+    def _graph_conditional_sample(self, condition_data, condition_mask, global_cond=None):
+        """
+        Same rollout as conditional_sample, replayed from a cuda graph captured
+        once per input shape. Only the static input buffers are refreshed per call.
+        """
+        key = (tuple(condition_data.shape), condition_data.dtype,
+            None if global_cond is None else tuple(global_cond.shape))
+        graph_state = self._cuda_graphs.get(key)
+        if graph_state is None:
+            graph_state = self._capture_sample_graph(condition_data, condition_mask, global_cond)
+            self._cuda_graphs[key] = graph_state
+
+        graph_state['condition_data'].copy_(condition_data)
+        graph_state['condition_mask'].copy_(condition_mask)
+        if global_cond is not None:
+            graph_state['global_cond'].copy_(global_cond)
+        graph_state['noise'].normal_()
+        graph_state['graph'].replay()
+        # the output buffer is overwritten by the next replay
+        return graph_state['output'].clone()
+
+    def _capture_sample_graph(self, condition_data, condition_mask, global_cond):
+        model = self.model
+        scheduler = self.noise_scheduler
+        scheduler.set_timesteps(self.num_inference_steps)
+        device = condition_data.device
+        # the UNet gets device timesteps (no host int -> device copy inside the graph),
+        # the scheduler keeps host timesteps so its coefficient lookups become
+        # constants baked into the captured kernels.
+        timesteps = list(zip(scheduler.timesteps, scheduler.timesteps.to(device)))
+
+        graph_state = {
+            'condition_data': condition_data.clone(),
+            'condition_mask': condition_mask.clone(),
+            'global_cond': None if global_cond is None else global_cond.clone(),
+            'noise': torch.randn_like(condition_data),
+        }
+
+        def rollout():
+            # mask-free conditioning, boolean indexing would sync on the mask
+            trajectory = graph_state['noise']
+            for t, t_device in timesteps:
+                trajectory = torch.where(graph_state['condition_mask'],
+                    graph_state['condition_data'], trajectory)
+                # the autocast weight cache would not survive the capture
+                with self._autocast(cache_enabled=False):
+                    model_output = model(sample=trajectory,
+                                        timestep=t_device,
+                                        local_cond=None, global_cond=graph_state['global_cond'])
+                model_output = model_output.float()
+                trajectory = scheduler.step(
+                    model_output, t, trajectory, ).prev_sample
+            return torch.where(graph_state['condition_mask'],
+                graph_state['condition_data'], trajectory)
+
+        # warm up on a side stream before capture, as required by cuda graphs
+        stream = torch.cuda.Stream(device=device)
+        stream.wait_stream(torch.cuda.current_stream(device))
+        with torch.cuda.stream(stream):
+            for _ in range(3):
+                rollout()
+        torch.cuda.current_stream(device).wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph):
+            graph_state['output'] = rollout()
+        graph_state['graph'] = graph
+        cprint(f"[DiffusionPointcloudPolicy] captured cuda graph for batch {condition_data.shape[0]}", "yellow")
+        return graph_state
+
+    def _apply(self, fn, *args, **kwargs):
+        # captured graphs point at the old parameter storage after .to()/.cuda()
+        self._cuda_graphs = dict()
+        self._obs_feature_cache = OrderedDict()
+        return super()._apply(fn, *args, **kwargs)
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        # new weights: cached frame features came from the old encoder,
+        # called for this module also when a parent module loads a state dict
+        self._cuda_graphs = dict()
+        self._obs_feature_cache = OrderedDict()
+        return super()._load_from_state_dict(*args, **kwargs)
+
+    def __getstate__(self):
+        # cuda graphs and compiled modules can not be pickled or deep-copied
+        state = self.__dict__.copy()
+        state['_cuda_graphs'] = dict()
+        state['_compiled'] = dict()
+        state['_obs_feature_cache'] = OrderedDict()
+        return state
+
+    def reset(self):
+        self._obs_feature_cache.clear()
+
+    def _encode_obs(self, nobs, To, frame_ids=None):
+        """
+        Encode the first To frames of every sample, returns (B*To, Do).
+        With frame_ids, frames whose id is already in the feature cache are not
+        re-encoded. Ids must be hashable and unique across the batch
+        (e.g. timestamps, or (client, timestamp) tuples when serving several robots).
+        """
+        this_nobs = dict_apply(nobs, lambda x: x[:,:To,...].reshape(-1,*x.shape[2:]))
+        if frame_ids is None or self.obs_feature_cache_size <= 0 or self.training:
+            return self._run_obs_encoder(this_nobs)
+
+        if isinstance(frame_ids, (np.ndarray, torch.Tensor)):
+            frame_ids = frame_ids.tolist()
+        keys = [ids[i] for ids in frame_ids for i in range(To)]
+        cache = self._obs_feature_cache
+
+        missing = list()
+        missing_keys = set()
+        for i, key in enumerate(keys):
+            if key not in cache and key not in missing_keys:
+                missing.append(i)
+                missing_keys.add(key)
+        if len(missing) > 0:
+            index = torch.as_tensor(missing, device=self.device)
+            new_features = self._run_obs_encoder(dict_apply(this_nobs, lambda x: x[index]))
+            for i, feature in zip(missing, new_features):
+                cache[keys[i]] = feature
+        nobs_features = torch.stack([cache[key] for key in keys], dim=0)
+
+        # least recently used frames are dropped first
+        for key in keys:
+            cache.move_to_end(key)
+        while len(cache) > self.obs_feature_cache_size:
+            cache.popitem(last=False)
+        return nobs_features
+
+    def _run_obs_encoder(self, this_nobs):
+        with self._autocast():
+            nobs_features = self._get_module('obs_encoder')(this_nobs)
+        return nobs_features.float()
+
+    def predict_action(self, obs_dict: Dict[str, torch.Tensor], frame_ids=None, generator=None) -> Dict[str, torch.Tensor]:
         """
         obs_dict: must include "obs" key
+        frame_ids: optional (B, To) ids (e.g. capture timestamps) of the observation
+            frames, frames seen in earlier calls reuse their cached encoder features
+        generator: optional torch.Generator for the sampling noise
         result: must include "action" key
         """
         # normalize input
@@ -270,8 +479,7 @@ class DiffusionPointcloudPolicy(BasePolicy):
         global_cond = None
         if self.obs_as_global_cond:
             # condition through global feature
-            this_nobs = dict_apply(nobs, lambda x: x[:,:To,...].reshape(-1,*x.shape[2:]))
-            nobs_features = self.obs_encoder(this_nobs)
+            nobs_features = self._encode_obs(nobs, To, frame_ids)
             if "cross_attention" in self.condition_type:
                 # treat as a sequence
                 global_cond = nobs_features.reshape(B, self.n_obs_steps, -1)
@@ -283,8 +491,7 @@ class DiffusionPointcloudPolicy(BasePolicy):
             cond_mask = torch.zeros_like(cond_data, dtype=torch.bool)
         else:
             # condition through impainting
-            this_nobs = dict_apply(nobs, lambda x: x[:,:To,...].reshape(-1,*x.shape[2:]))
-            nobs_features = self.obs_encoder(this_nobs)
+            nobs_features = self._encode_obs(nobs, To, frame_ids)
             # reshape back to B, T, Do
             nobs_features = nobs_features.reshape(B, To, -1)
             cond_data = torch.zeros(size=(B, T, Da+Do), device=device, dtype=dtype)
@@ -298,6 +505,7 @@ class DiffusionPointcloudPolicy(BasePolicy):
             cond_mask,
             local_cond=local_cond,
             global_cond=global_cond,
+            generator=generator,
             **self.kwargs)
         
         # unnormalize prediction
@@ -322,6 +530,7 @@ class DiffusionPointcloudPolicy(BasePolicy):
     # ========= training  ============
     def set_normalizer(self, normalizer: LinearNormalizer):
         self.normalizer.load_state_dict(normalizer.state_dict())
+        self._obs_feature_cache.clear()
 
     def compute_loss(self, batch):
         # normalize input
@@ -352,7 +561,7 @@ class DiffusionPointcloudPolicy(BasePolicy):
             # reshape B, T, ... to B*T
             this_nobs = dict_apply(nobs, 
                 lambda x: x[:,:self.n_obs_steps,...].reshape(-1,*x.shape[2:]))
-            nobs_features = self.obs_encoder(this_nobs)
+            nobs_features = self._run_obs_encoder(this_nobs)
 
             if "cross_attention" in self.condition_type:
                 # treat as a sequence
@@ -363,7 +572,7 @@ class DiffusionPointcloudPolicy(BasePolicy):
         else:
             # reshape B, T, ... to B*T
             this_nobs = dict_apply(nobs, lambda x: x.reshape(-1, *x.shape[2:]))
-            nobs_features = self.obs_encoder(this_nobs)
+            nobs_features = self._run_obs_encoder(this_nobs)
             # reshape back to B, T, Do
             nobs_features = nobs_features.reshape(batch_size, horizon, -1)
             cond_data = torch.cat([nactions, nobs_features], dim=-1)
@@ -395,14 +604,17 @@ class DiffusionPointcloudPolicy(BasePolicy):
         loss_mask = ~condition_mask
 
         # apply conditioning
-        noisy_trajectory[condition_mask] = cond_data[condition_mask]
+        noisy_trajectory = torch.where(condition_mask, cond_data, noisy_trajectory)
 
         # Predict the noise residual
         
-        pred = self.model(sample=noisy_trajectory, 
-                        timestep=timesteps, 
-                            local_cond=local_cond, 
-                            global_cond=global_cond)
+        with self._autocast():
+            pred = self._get_module('model')(sample=noisy_trajectory, 
+                            timestep=timesteps, 
+                                local_cond=local_cond, 
+                                global_cond=global_cond)
+        # the loss is computed in fp32
+        pred = pred.float()
 
 
         pred_type = self.noise_scheduler.config.prediction_type 
@@ -431,8 +643,9 @@ class DiffusionPointcloudPolicy(BasePolicy):
         loss = loss.mean()
         
 
+        # kept on the device, logging syncs once per flush (see MetricsAggregator)
         loss_dict = {
-                'bc_loss': loss.item(),
+                'bc_loss': loss.detach(),
             }
 
         return loss, loss_dict
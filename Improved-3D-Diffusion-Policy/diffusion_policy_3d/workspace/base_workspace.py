@@ -2,22 +2,23 @@ from typing import Optional
 import os
 import pathlib
 import hydra
-import copy
 from hydra.core.hydra_config import HydraConfig
 from omegaconf import OmegaConf
 import dill
 import torch
-import threading
+from diffusion_policy_3d.common.checkpoint_writer import CheckpointWriter, load_payload
 
 
 class BaseWorkspace:
     include_keys = tuple()
     exclude_keys = tuple()
+    # module state dicts are saved as one shard per submodule this many levels deep
+    checkpoint_shard_depth = 2
 
     def __init__(self, cfg: OmegaConf, output_dir: Optional[str]=None):
         self.cfg = cfg
         self._output_dir = output_dir
-        self._saving_thread = None
+        self._checkpoint_writer = None
 
     @property
     def output_dir(self):
@@ -35,7 +36,12 @@ class BaseWorkspace:
     def save_checkpoint(self, path=None, tag='latest', 
             exclude_keys=None,
             include_keys=None,
-            use_thread=False):
+            use_thread=True):
+        """
+        Save a sharded checkpoint directory, see checkpoint_writer.py.
+        use_thread: return once the state is copied to cpu and write it in the
+            background, wait_checkpoint() blocks until it is on disk
+        """
         if path is None:
             path = pathlib.Path(self.output_dir).joinpath('checkpoints', f'{tag}.ckpt')
         else:
@@ -46,32 +52,27 @@ class BaseWorkspace:
             include_keys = tuple(self.include_keys) + ('_output_dir',)
 
         path.parent.mkdir(parents=False, exist_ok=True)
-        payload = {
-            'cfg': self.cfg,
-            'state_dicts': dict(),
-            'pickles': dict()
-        } 
+        state_dicts = dict()
+        pickles = dict()
 
         for key, value in self.__dict__.items():
             if hasattr(value, 'state_dict') and hasattr(value, 'load_state_dict'):
                 # modules, optimizers and samplers etc
                 if key not in exclude_keys:
-                    if use_thread:
-                        payload['state_dicts'][key] = _copy_to_cpu(value.state_dict())
-                    else:
-                        payload['state_dicts'][key] = value.state_dict()
+                    state_dicts[key] = value.state_dict()
             elif key in include_keys:
-                payload['pickles'][key] = dill.dumps(value)
-        if use_thread:
-            self._saving_thread = threading.Thread(
-                target=lambda : torch.save(payload, path.open('wb'), pickle_module=dill))
-            self._saving_thread.start()
-        else:
-            torch.save(payload, path.open('wb'), pickle_module=dill)
-        
-        del payload
-        torch.cuda.empty_cache()
+                pickles[key] = dill.dumps(value)
+
+        if self._checkpoint_writer is None:
+            self._checkpoint_writer = CheckpointWriter(shard_depth=self.checkpoint_shard_depth)
+        self._checkpoint_writer.save(path, cfg=self.cfg,
+            state_dicts=state_dicts, pickles=pickles, block=not use_thread)
         return str(path.absolute())
+
+    def wait_checkpoint(self):
+        """Block until all checkpoints saved with use_thread are on disk."""
+        if self._checkpoint_writer is not None:
+            self._checkpoint_writer.wait()
     
     def get_checkpoint_path(self, tag='latest'):
         if tag=='latest':
@@ -117,7 +118,9 @@ class BaseWorkspace:
             path = self.get_checkpoint_path(tag=tag)
         else:
             path = pathlib.Path(path)
-        payload = torch.load(path.open('rb'), pickle_module=dill, map_location='cpu')
+        # the checkpoint may still be in the writer's queue
+        self.wait_checkpoint()
+        payload = load_payload(path, map_location='cpu')
         self.load_payload(payload, 
             exclude_keys=exclude_keys, 
             include_keys=include_keys)
@@ -128,7 +131,7 @@ class BaseWorkspace:
             exclude_keys=None, 
             include_keys=None,
             **kwargs):
-        payload = torch.load(open(path, 'rb'), pickle_module=dill)
+        payload = load_payload(path)
         instance = cls(payload['cfg'])
         instance.load_payload(
             payload=payload, 
@@ -149,20 +152,13 @@ class BaseWorkspace:
         torch.save(self, path.open('wb'), pickle_module=dill)
         return str(path.absolute())
     
+    def __getstate__(self):
+        # the writer thread can not be pickled into snapshots
+        state = self.__dict__.copy()
+        state['_checkpoint_writer'] = None
+        return state
+
     @classmethod
     def create_from_snapshot(cls, path):
         return torch.load(open(path, 'rb'), pickle_module=dill)
 
-
-def _copy_to_cpu(x):
-    if isinstance(x, torch.Tensor):
-        return x.detach().to('cpu')
-    elif isinstance(x, dict):
-        result = dict()
-        for k, v in x.items():
-            result[k] = _copy_to_cpu(v)
-        return result
-    elif isinstance(x, list):
-        return [_copy_to_cpu(k) for k in x]
-    else:
-        return copy.deepcopy(x)
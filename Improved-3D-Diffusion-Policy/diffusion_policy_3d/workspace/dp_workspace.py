@@ -16,6 +16,7 @@ from torch.utils.data import DataLoader
 import copy
 import random
 import time
+import contextlib
 import wandb
 import tqdm
 import numpy as np
@@ -26,9 +27,10 @@ from diffusion_policy_3d.policy.diffusion_image_policy import DiffusionImagePoli
 from diffusion_policy_3d.dataset.base_dataset import BaseImageDataset
 from diffusion_policy_3d.common.checkpoint_util import TopKCheckpointManager
 from diffusion_policy_3d.common.json_logger import JsonLogger
-from diffusion_policy_3d.common.pytorch_util import dict_apply, optimizer_to
+from diffusion_policy_3d.common.pytorch_util import dict_apply, optimizer_to, create_dataloader
 from diffusion_policy_3d.model.diffusion.ema_model import EMAModel
 from diffusion_policy_3d.model.common.lr_scheduler import get_scheduler
+import diffusion_policy_3d.common.dist_util as dist_util
 
 OmegaConf.register_new_resolver("eval", eval, replace=True)
 
@@ -61,10 +63,17 @@ class DPWorkspace(BaseWorkspace):
 
     def run(self):
         cfg = copy.deepcopy(self.cfg)
+        # distributed data parallel when launched with torchrun, see dist_util
+        dist_cfg = cfg.get('distributed', None)
+        device = dist_util.init_distributed(cfg.training.device,
+            backend=None if dist_cfg is None else dist_cfg.backend)
+        is_main = dist_util.is_main_process()
+        # all ranks resume from and save to the output dir of rank 0
+        self._output_dir = dist_util.broadcast_object(self.output_dir)
         # resume training
         if cfg.training.resume:
             lastest_ckpt_path = self.get_checkpoint_path()
-            if lastest_ckpt_path.is_file():
+            if lastest_ckpt_path.exists():
                 print(f"Resuming from checkpoint {lastest_ckpt_path}")
                 self.load_checkpoint(path=lastest_ckpt_path)
 
@@ -73,12 +82,20 @@ class DPWorkspace(BaseWorkspace):
         dataset = hydra.utils.instantiate(cfg.task.dataset)
         # dataset element: {'obs', 'action'}
         # obs: {'image': (16,3,96,96) with range [0,1],  'agent_pos': (16,2)}
-        train_dataloader = DataLoader(dataset, **cfg.dataloader)
+        # every rank gets its own shard of the SequenceSampler indices, batch_size is per rank
+        train_sampler = None
+        if dist_util.is_distributed():
+            train_sampler = torch.utils.data.DistributedSampler(dataset,
+                shuffle=cfg.dataloader.shuffle, seed=cfg.training.seed)
+        train_dataloader = create_dataloader(dataset, sampler=train_sampler, **cfg.dataloader)
         normalizer = dataset.get_normalizer()
 
         # configure validation dataset
         val_dataset = dataset.get_validation_dataset()
-        val_dataloader = DataLoader(val_dataset, **cfg.val_dataloader)
+        val_sampler = None
+        if dist_util.is_distributed():
+            val_sampler = torch.utils.data.DistributedSampler(val_dataset, shuffle=False)
+        val_dataloader = create_dataloader(val_dataset, sampler=val_sampler, **cfg.val_dataloader)
 
         self.model.set_normalizer(normalizer)
         if cfg.training.use_ema:
@@ -110,11 +127,14 @@ class DPWorkspace(BaseWorkspace):
         cprint(f"[WandB] group: {cfg.logging.group}", "yellow")
         cprint(f"[WandB] name: {cfg.logging.name}", "yellow")
         cprint("-----------------------------", "yellow")
-        # configure logging
+        # configure logging, only rank 0 logs and saves checkpoints
+        logging_cfg = OmegaConf.to_container(cfg.logging, resolve=True)
+        if not is_main:
+            logging_cfg['mode'] = 'disabled'
         wandb_run = wandb.init(
             dir=str(self.output_dir),
             config=OmegaConf.to_container(cfg, resolve=True),
-            **cfg.logging
+            **logging_cfg
         )
         wandb.config.update(
             {
@@ -129,11 +149,17 @@ class DPWorkspace(BaseWorkspace):
         )
 
         # device transfer
-        device = torch.device(cfg.training.device)
         self.model.to(device)
         if self.ema_model is not None:
             self.ema_model.to(device)
+            # identical ema on every rank, the model itself is synced by DDP
+            dist_util.broadcast_module(self.ema_model)
+            if ema is not None:
+                ema.offload_()
         optimizer_to(self.optimizer, device)
+        # forward(batch) -> compute_loss(batch), gradients are all-reduced in backward
+        train_model = dist_util.wrap_ddp(self.model, device,
+            find_unused_parameters=False if dist_cfg is None else dist_cfg.find_unused_parameters)
 
         # save batch for sampling
         train_sampling_batch = None
@@ -155,9 +181,11 @@ class DPWorkspace(BaseWorkspace):
         
         # training loop
         log_path = os.path.join(self.output_dir, 'logs.json.txt')
-        with JsonLogger(log_path) as json_logger:
-            for local_epoch_idx in tqdm.tqdm(range(cfg.training.num_epochs)):
+        with JsonLogger(log_path) if is_main else contextlib.nullcontext() as json_logger:
+            for local_epoch_idx in tqdm.tqdm(range(cfg.training.num_epochs), disable=not is_main):
                 step_log = dict()
+                if train_sampler is not None:
+                    train_sampler.set_epoch(self.epoch)
                 # ========= train for this epoch ==========
                 train_losses = list()
                 for batch_idx, batch in enumerate(train_dataloader):
@@ -167,12 +195,16 @@ class DPWorkspace(BaseWorkspace):
                     if train_sampling_batch is None:
                         train_sampling_batch = batch
                     # compute loss
-                    raw_loss = self.model.compute_loss(batch)
-                    loss = raw_loss / cfg.training.gradient_accumulate_every
-                    loss.backward()
+                    # gradients are only all-reduced on steps that update the weights
+                    is_update_step = self.global_step % cfg.training.gradient_accumulate_every == 0
+                    with contextlib.nullcontext() if is_update_step or not dist_util.is_distributed() \
+                            else train_model.no_sync():
+                        raw_loss = train_model(batch)
+                        loss = raw_loss / cfg.training.gradient_accumulate_every
+                        loss.backward()
 
                     # step optimizer
-                    if self.global_step % cfg.training.gradient_accumulate_every == 0:
+                    if is_update_step:
                         self.optimizer.step()
                         self.optimizer.zero_grad()
                         lr_scheduler.step()
@@ -199,7 +231,8 @@ class DPWorkspace(BaseWorkspace):
                     if not is_last_batch:
                         # log of last step is combined with validation and rollout
                         wandb_run.log(step_log, step=self.global_step)
-                        json_logger.log(step_log)
+                        if is_main:
+                            json_logger.log(step_log)
                         self.global_step += 1
 
                     if (cfg.training.max_train_steps is not None) \
@@ -208,13 +241,15 @@ class DPWorkspace(BaseWorkspace):
 
                 # at the end of each epoch
                 # replace train_loss with epoch average
-                train_loss = np.mean(train_losses)
+                train_loss = dist_util.all_reduce_mean(np.mean(train_losses), device=device)
                 step_log['train_loss'] = train_loss
 
                 # ========= eval for this epoch ==========
                 policy = self.model
                 if cfg.training.use_ema:
                     policy = self.ema_model
+                    # an offloaded ema copy is evaluated on the training device
+                    policy.to(device)
                 policy.eval()
 
               
@@ -231,7 +266,8 @@ class DPWorkspace(BaseWorkspace):
                                 and batch_idx >= (cfg.training.max_val_steps-1):
                                 break
                         if len(val_losses) > 0:
-                            val_loss = torch.mean(torch.tensor(val_losses)).item()
+                            # every rank validates its own shard of the val split
+                            val_loss = dist_util.all_reduce_mean(torch.stack(val_losses).mean()).item()
                             # log epoch average validation loss
                             step_log['val_loss'] = val_loss
 
@@ -259,7 +295,7 @@ class DPWorkspace(BaseWorkspace):
                     
                     
                 # checkpoint
-                if (self.epoch % cfg.training.checkpoint_every) == 0 and cfg.checkpoint.save_ckpt:
+                if (self.epoch % cfg.training.checkpoint_every) == 0 and cfg.checkpoint.save_ckpt and is_main:
                     # checkpointing
                     if cfg.checkpoint.save_last_ckpt:
                         self.save_checkpoint()
@@ -281,22 +317,30 @@ class DPWorkspace(BaseWorkspace):
                         self.save_checkpoint(path=topk_ckpt_path)
                 # ========= eval end for this epoch ==========
                 policy.train()
+                if ema is not None:
+                    ema.offload_()
 
                 # end of epoch
                 # log of last step is combined with validation and rollout
                 wandb_run.log(step_log, step=self.global_step)
-                json_logger.log(step_log)
+                if is_main:
+                    json_logger.log(step_log)
                 self.global_step += 1
                 self.epoch += 1
 
+        # checkpoints still being written in the background
+        self.wait_checkpoint()
         # stop wandb run
         wandb_run.finish()
+        # DDP has to be released before its process group
+        del train_model
+        dist_util.cleanup()
     def eval(self):
         # load the latest checkpoint
         cfg = copy.deepcopy(self.cfg)
         
         lastest_ckpt_path = self.get_checkpoint_path()
-        if lastest_ckpt_path.is_file():
+        if lastest_ckpt_path.exists():
             cprint(f"Resuming from checkpoint {lastest_ckpt_path}", 'magenta')
             self.load_checkpoint(path=lastest_ckpt_path)
         
@@ -321,7 +365,7 @@ class DPWorkspace(BaseWorkspace):
         # tag = "best"
         lastest_ckpt_path = self.get_checkpoint_path(tag=tag)
         
-        if lastest_ckpt_path.is_file():
+        if lastest_ckpt_path.exists():
             cprint(f"Resuming from checkpoint {lastest_ckpt_path}", 'magenta')
             self.load_checkpoint(path=lastest_ckpt_path)
         lastest_ckpt_path = str(lastest_ckpt_path)
@@ -374,7 +418,7 @@ class DPWorkspace(BaseWorkspace):
         cprint(f"FPS for original policy: {infer_times/(time.time()-t0):.3f}", 'green')
 
         
-    def get_model(self, ckpt_path=None):
+    def get_model(self, ckpt_path=None, device='cuda'):
         cfg = copy.deepcopy(self.cfg)
         
         if ckpt_path is None:
@@ -382,11 +426,11 @@ class DPWorkspace(BaseWorkspace):
             # tag = "best"
             lastest_ckpt_path = self.get_checkpoint_path(tag=tag)
             
-            if lastest_ckpt_path.is_file():
+            if lastest_ckpt_path.exists():
                 cprint(f"Resuming from checkpoint {lastest_ckpt_path}", 'magenta')
                 self.load_checkpoint(path=lastest_ckpt_path)
         else:
-            if ckpt_path.is_file():
+            if ckpt_path.exists():
                 cprint(f"Resuming from checkpoint {ckpt_path}", 'magenta')
                 self.load_checkpoint(path=ckpt_path)
             else:
@@ -396,7 +440,7 @@ class DPWorkspace(BaseWorkspace):
         if cfg.training.use_ema:
             policy = self.ema_model    
         # policy.eval()
-        device = torch.device('cuda')
+        device = torch.device(device)
         policy.to(device)
         policy.eval()
 
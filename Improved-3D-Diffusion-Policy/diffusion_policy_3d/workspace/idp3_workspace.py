@@ -20,19 +20,25 @@ import tqdm
 import numpy as np
 from termcolor import cprint
 import shutil
-import time
+import contextlib
 from diffusion_policy_3d.workspace.base_workspace import BaseWorkspace
 from diffusion_policy_3d.policy.diffusion_pointcloud_policy import DiffusionPointcloudPolicy
 from diffusion_policy_3d.common.checkpoint_util import TopKCheckpointManager
 from diffusion_policy_3d.common.json_logger import JsonLogger
-from diffusion_policy_3d.common.pytorch_util import dict_apply, optimizer_to
+from diffusion_policy_3d.common.inference_policy import save_inference_policy
+from diffusion_policy_3d.common.policy_evaluator import PolicyEvaluator
+from diffusion_policy_3d.common.metrics_logger import MetricsAggregator, to_float_dict
+from diffusion_policy_3d.common.step_profiler import StepProfiler
+from diffusion_policy_3d.common.pytorch_util import dict_apply, optimizer_to, create_dataloader
 from diffusion_policy_3d.model.diffusion.ema_model import EMAModel
 from diffusion_policy_3d.model.common.lr_scheduler import get_scheduler
+from diffusion_policy_3d.model.vision_3d.point_augmentation import PointCloudPreprocessor
+import diffusion_policy_3d.common.dist_util as dist_util
 
 OmegaConf.register_new_resolver("eval", eval, replace=True)
 
 class iDP3Workspace(BaseWorkspace):
-    include_keys = ['global_step', 'epoch']
+    include_keys = ['global_step', 'epoch', 'precision']
 
     def __init__(self, cfg: OmegaConf, output_dir=None):
         super().__init__(cfg, output_dir=output_dir)
@@ -46,6 +52,8 @@ class iDP3Workspace(BaseWorkspace):
 
         # configure model
         self.model: DiffusionPointcloudPolicy = hydra.utils.instantiate(cfg.policy)
+        # saved with the checkpoint, get_model serves in the precision the policy was trained in
+        self.precision = self.model.precision
 
         self.ema_model: DiffusionPointcloudPolicy = None
         if cfg.training.use_ema:
@@ -82,22 +90,39 @@ class iDP3Workspace(BaseWorkspace):
             RUN_CKPT = True
             verbose = False
         
+        # distributed data parallel when launched with torchrun, see dist_util
+        dist_cfg = cfg.get('distributed', None)
+        device = dist_util.init_distributed(cfg.training.device,
+            backend=None if dist_cfg is None else dist_cfg.backend)
+        is_main = dist_util.is_main_process()
+        # all ranks resume from and save to the output dir of rank 0
+        self._output_dir = dist_util.broadcast_object(self.output_dir)
         
         # resume training
         if cfg.training.resume:
             lastest_ckpt_path = self.get_checkpoint_path()
-            if lastest_ckpt_path.is_file():
+            if lastest_ckpt_path.exists():
                 print(f"Resuming from checkpoint {lastest_ckpt_path}")
                 self.load_checkpoint(path=lastest_ckpt_path)
+        # the configured precision wins over the one of the resumed checkpoint
+        self.precision = self.model.precision
 
         # configure dataset
         dataset = hydra.utils.instantiate(cfg.task.dataset)
-        train_dataloader = DataLoader(dataset, **cfg.dataloader)
+        # every rank gets its own shard of the SequenceSampler indices, batch_size is per rank
+        train_sampler = None
+        if dist_util.is_distributed():
+            train_sampler = torch.utils.data.DistributedSampler(dataset,
+                shuffle=cfg.dataloader.shuffle, seed=cfg.training.seed)
+        dataloader_cfg = OmegaConf.to_container(cfg.dataloader, resolve=True)
+        if self.model.use_compile:
+            # static batch shape, a smaller last batch would compile the policy a second time
+            dataloader_cfg['drop_last'] = True
+        train_dataloader = create_dataloader(dataset, sampler=train_sampler, **dataloader_cfg)
         normalizer = dataset.get_normalizer()
 
-        # configure validation dataset
+        # configure validation dataset, evaluated through PolicyEvaluator
         val_dataset = dataset.get_validation_dataset()
-        val_dataloader = DataLoader(val_dataset, **cfg.val_dataloader)
 
         self.model.set_normalizer(normalizer)
         if cfg.training.use_ema:
@@ -130,17 +155,25 @@ class iDP3Workspace(BaseWorkspace):
         cprint(f"[WandB] group: {cfg.logging.group}", "yellow")
         cprint(f"[WandB] name: {cfg.logging.name}", "yellow")
         cprint("-----------------------------", "yellow")
-        # configure logging
-        wandb_run = wandb.init(
-            dir=str(self.output_dir),
-            config=OmegaConf.to_container(cfg, resolve=True),
-            **cfg.logging
-        )
-        wandb.config.update(
-            {
-                "output_dir": self.output_dir,
-            }
-        )
+        # configure logging, only rank 0 logs and saves checkpoints
+        metrics_cfg = cfg.get('metrics', None)
+        # offline runs never initialize wandb, metrics only go to logs.json.txt
+        offline = metrics_cfg is not None and metrics_cfg.offline
+        wandb_run = None
+        if not offline:
+            logging_cfg = OmegaConf.to_container(cfg.logging, resolve=True)
+            if not is_main:
+                logging_cfg['mode'] = 'disabled'
+            wandb_run = wandb.init(
+                dir=str(self.output_dir),
+                config=OmegaConf.to_container(cfg, resolve=True),
+                **logging_cfg
+            )
+            wandb.config.update(
+                {
+                    "output_dir": self.output_dir,
+                }
+            )
 
         # configure checkpoint
         topk_manager = TopKCheckpointManager(
@@ -149,11 +182,59 @@ class iDP3Workspace(BaseWorkspace):
         )
 
         # device transfer
-        device = torch.device(cfg.training.device)
         self.model.to(device)
         if self.ema_model is not None:
             self.ema_model.to(device)
+            # identical ema on every rank, the model itself is synced by DDP
+            dist_util.broadcast_module(self.ema_model)
+            if ema is not None:
+                ema.offload_()
         optimizer_to(self.optimizer, device)
+        # loss scaling against fp16 gradient underflow, a no-op for fp32 and bf16
+        grad_scaler = torch.cuda.amp.GradScaler(
+            enabled=self.precision == 'fp16' and device.type == 'cuda')
+        # forward(batch) -> compute_loss(batch), gradients are all-reduced in backward
+        train_model = dist_util.wrap_ddp(self.model, device,
+            find_unused_parameters=False if dist_cfg is None else dist_cfg.find_unused_parameters)
+
+        # on-device point cloud subsampling / augmentation after the host->device copy
+        point_preprocessor = None
+        if cfg.get('point_preprocess', None) is not None and cfg.point_preprocess.enable:
+            preprocess_kwargs = OmegaConf.to_container(cfg.point_preprocess, resolve=True)
+            preprocess_kwargs.pop('enable')
+            point_preprocessor = PointCloudPreprocessor(**preprocess_kwargs)
+            cprint(f"[PointCloudPreprocessor] {preprocess_kwargs}", "yellow")
+
+        # action prediction error on a fixed subset of the validation split
+        # (of the training split without one), see the evaluation block of the config
+        eval_cfg = cfg.get('evaluation', None)
+        evaluator = PolicyEvaluator(val_dataset, fallback_dataset=dataset,
+            n_samples=256 if eval_cfg is None else eval_cfg.n_samples,
+            batch_size=cfg.val_dataloader.batch_size if eval_cfg is None else eval_cfg.batch_size,
+            max_steps=cfg.training.max_val_steps,
+            seed=cfg.training.seed,
+            device=device,
+            point_preprocessor=point_preprocessor,
+            background=eval_cfg is not None and eval_cfg.background)
+
+        # per-phase step timing with cuda events, reported every report_every steps
+        # (every step in debug mode) and optionally a torch.profiler trace
+        profiling_cfg = cfg.get('profiling', None)
+        profiler = StepProfiler(device=device,
+            enabled=verbose or profiling_cfg is None or profiling_cfg.enable,
+            report_every=1 if verbose or profiling_cfg is None else profiling_cfg.report_every,
+            trace_steps=0 if profiling_cfg is None else profiling_cfg.trace_steps,
+            trace_skip_steps=10 if profiling_cfg is None else profiling_cfg.trace_skip_steps,
+            trace_dir=os.path.join(self.output_dir, 'profile'),
+            rank=dist_util.get_rank())
+
+        # top-k of background evaluations: the weights are saved when they are submitted
+        # and ranked once their score arrives, see _rank_evaluated_checkpoint
+        rank_background_eval = evaluator.background and is_main \
+            and cfg.checkpoint.save_ckpt and topk_manager.k > 0
+        pending_ckpt_path = os.path.join(self.output_dir, 'checkpoints', 'eval_pending.ckpt')
+        pending_log = None
+        profile_log = None
 
         # save batch for sampling
         train_sampling_batch = None
@@ -161,61 +242,75 @@ class iDP3Workspace(BaseWorkspace):
 
         # training loop
         log_path = os.path.join(self.output_dir, 'logs.json.txt')
-        with JsonLogger(log_path) as json_logger:
-            for local_epoch_idx in tqdm.tqdm(range(cfg.training.num_epochs), desc=f"Training"):
+        with JsonLogger(log_path) if is_main else contextlib.nullcontext() as json_logger:
+            # per-step metrics are averaged on the device and written in the background
+            metrics = MetricsAggregator(wandb_run=wandb_run, json_logger=json_logger,
+                flush_every=50 if metrics_cfg is None else metrics_cfg.flush_every,
+                flush_interval=10.0 if metrics_cfg is None else metrics_cfg.flush_interval,
+                enabled=is_main)
+            for local_epoch_idx in tqdm.tqdm(range(cfg.training.num_epochs), desc=f"Training", disable=not is_main):
                 step_log = dict()
+                if train_sampler is not None:
+                    train_sampler.set_epoch(self.epoch)
                 # ========= train for this epoch ==========
-                train_losses = list()
+                train_loss_sum = torch.zeros((), device=device)
+                n_train_steps = 0
+                profiler.epoch_begin()
                 for batch_idx, batch in enumerate(train_dataloader):
-                    t1 = time.time()
+                    profiler.step_begin(batch_size=len(batch['action']))
                     # device transfer
                     batch = dict_apply(batch, lambda x: x.to(device, non_blocking=True) if isinstance(x, torch.Tensor) else x)
+                    if point_preprocessor is not None:
+                        batch['obs'] = point_preprocessor(batch['obs'])
                     if train_sampling_batch is None:
                         train_sampling_batch = batch
+                    profiler.mark('h2d')
                 
                     # compute loss
-                    t1_1 = time.time()
-                    raw_loss, loss_dict = self.model.compute_loss(batch)
-                    loss = raw_loss / cfg.training.gradient_accumulate_every
-                    loss.backward()
-                    
-                    t1_2 = time.time()
+                    # gradients are only all-reduced on steps that update the weights
+                    is_update_step = self.global_step % cfg.training.gradient_accumulate_every == 0
+                    with contextlib.nullcontext() if is_update_step or not dist_util.is_distributed() \
+                            else train_model.no_sync():
+                        raw_loss, loss_dict = train_model(batch)
+                        loss = raw_loss / cfg.training.gradient_accumulate_every
+                        profiler.mark('forward')
+                        grad_scaler.scale(loss).backward()
+                        profiler.mark('backward')
 
                     # step optimizer
-                    if self.global_step % cfg.training.gradient_accumulate_every == 0:
-                        self.optimizer.step()
+                    if is_update_step:
+                        grad_scaler.step(self.optimizer)
+                        grad_scaler.update()
                         self.optimizer.zero_grad()
                         lr_scheduler.step()
-                    t1_3 = time.time()
+                    profiler.mark('optimizer')
                     # update ema
                     if cfg.training.use_ema:
                         ema.step(self.model)
-                    t1_4 = time.time()
-                    # logging
-                    raw_loss_cpu = raw_loss.item()
-                    train_losses.append(raw_loss_cpu)
+                    profiler.mark('ema')
+                    # logging, the loss stays on the device
+                    train_loss_sum += raw_loss.detach()
+                    n_train_steps += 1
                     step_log = {
-                        'train_loss': raw_loss_cpu,
+                        'train_loss': raw_loss.detach(),
                         'global_step': self.global_step,
                         'epoch': self.epoch,
                         'lr': lr_scheduler.get_last_lr()[0]
                     }
-                    t1_5 = time.time()
                     step_log.update(loss_dict)
-                    t2 = time.time()
-                    
-                    if verbose:
-                        print(f"total one step time: {t2-t1:.3f}")
-                        print(f" compute loss time: {t1_2-t1_1:.3f}")
-                        print(f" step optimizer time: {t1_3-t1_2:.3f}")
-                        print(f" update ema time: {t1_4-t1_3:.3f}")
-                        print(f" logging time: {t1_5-t1_4:.3f}")
 
                     is_last_batch = (batch_idx == (len(train_dataloader)-1))
                     if not is_last_batch:
                         # log of last step is combined with validation and rollout
-                        wandb_run.log(step_log, step=self.global_step)
-                        json_logger.log(step_log)
+                        metrics.add(step_log, step=self.global_step)
+                    if profile_log is not None:
+                        # report of the previous window, part of this step's logging phase
+                        metrics.log(profile_log, step=self.global_step)
+                        if verbose:
+                            cprint(f"[StepProfiler] {StepProfiler.format(profile_log)}", "yellow")
+                    profiler.mark('logging')
+                    profile_log = profiler.step_end()
+                    if not is_last_batch:
                         self.global_step += 1
 
                     if (cfg.training.max_train_steps is not None) \
@@ -223,44 +318,50 @@ class iDP3Workspace(BaseWorkspace):
                         break
 
                 # at the end of each epoch
+                # steps of an unfinished report window
+                for log in (profile_log, profiler.report()):
+                    if log is not None:
+                        metrics.log(log, step=self.global_step)
+                profile_log = None
                 # replace train_loss with epoch average
-                train_loss = np.mean(train_losses)
+                train_loss = dist_util.all_reduce_mean(train_loss_sum / max(n_train_steps, 1))
                 step_log['train_loss'] = train_loss
+                step_log = to_float_dict(step_log)
 
                 # ========= eval for this epoch ==========
                 policy = self.model
                 if cfg.training.use_ema:
                     policy = self.ema_model
+                    # an offloaded ema copy is evaluated on the training device
+                    policy.to(device)
                 policy.eval()
                 
                     
                 # run validation
+                if evaluator.background:
+                    # result of an earlier epoch, collected before the next submit
+                    eval_log = evaluator.poll()
+                    if eval_log is not None:
+                        step_log.update(eval_log)
+                        cprint(f"val loss (epoch {eval_log['eval_epoch']}): {-eval_log['test_mean_score']:.7f}", "cyan")
+                        if pending_log is not None:
+                            self._rank_evaluated_checkpoint(topk_manager, pending_ckpt_path,
+                                {**pending_log, **eval_log})
+                            pending_log = None
                 if (self.epoch % cfg.training.val_every) == 0:
-                    with torch.no_grad():                        
-                        train_losses = list()
-                        
-                        for batch_idx, batch in enumerate(train_dataloader):
-                            batch = dict_apply(batch, lambda x: x.to(device, non_blocking=True) if isinstance(x, torch.Tensor) else x)
-                            obs_dict = batch['obs']
-                            gt_action = batch['action']
-
-                            result = policy.predict_action(obs_dict)
-                            pred_action = result['action_pred']
-                            mse = torch.nn.functional.mse_loss(pred_action, gt_action)
-                            train_losses.append(mse.item())
-                            
-                            if (cfg.training.max_train_steps is not None) \
-                                and batch_idx >= (cfg.training.max_train_steps-1):
-                                break
-                        train_loss = np.sum(train_losses)
-                        # log epoch average validation loss
-                        step_log['train_action_mse_error'] = train_loss
-                        step_log['test_mean_score'] = - step_log['train_action_mse_error']
-                        cprint(f"val loss: {train_loss:.7f}", "cyan")
+                    if evaluator.background:
+                        # the result is logged at the end of a later epoch
+                        if evaluator.submit(policy, epoch=self.epoch) and rank_background_eval:
+                            pending_log = dict(step_log)
+                            self.save_checkpoint(path=pending_ckpt_path)
+                    else:
+                        eval_log = evaluator.evaluate(policy)
+                        step_log.update(eval_log)
+                        cprint(f"val loss: {-eval_log['test_mean_score']:.7f}", "cyan")
 
 
                 # checkpoint
-                if (self.epoch % cfg.training.checkpoint_every) == 0 and cfg.checkpoint.save_ckpt:
+                if (self.epoch % cfg.training.checkpoint_every) == 0 and cfg.checkpoint.save_ckpt and is_main:
                     # checkpointing
                     if cfg.checkpoint.save_last_ckpt:
                         self.save_checkpoint()
@@ -276,34 +377,72 @@ class iDP3Workspace(BaseWorkspace):
                     # We can't copy the last checkpoint here
                     # since save_checkpoint uses threads.
                     # therefore at this point the file might have been empty!
-                    topk_ckpt_path = topk_manager.get_ckpt_path(metric_dict)
+                    # background evaluations are ranked with the weights they evaluated (above)
+                    topk_ckpt_path = None
+                    if not evaluator.background and topk_manager.monitor_key in metric_dict:
+                        topk_ckpt_path = topk_manager.get_ckpt_path(metric_dict)
 
                     if topk_ckpt_path is not None:
                         self.save_checkpoint(path=topk_ckpt_path)
                     cprint("checkpoint saved.", "green")
                 # ========= eval end for this epoch ==========
                 policy.train()
+                if ema is not None:
+                    ema.offload_()
 
                 # end of epoch
                 # log of last step is combined with validation and rollout
-                wandb_run.log(step_log, step=self.global_step)
-                json_logger.log(step_log)
+                metrics.log(step_log, step=self.global_step)
                 
                 self.global_step += 1
                 self.epoch += 1
                 del step_log
-
+            # the last background evaluation is logged before the metrics writer stops
+            eval_log = evaluator.wait()
+            if eval_log is not None:
+                cprint(f"val loss (epoch {eval_log['eval_epoch']}): {-eval_log['test_mean_score']:.7f}", "cyan")
+                if pending_log is not None:
+                    self._rank_evaluated_checkpoint(topk_manager, pending_ckpt_path,
+                        {**pending_log, **eval_log})
+                metrics.log(eval_log, step=self.global_step)
+            # the writer uses the json logger, it is drained before the file is closed
+            metrics.close()
+            profiler.close()
+
+        # checkpoints still being written in the background
+        self.wait_checkpoint()
         # stop wandb run
-        wandb_run.finish()
+        if wandb_run is not None:
+            wandb_run.finish()
+        # DDP has to be released before its process group
+        del train_model
+        dist_util.cleanup()
     
-    def get_model(self):
+    def _rank_evaluated_checkpoint(self, topk_manager, ckpt_path, log):
+        """
+        Top-k of a background evaluation: ckpt_path holds the weights that were
+        evaluated and is moved to its top-k path, or deleted.
+        """
+        metric_dict = {key.replace('/', '_'): value for key, value in log.items()}
+        # the snapshot may still be written in the background
+        self.wait_checkpoint()
+        topk_ckpt_path = topk_manager.get_ckpt_path(metric_dict)
+        if topk_ckpt_path is None:
+            shutil.rmtree(ckpt_path, ignore_errors=True)
+            return
+        if os.path.exists(topk_ckpt_path):
+            shutil.rmtree(topk_ckpt_path)
+        os.replace(ckpt_path, topk_ckpt_path)
+        cprint(f"checkpoint of epoch {log['epoch']} saved as {topk_ckpt_path}", "green")
+
+    def get_model(self, device='cuda'):
         cfg = copy.deepcopy(self.cfg)
         
         tag = "latest"
         # tag = "best"
         lastest_ckpt_path = self.get_checkpoint_path(tag=tag)
         
-        if lastest_ckpt_path.is_file():
+        if lastest_ckpt_path.exists():
             cprint(f"Resuming from checkpoint {lastest_ckpt_path}", 'magenta')
             self.load_checkpoint(path=lastest_ckpt_path)
         lastest_ckpt_path = str(lastest_ckpt_path)
@@ -311,12 +450,31 @@ class iDP3Workspace(BaseWorkspace):
         policy = self.model
         if cfg.training.use_ema:
             policy = self.ema_model    
+        policy.set_precision(self.precision)
+        cprint(f"Serving in {self.precision}", 'magenta')
     
-        device = torch.device('cuda')
+        device = torch.device(device)
         policy.to(device)
         policy.eval()
         return policy
 
+
+    def export_inference_policy(self, path=None, tag='latest'):
+        """
+        Write the served policy of a training checkpoint as an inference artifact,
+        see load_inference_policy. Default path: checkpoints/<tag>_inference.pt
+        """
+        ckpt_path = self.get_checkpoint_path(tag=tag)
+        if not ckpt_path.exists():
+            raise FileNotFoundError(f"Checkpoint not found: {ckpt_path}")
+        self.load_checkpoint(path=ckpt_path)
+        policy = self.model
+        if self.cfg.training.use_ema:
+            policy = self.ema_model
+        if path is None:
+            path = ckpt_path.parent.joinpath(f'{tag}_inference.pt')
+        return save_inference_policy(policy, self.cfg.policy, path, precision=self.precision)
+
         
 
 @hydra.main(
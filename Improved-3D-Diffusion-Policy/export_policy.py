@@ -0,0 +1,37 @@
+"""
+Usage:
+Export the served policy of a training run for infer.py:
+python export_policy.py --config-name=idp3 hydra.run.dir=<training run dir>
+
+Writes <training run dir>/checkpoints/latest_inference.pt (or inference.policy_path).
+"""
+import sys
+# use line-buffering for both stdout and stderr
+sys.stdout = open(sys.stdout.fileno(), mode='w', buffering=1)
+sys.stderr = open(sys.stderr.fileno(), mode='w', buffering=1)
+
+import pathlib
+import hydra
+from omegaconf import OmegaConf
+from diffusion_policy_3d.workspace.base_workspace import BaseWorkspace
+
+# allows arbitrary python code execution in configs using the ${eval:''} resolver
+OmegaConf.register_new_resolver("eval", eval, replace=True)
+
+
+@hydra.main(
+    version_base=None,
+    config_path=str(pathlib.Path(__file__).parent.joinpath(
+        'diffusion_policy_3d', 'config'))
+)
+def main(cfg: OmegaConf):
+    OmegaConf.resolve(cfg)
+    cls = hydra.utils.get_class(cfg._target_)
+    workspace: BaseWorkspace = cls(cfg)
+    infer_cfg = cfg.get('inference', None)
+    path = None if infer_cfg is None else infer_cfg.get('policy_path', None)
+    workspace.export_inference_policy(path=path)
+
+
+if __name__ == "__main__":
+    main()
@@ -8,29 +8,36 @@ import pathlib
 # from train import TrainDP3Workspace
 import numpy as np
 import random
-from diffusion_policy_3d.common.pytorch_util import dict_apply
+from diffusion_policy_3d.common.pytorch_util import dict_apply, PinnedBufferPool
 from diffusion_policy_3d.policy.base_policy import BasePolicy
 from diffusion_policy_3d.workspace.base_workspace import BaseWorkspace
+from diffusion_policy_3d.common.inference_policy import load_inference_policy
+from diffusion_policy_3d.common.checkpoint_writer import INDEX_FILE
+from hydra.core.hydra_config import HydraConfig
 import diffusion_policy_3d.common.rotation_util as rotation_util
 import time
+from collections import defaultdict
 from profiler import Dbg_Timer
-from network import ZMQResponseServer, ZMQResponseClient
+from network import ZMQResponseServer, ZMQResponseClient, ZMQBatchResponseServer
 
 
 OmegaConf.register_new_resolver("eval", eval, replace=True)
 cur_dir = os.path.dirname(os.path.abspath(__file__))
 
-def servo_infer(policy: BasePolicy):
+def servo_infer(policy: BasePolicy, host="0.0.0.0", port=18000):
     step_count = 0
     device = policy.device
     use_wrist = policy.use_wrist
     logger.info("user wrist {}", use_wrist)
-    zmq_server = ZMQResponseServer("0.0.0.0", 18000)
+    zmq_server = ZMQResponseServer(host, port)
     logger.info("init server done")
+    pinned_pool = PinnedBufferPool(device)
     while True:
         obs_dict = zmq_server.recv_request()
         logger.info(f'obs_dict{obs_dict}')
-        obs_dict = dict_apply(obs_dict, lambda x: torch.from_numpy(x).to(device=device))
+        # optional (To,) frame ids/timestamps, lets the policy reuse cached frame features
+        frame_id = obs_dict.pop('frame_id', None)
+        obs_dict = {key: pinned_pool.to_device(key, value) for key, value in obs_dict.items()}
         with torch.no_grad():
             # run mode info predict next action
             obs_dict_input = {}  # flush unused keys
@@ -43,7 +50,10 @@ def servo_infer(policy: BasePolicy):
             action_list = []
             try:
                 with Dbg_Timer(f"predict_one_action_{step_count}"):
-                    action_dict = policy.predict_action(obs_dict_input)
+                    if frame_id is None:
+                        action_dict = policy.predict_action(obs_dict_input)
+                    else:
+                        action_dict = policy.predict_action(obs_dict_input, frame_ids=frame_id[None])
             except Exception as e:
                 logger.exception(e)
             # device_transfer, move to cpu 
@@ -53,7 +63,88 @@ def servo_infer(policy: BasePolicy):
         obs_result = {"action": action_list}
         zmq_server.send_response(obs_result)
 
-        
+
+def _stack_requests(obs_dicts, use_wrist, pinned_pool: PinnedBufferPool):
+    """
+    Stack per-client obs dicts (To, ...) into one policy input batch (B, To, ...).
+    """
+    obs_dict_input = {}
+    obs_dict_input['point_cloud'] = np.stack([obs['point_cloud'] for obs in obs_dicts], axis=0)
+    if use_wrist:
+        obs_dict_input['wrist_point_cloud'] = np.stack([obs['wrist_point_cloud'] for obs in obs_dicts], axis=0)
+    obs_dict_input['agent_pos'] = np.stack([obs['state'] for obs in obs_dicts], axis=0)
+    return {key: pinned_pool.to_device(key, value) for key, value in obs_dict_input.items()}
+
+
+def _stack_frame_ids(identities, obs_dicts):
+    """
+    Per-client frame ids made unique across clients, None unless every client sent them.
+    """
+    if not all('frame_id' in obs for obs in obs_dicts):
+        return None
+    return [[(identity, frame_id) for frame_id in obs['frame_id'].tolist()]
+        for identity, obs in zip(identities, obs_dicts)]
+
+
+def servo_infer_batched(policy: BasePolicy, host="0.0.0.0", port=18000,
+        batch_window=0.005, max_batch_size=4):
+    """
+    Serve several robots at once: requests gathered within `batch_window` seconds
+    are coalesced into a single predict_action call and each client gets its own slice.
+    """
+    step_count = 0
+    device = policy.device
+    use_wrist = policy.use_wrist
+    logger.info("user wrist {}", use_wrist)
+    zmq_server = ZMQBatchResponseServer(host, port)
+    logger.info("init batch server done, window {}s, max batch {}", batch_window, max_batch_size)
+    pinned_pool = PinnedBufferPool(device)
+    while True:
+        requests = zmq_server.recv_requests(
+            batch_window=batch_window, max_batch_size=max_batch_size)
+
+        # requests can only be stacked if every array has the same shape
+        groups = defaultdict(list)
+        for identity, obs_dict in requests:
+            signature = tuple(sorted((k, np.shape(v)) for k, v in obs_dict.items()))
+            groups[signature].append((identity, obs_dict))
+
+        for group in groups.values():
+            identities = [identity for identity, _ in group]
+            try:
+                with torch.no_grad():
+                    obs_dicts = [obs_dict for _, obs_dict in group]
+                    obs_dict_input = _stack_requests(obs_dicts, use_wrist, pinned_pool)
+                    frame_ids = _stack_frame_ids(identities, obs_dicts)
+                    with Dbg_Timer(f"predict_batch_{step_count}_size_{len(group)}"):
+                        if frame_ids is None:
+                            action_dict = policy.predict_action(obs_dict_input)
+                        else:
+                            action_dict = policy.predict_action(obs_dict_input, frame_ids=frame_ids)
+                    actions = action_dict['action'].detach().to('cpu').numpy()
+            except Exception as e:
+                logger.exception(e)
+                for identity in identities:
+                    zmq_server.send_response(identity, {"action": None, "error": repr(e)})
+                continue
+            for i, identity in enumerate(identities):
+                zmq_server.send_response(identity, {"action": actions[i]})
+            logger.info("step {} served {} clients", step_count, len(identities))
+        step_count += 1
+
+
+def _is_stale_artifact(artifact_path, ckpt_path):
+    """
+    True if the training checkpoint was written after the artifact was exported.
+    The index of a sharded checkpoint is replaced on every save.
+    """
+    ckpt_path = pathlib.Path(ckpt_path)
+    if ckpt_path.is_dir():
+        ckpt_path = ckpt_path.joinpath(INDEX_FILE)
+    if not ckpt_path.exists():
+        return False
+    return ckpt_path.stat().st_mtime > pathlib.Path(artifact_path).stat().st_mtime
+
 
 @hydra.main(
     version_base=None,
@@ -63,12 +154,41 @@ def servo_infer(policy: BasePolicy):
 def main(cfg):
     OmegaConf.resolve(cfg)
     print(f'cfg {cfg}, type {type(cfg)}')
+    infer_cfg = cfg.get('inference', None)
     with Dbg_Timer("init policy"):
-        cls = hydra.utils.get_class(cfg._target_)
-        workspace: BaseWorkspace = cls(cfg)
-        policy = workspace.get_model()
+        # the exported artifact (export_policy.py) only builds the policy, the
+        # training checkpoint needs the whole workspace
+        policy_path = None if infer_cfg is None else infer_cfg.get('policy_path', None)
+        use_artifact = policy_path is not None
+        if policy_path is None:
+            ckpt_dir = pathlib.Path(HydraConfig.get().runtime.output_dir).joinpath('checkpoints')
+            policy_path = ckpt_dir.joinpath('latest_inference.pt')
+            use_artifact = policy_path.is_file()
+            # an artifact exported before training went on would serve an old policy
+            if use_artifact and _is_stale_artifact(policy_path, ckpt_dir.joinpath('latest.ckpt')):
+                logger.warning("{} is older than latest.ckpt, loading the training checkpoint "
+                    "(re-export with export_policy.py)", policy_path)
+                use_artifact = False
+        device = 'cuda' if infer_cfg is None else infer_cfg.get('device', 'cuda')
+        if use_artifact:
+            policy = load_inference_policy(policy_path, device=device,
+                mmap=infer_cfg is not None and infer_cfg.get('mmap', False))
+        else:
+            logger.info("no inference artifact at {}, loading the training checkpoint", policy_path)
+            cls = hydra.utils.get_class(cfg._target_)
+            workspace: BaseWorkspace = cls(cfg)
+            policy = workspace.get_model(device=device)
     with Dbg_Timer("run online_infer"):
-        servo_infer(policy)
+        if infer_cfg is not None and infer_cfg.max_batch_size > 1:
+            servo_infer_batched(policy,
+                host=infer_cfg.host,
+                port=infer_cfg.port,
+                batch_window=infer_cfg.batch_window_ms / 1000.0,
+                max_batch_size=infer_cfg.max_batch_size)
+        elif infer_cfg is not None:
+            servo_infer(policy, host=infer_cfg.host, port=infer_cfg.port)
+        else:
+            servo_infer(policy)
     
     
 if __name__ == '__main__':
@@ -8,7 +8,7 @@ import pathlib
 # from train import TrainDP3Workspace
 import numpy as np
 import random
-from diffusion_policy_3d.common.pytorch_util import dict_apply
+from diffusion_policy_3d.common.pytorch_util import dict_apply, PinnedBufferPool
 from diffusion_policy_3d.policy.base_policy import BasePolicy
 from diffusion_policy_3d.workspace.base_workspace import BaseWorkspace
 import diffusion_policy_3d.common.rotation_util as rotation_util
@@ -27,10 +27,11 @@ def servo_infer(policy: BasePolicy):
     logger.info("init server done")
     use_wrist = policy.use_wrist
     logger.info("user wrist {}", use_wrist)
+    pinned_pool = PinnedBufferPool(device)
     while True:
         obs_dict = zmq_server.recv_request()
         logger.info(f'obs_dict{obs_dict}')
-        obs_dict = dict_apply(obs_dict, lambda x: torch.from_numpy(x).to(device=device))
+        obs_dict = {key: pinned_pool.to_device(key, value) for key, value in obs_dict.items()}
         with torch.no_grad():
             # run mode info predict next action
             obs_dict_input = {}  # flush unused keys
@@ -3,14 +3,46 @@ import cv2
 import base64
 import numpy as np
 import pickle
+import json
 import blosc as bl
 import threading
+import time
 from loguru import logger
 
 IMAGE_TYPE_RGB = 'RGB'
 IMAGE_TYPE_DEPTH = 'Depth'
 IMAGE_TYPE_INTRINSICS = 'Intrinsics'
 
+# Request/response wire format: one json header frame describing every array
+# as (key, dtype, shape), followed by one raw buffer frame per array.
+# Non-array values (e.g. error strings) travel inside the header as json.
+def pack_array_dict(data):
+    header = {'arrays': [], 'meta': {}}
+    frames = []
+    for key, value in data.items():
+        if isinstance(value, np.ndarray):
+            if value.dtype.hasobject:
+                raise TypeError(f"Array {key} has object dtype and can not be sent")
+            value = np.ascontiguousarray(value)
+            header['arrays'].append({'key': key, 'dtype': value.dtype.str, 'shape': value.shape})
+            frames.append(value)
+        else:
+            header['meta'][key] = value
+    return [json.dumps(header).encode('utf-8')] + frames
+
+def unpack_array_dict(frames):
+    """
+    frames: zmq.Frame list from recv_multipart(copy=False).
+    The returned arrays are read-only views on the received buffers.
+    """
+    header = json.loads(bytes(frames[0].buffer))
+    if len(frames) - 1 != len(header['arrays']):
+        raise ValueError(f"Expected {len(header['arrays'])} buffers, got {len(frames) - 1}")
+    data = dict(header['meta'])
+    for desc, frame in zip(header['arrays'], frames[1:]):
+        data[desc['key']] = np.frombuffer(frame.buffer, dtype=np.dtype(desc['dtype'])).reshape(desc['shape'])
+    return data
+
 # ZMQ Sockets
 def create_push_socket(host, port):
     context = zmq.Context()
@@ -49,9 +81,9 @@ class ZMQResponseClient(object):
 
     def send_request(self, request):
         logger.info('Sending request {}', request)
-        self.socket.send(pickle.dumps(request, protocol=-1))
-        response = self.socket.recv()
-        return pickle.loads(response)
+        self.socket.send_multipart(pack_array_dict(request), copy=False)
+        response = self.socket.recv_multipart(copy=False)
+        return unpack_array_dict(response)
     
 
     def stop(self):
@@ -70,18 +102,63 @@ class ZMQResponseServer(object):
         self.socket.bind('tcp://{}:{}'.format(self._host, self._port))
 
     def recv_request(self):
-        raw_data = self.socket.recv()
-        return pickle.loads(raw_data)
+        frames = self.socket.recv_multipart(copy=False)
+        return unpack_array_dict(frames)
 
     def send_response(self, response):
         logger.info('Sending response {}', response)
-        self.socket.send(pickle.dumps(response, protocol=-1))
+        self.socket.send_multipart(pack_array_dict(response), copy=False)
 
     def stop(self):
         logger.info('Closing the responder socket in {}:{}.'.format(self._host, self._port))
         self.socket.close()
         self.context.term()
 
+class ZMQBatchResponseServer(object):
+    """
+    ROUTER-based counterpart of ZMQResponseServer that serves many REQ clients.
+    Requests that arrive within `batch_window` seconds of the first one are
+    returned together, so the caller can answer them with one batched forward pass.
+    """
+    def __init__(self, host, port):
+        self._host, self._port = host, port
+        self._init_router()
+
+    def _init_router(self):
+        self.context = zmq.Context()
+        self.socket = self.context.socket(zmq.ROUTER)
+        self.socket.bind('tcp://{}:{}'.format(self._host, self._port))
+        self.poller = zmq.Poller()
+        self.poller.register(self.socket, zmq.POLLIN)
+
+    def _recv_one(self):
+        # REQ envelope: [identity, empty delimiter, header, *buffers]
+        frames = self.socket.recv_multipart(copy=False)
+        return frames[0].bytes, unpack_array_dict(frames[2:])
+
+    def recv_requests(self, batch_window=0.005, max_batch_size=8):
+        """
+        Block until one request arrives, then keep collecting requests for at
+        most `batch_window` seconds or until `max_batch_size` are gathered.
+        Returns a list of (identity, request).
+        """
+        requests = [self._recv_one()]
+        deadline = time.time() + batch_window
+        while len(requests) < max_batch_size:
+            timeout_ms = max(0.0, deadline - time.time()) * 1000
+            if not self.poller.poll(timeout_ms):
+                break
+            requests.append(self._recv_one())
+        return requests
+
+    def send_response(self, identity, response):
+        self.socket.send_multipart([identity, b''] + pack_array_dict(response), copy=False)
+
+    def stop(self):
+        logger.info('Closing the router socket in {}:{}.'.format(self._host, self._port))
+        self.socket.close()
+        self.context.term()
+
 # Pub/Sub classes for Keypoints
 class ZMQKeypointPublisher(object):
     def __init__(self, host, port):